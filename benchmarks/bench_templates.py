@@ -0,0 +1,226 @@
+#! /usr/bin/env python
+"""
+Micro-benchmark of the construction of the METS and PREMIS elements of an audio
+CD: compares the element templates (see omSipCreator/templates.py) against
+building every element with etree.SubElement (the reference implementation
+below, which is how these elements were built before). MediaInfo is not run;
+a fixed EBUCore element is used instead, so only element construction is timed.
+
+Usage (from the root of the repository):
+
+    python benchmarks/bench_templates.py [--tracks 99] [--carriers 20] [--fixity md5,sha256]
+"""
+
+import os
+import sys
+import uuid
+import time
+import argparse
+import tempfile
+from lxml import etree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omSipCreator import config
+from omSipCreator import premis
+from omSipCreator import carrier
+from omSipCreator.checksums import algorithmNames
+
+
+def getAudioMetadata(fileName):
+    """Stand-in for mdaudio.getAudioMetadata (no MediaInfo call)"""
+    outElt = etree.Element("{%s}ebuCoreMain" % (config.ebucore_ns), nsmap=config.NSMAP)
+    etree.SubElement(outElt, "{%s}coreMetadata" % (config.ebucore_ns))
+    return {"outElt": outElt}
+
+
+def referenceCreationEvent(log):
+    """Creation event, built with etree.SubElement"""
+    event = etree.Element(etree.QName(config.premis_ns, "event"), nsmap=config.NSMAP)
+    eventIdentifier = etree.SubElement(event, "{%s}eventIdentifier" % (config.premis_ns))
+    etree.SubElement(eventIdentifier, "{%s}eventIdentifierType" % (config.premis_ns)).text = "UUID"
+    etree.SubElement(eventIdentifier, "{%s}eventIdentifierValue" % (config.premis_ns)).text = \
+        str(uuid.uuid1())
+    etree.SubElement(event, "{%s}eventType" % (config.premis_ns)).text = "creation"
+    etree.SubElement(event, "{%s}eventDateTime" % (config.premis_ns)).text = \
+        str(os.path.getctime(log))
+    eventDetailInformation = etree.SubElement(
+        event, "{%s}eventDetailInformation" % (config.premis_ns))
+    eventDetail = etree.SubElement(eventDetailInformation, "{%s}eventDetail" % (config.premis_ns))
+    eventOutcomeInformation = etree.SubElement(
+        event, "{%s}eventOutcomeInformation" % (config.premis_ns))
+    eventOutcomeDetail = etree.SubElement(
+        eventOutcomeInformation, "{%s}eventOutcomeDetail" % (config.premis_ns))
+    with open(log, "r", encoding="utf-8") as fLog:
+        etree.SubElement(eventOutcomeDetail, "{%s}eventOutcomeDetailNote" %
+                         (config.premis_ns)).text = fLog.read()
+    linkingAgentIdentifier = etree.SubElement(
+        event, "{%s}linkingAgentIdentifier" % (config.premis_ns))
+    etree.SubElement(linkingAgentIdentifier, "{%s}linkingAgentIdentifierType" %
+                     (config.premis_ns)).text = "URI"
+    linkingAgentIdentifierValue = etree.SubElement(
+        linkingAgentIdentifier, "{%s}linkingAgentIdentifierValue" % (config.premis_ns))
+    eventDetail.text = "Audio ripped with dBpoweramp"
+    linkingAgentIdentifierValue.text = "https://www.wikidata.org/wiki/Q1152133"
+    return event
+
+
+def referenceObjectInstance(fileName, fileSize, sha512Sum, extraChecksums):
+    """PREMIS object instance of an audio track, built with etree.SubElement"""
+    pObject = etree.Element(etree.QName(config.premis_ns, "object"), nsmap=config.NSMAP)
+    pObject.attrib["{%s}type" % config.xsi_ns] = "premis:file"
+    objectIdentifier = etree.SubElement(pObject, "{%s}objectIdentifier" % (config.premis_ns))
+    etree.SubElement(objectIdentifier, "{%s}objectIdentifierType" %
+                     (config.premis_ns)).text = "UUID"
+    etree.SubElement(objectIdentifier, "{%s}objectIdentifierValue" %
+                     (config.premis_ns)).text = str(uuid.uuid1())
+    objectCharacteristics = etree.SubElement(
+        pObject, "{%s}objectCharacteristics" % (config.premis_ns))
+    etree.SubElement(objectCharacteristics, "{%s}compositionLevel" %
+                     (config.premis_ns)).text = "0"
+    checksums = [("sha512", sha512Sum)] + extraChecksums
+    for algorithm, checksum in checksums:
+        fixity = etree.SubElement(objectCharacteristics, "{%s}fixity" % (config.premis_ns))
+        etree.SubElement(fixity, "{%s}messageDigestAlgorithm" %
+                         (config.premis_ns)).text = algorithmNames[algorithm]
+        etree.SubElement(fixity, "{%s}messageDigest" % (config.premis_ns)).text = checksum
+        etree.SubElement(fixity, "{%s}messageDigestOriginator" %
+                         (config.premis_ns)).text = "python.hashlib." + algorithm + ".hexdigest"
+    etree.SubElement(objectCharacteristics, "{%s}size" % (config.premis_ns)).text = fileSize
+    pFormat = etree.SubElement(objectCharacteristics, "{%s}format" % (config.premis_ns))
+    formatDesignation = etree.SubElement(pFormat, "{%s}formatDesignation" % (config.premis_ns))
+    etree.SubElement(formatDesignation, "{%s}formatName" % (config.premis_ns)).text = "Wave"
+    formatRegistry = etree.SubElement(pFormat, "{%s}formatRegistry" % (config.premis_ns))
+    etree.SubElement(formatRegistry, "{%s}formatRegistryName" % (config.premis_ns)).text = "DIAS"
+    etree.SubElement(formatRegistry, "{%s}formatRegistryKey" % (config.premis_ns)).text = "60"
+    objectCharacteristicsExtension = etree.SubElement(
+        objectCharacteristics, "{%s}objectCharacteristicsExtension" % (config.premis_ns))
+    objectCharacteristicsExtension.append(getAudioMetadata(fileName)["outElt"])
+    etree.SubElement(pObject, "{%s}originalName" % (config.premis_ns)).text = \
+        os.path.basename(fileName)
+    return pObject
+
+
+def referenceTrack(fileName, fileID, techMDID, order, checksum, extraChecksums):
+    """METS file, div and techMD elements of an audio track, built with etree.SubElement"""
+    fileElt = etree.Element(etree.QName(config.mets_ns, "file"), nsmap=config.NSMAP)
+    fileElt.attrib["ID"] = fileID
+    fileElt.attrib["SIZE"] = "52920000"
+    fLocat = etree.SubElement(fileElt, "{%s}FLocat" % (config.mets_ns))
+    fLocat.attrib["LOCTYPE"] = "URL"
+    fLocat.attrib[etree.QName(config.xlink_ns, "href")] = "file:///1/" + fileName
+    fileElt.attrib["MIMETYPE"] = "audio/wav"
+    fileElt.attrib["CHECKSUM"] = checksum
+    fileElt.attrib["CHECKSUMTYPE"] = "SHA-512"
+    fileElt.attrib["ADMID"] = techMDID
+
+    divFile = etree.Element(etree.QName(config.mets_ns, "div"), nsmap=config.NSMAP)
+    divFile.attrib["TYPE"] = "audio track"
+    divFile.attrib["ORDER"] = str(order)
+    etree.SubElement(divFile, "{%s}fptr" % (config.mets_ns)).attrib["FILEID"] = fileID
+
+    techMDPremis = etree.Element(etree.QName(config.mets_ns, "techMD"), nsmap=config.NSMAP)
+    techMDPremis.attrib["ID"] = techMDID
+    mdWrap = etree.SubElement(techMDPremis, "{%s}mdWrap" % (config.mets_ns))
+    mdWrap.attrib["MIMETYPE"] = "text/xml"
+    mdWrap.attrib["MDTYPE"] = "PREMIS:OBJECT"
+    mdWrap.attrib["MDTYPEVERSION"] = "3.0"
+    xmlData = etree.SubElement(mdWrap, "{%s}xmlData" % (config.mets_ns))
+    xmlData.append(referenceObjectInstance(fileName, "52920000", checksum, extraChecksums))
+    return [fileElt, divFile, techMDPremis]
+
+
+def templateTrack(fileName, fileID, techMDID, order, checksum, extraChecksums):
+    """METS file, div and techMD elements of an audio track, built from templates
+    (the same steps as carrier.Carrier.processMetadata)"""
+    fileElt, (fLocat,) = carrier.fileTemplate.new()
+    fileElt.attrib["ID"] = fileID
+    fileElt.attrib["SIZE"] = "52920000"
+    fLocat.attrib[carrier.xlinkHref] = "file:///1/" + fileName
+    fileElt.attrib["MIMETYPE"] = "audio/wav"
+    fileElt.attrib["CHECKSUM"] = checksum
+    fileElt.attrib["ADMID"] = techMDID
+
+    divFile, (fptr,) = carrier.divFileTemplate.new()
+    divFile.attrib["TYPE"] = "audio track"
+    divFile.attrib["ORDER"] = str(order)
+    fptr.attrib["FILEID"] = fileID
+
+    techMDPremis, (xmlData,) = carrier.techMDPremisTemplate.new()
+    techMDPremis.attrib["ID"] = techMDID
+    xmlData.append(premis.addObjectInstance(fileName, "52920000", "audio/wav", checksum,
+                                            0, None, extraChecksums))
+    return [fileElt, divFile, techMDPremis]
+
+
+def buildCarrier(buildTrack, buildEvent, log, tracks, extraChecksums):
+    """Return METS and PREMIS elements of one audio carrier"""
+    elements = [buildEvent(log)]
+    for track in range(1, tracks + 1):
+        fileName = "track%02d.wav" % track
+        elements += buildTrack(fileName, "file_" + str(track), "techMD_" + str(track),
+                               track, "%0128x" % track, extraChecksums)
+    return elements
+
+
+def normalise(elements):
+    """Return serialized elements without the values that differ between runs"""
+    result = []
+    for element in elements:
+        for elt in element.iter():
+            if elt.tag in ["{%s}objectIdentifierValue" % (config.premis_ns),
+                           "{%s}eventIdentifierValue" % (config.premis_ns),
+                           "{%s}eventDateTime" % (config.premis_ns)]:
+                elt.text = None
+        result.append(etree.tostring(element))
+    return result
+
+
+def run(name, buildTrack, buildEvent, log, args, extraChecksums):
+    """Build carriers with buildTrack and buildEvent, and report number of elements
+    per second"""
+    noElements = 0
+    start = time.perf_counter()
+    for _ in range(args.carriers):
+        for element in buildCarrier(buildTrack, buildEvent, log, args.tracks, extraChecksums):
+            noElements += sum(1 for _ in element.iter())
+    seconds = time.perf_counter() - start
+    print("%-10s %8d elements in %6.3f s: %9.0f elements/s" %
+          (name, noElements, seconds, noElements/seconds))
+    return noElements/seconds
+
+
+def main():
+    """Run benchmark"""
+    parser = argparse.ArgumentParser(description="benchmark construction of METS and PREMIS elements")
+    parser.add_argument("--tracks", type=int, default=99, help="number of tracks per carrier")
+    parser.add_argument("--carriers", type=int, default=20, help="number of carriers")
+    parser.add_argument("--fixity", default="",
+                        help="comma-separated list of additional fixity algorithms")
+    args = parser.parse_args()
+    premis.getAudioMetadata = getAudioMetadata
+    extraChecksums = [(algorithm, "%032x" % 0) for algorithm in args.fixity.split(",")
+                      if algorithm != ""]
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        log = os.path.join(tempDir, "dbpoweramp.log")
+        with open(log, "w", encoding="utf-8") as fLog:
+            fLog.write("Ripping log")
+
+        # Both implementations must give the same elements (apart from UUIDs and
+        # time stamps)
+        reference = buildCarrier(referenceTrack, referenceCreationEvent, log, 2, extraChecksums)
+        templates = buildCarrier(templateTrack, premis.addCreationEvent, log, 2, extraChecksums)
+        if normalise(reference) != normalise(templates):
+            sys.exit("template elements differ from reference elements")
+
+        print("%d carriers of %d tracks" % (args.carriers, args.tracks))
+        before = run("SubElement", referenceTrack, referenceCreationEvent, log, args,
+                     extraChecksums)
+        after = run("templates", templateTrack, premis.addCreationEvent, log, args,
+                    extraChecksums)
+        print("speedup: %.2f" % (after/before))
+
+
+if __name__ == "__main__":
+    main()
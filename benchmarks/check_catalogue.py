@@ -0,0 +1,192 @@
+#! /usr/bin/env python
+"""
+Scripted check of the catalogue lookups and of distributed processing against
+the local stand-in for the SRU service (see tests/stubserver.py),
+so no network access is needed. It checks:
+
+- sru.search_batch: splitting of the records of OR'd queries over their PPNs,
+  number of requests, PPNs without records, and single-value queries
+- retries of failed requests (the stub answers the first requests with HTTP
+  status 503), and failure once the retries are used up
+- asyncsru.search_batch, which must give the same records as sru.search_batch
+- two worker processes that write the SIPs of a generated batch of data
+  carriers at the same time (catalogue lookups go to the stub), followed by
+  collect: every PPN must be processed exactly once, without errors, and nothing
+  may be written to the input batch
+
+Usage (from the root of the repository):
+
+    python benchmarks/check_catalogue.py [--ppns 12] [--workers 2]
+"""
+
+import os
+import sys
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+
+from omSipCreator.kbapi.sru import sru
+from omSipCreator.kbapi.sru import asyncsru
+from omSipCreator.workqueue import WorkQueue
+from stubserver import StubSruServer
+from stubserver import defaultRecord
+from makebatch import makeBatch
+
+# Runs one worker (or collect) process with the stub as catalogue: python -c
+# WORKER url arguments
+WORKER = ("import sys; from omSipCreator import kbapi; kbapi.sru.baseurl = sys.argv[1]; "
+          "from omSipCreator.omSipCreator import main; "
+          "sys.argv = ['omSipCreator'] + sys.argv[2:]; main()")
+
+
+def check(condition, message):
+    """Exit with message if condition is False"""
+    if not condition:
+        sys.exit("FAILED: " + message)
+
+
+def titles(results):
+    """Return dictionary with the titles of the records of each value"""
+    return {value: [found.titles for found in records] for value, records in results.items()}
+
+
+def checkSearchBatch(PPNs):
+    """Check splitting of batched queries, and single-value queries"""
+    # Every 5th PPN has no record
+    records = {PPN: defaultRecord(PPN) for position, PPN in enumerate(PPNs) if position % 5}
+    with StubSruServer(records) as stub:
+        client = sru(stub.url, retries=0)
+        results = client.search_batch(PPNs, "GGC", batchsize=50)
+        check(stub.requestcount == (len(PPNs) + 49) // 50,
+              "expected one request per 50 PPNs, got " + str(stub.requestcount))
+        for PPN in PPNs:
+            expected = [["Title of " + PPN]] if PPN in records else []
+            check(titles(results)[PPN] == expected, "wrong records for PPN " + PPN)
+
+    # A record without PPN identifier belongs to the value of a single-value
+    # query; in an OR'd query it cannot be assigned, so the values without
+    # records are searched again on their own
+    records = {"1": defaultRecord("1").replace("PPN:1", "").replace("PPN=1", "")}
+    with StubSruServer(records) as stub:
+        client = sru(stub.url, retries=0)
+        check(len(client.search_batch(["1"], "GGC")["1"]) == 1,
+              "record of single-value query was not kept")
+        found = client.search_batch(["1", "2"], "GGC")
+        check(len(found["1"]) == 1 and len(found["2"]) == 0,
+              "unassigned record of OR'd query was lost")
+        check(stub.requestcount == 4, "expected 1 + 1 + 2 requests, got " +
+              str(stub.requestcount))
+    print("search_batch: %d PPNs OK" % len(PPNs))
+    return results
+
+
+def checkRetries():
+    """Check retries of failed requests, and failure after the last retry"""
+    with StubSruServer(failures=2) as stub:
+        client = sru(stub.url, retries=3, backoff=0.01)
+        found = client.search('"PPN=1"', "GGC")
+        check(found and found.titles == ["Title of 1"], "no record after retries")
+        check(client.latency_stats()["retries"] == 2, "expected 2 retries")
+
+    with StubSruServer(failures=10) as stub:
+        client = sru(stub.url, retries=1, backoff=0.01)
+        try:
+            client.search('"PPN=1"', "GGC")
+            failed = False
+        except Exception:
+            failed = True
+        check(failed, "search did not fail after last retry")
+        check(stub.requestcount == 2, "expected 2 requests, got " + str(stub.requestcount))
+        check(client.latency_stats()["failures"] == 1, "expected 1 failure")
+    print("retries: OK")
+
+
+def checkAsync(PPNs, expected):
+    """Check that asyncsru.search_batch gives the same records as sru.search_batch"""
+    records = {PPN: defaultRecord(PPN) for position, PPN in enumerate(PPNs) if position % 5}
+    with StubSruServer(records, delay=0.05) as stub:
+        client = asyncsru(sru(stub.url, retries=0), maxconcurrent=4)
+        try:
+            results = asyncio.run(client.search_batch(PPNs, "GGC", batchsize=20))
+        finally:
+            client.close()
+        check(stub.requestcount == (len(PPNs) + 19) // 20,
+              "expected one request per 20 PPNs, got " + str(stub.requestcount))
+        check(titles(results) == titles(expected), "asyncsru results differ from sru")
+    print("asyncsru.search_batch: OK")
+
+
+def checkWorkers(PPNs, noWorkers):
+    """Check that noWorkers worker processes write the SIPs of a batch together"""
+    with tempfile.TemporaryDirectory() as tempDir, StubSruServer(delay=0.05) as stub:
+        batchDir = os.path.join(tempDir, "batch")
+        dirOut = os.path.join(tempDir, "sips")
+        makeBatch(batchDir, PPNs)
+        batchFiles = sorted(os.listdir(batchDir))
+
+        workers = []
+        for worker in range(1, noWorkers + 1):
+            workerID = "worker" + str(worker)
+            fLog = open(os.path.join(tempDir, workerID + ".log"), "w", encoding="utf-8")
+            workers.append((workerID, fLog, subprocess.Popen(
+                [sys.executable, "-c", WORKER, stub.url, "worker", batchDir, dirOut,
+                 "--worker-id", workerID], cwd=ROOT, stdout=fLog,
+                stderr=subprocess.STDOUT)))
+        for workerID, fLog, process in workers:
+            process.wait(timeout=600)
+            fLog.close()
+            with open(fLog.name, "r", encoding="utf-8") as fIn:
+                log = fIn.read()
+            check(process.returncode == 0 and " 0 errors and 0 warnings" in log,
+                  workerID + " failed:\n" + log)
+        check(stub.requestcount > 0, "workers did not query the catalogue")
+        check(sorted(os.listdir(batchDir)) == batchFiles, "workers wrote to the input batch")
+
+        collect = subprocess.run([sys.executable, "-c", WORKER, stub.url, "collect",
+                                  "--wait", "--wait-timeout", "10", batchDir, dirOut],
+                                 cwd=ROOT,
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 universal_newlines=True, timeout=600)
+        check("resulted in 0 errors and 0 warnings" in collect.stdout,
+              "collect failed:\n" + collect.stdout)
+
+        queue = WorkQueue(os.path.join(dirOut + ".state", "queue.db"))
+        results = queue.results()
+        queue.close()
+        check([result["ppn"] for result in results] == PPNs, "PPNs missing from queue")
+        PPNsByWorker = {}
+        for result in results:
+            check(result["status"] == "done" and result["attempts"] == 1,
+                  "PPN " + result["ppn"] + " was claimed " + str(result["attempts"]) +
+                  " times (status '" + result["status"] + "')")
+            check(os.path.isfile(os.path.join(dirOut, result["ppn"], "mets.xml")),
+                  "no METS file for PPN " + result["ppn"])
+            PPNsByWorker[result["worker"]] = PPNsByWorker.get(result["worker"], 0) + 1
+    print("%d workers: %d PPNs OK (%s)" %
+          (noWorkers, len(PPNs), ", ".join(workerID + ": " + str(count) + " PPNs"
+                                           for workerID, count in sorted(PPNsByWorker.items()))))
+
+
+def main():
+    """Run checks"""
+    parser = argparse.ArgumentParser(description="check catalogue lookups and workers "
+                                     "against the stand-in SRU service")
+    parser.add_argument("--ppns", type=int, default=12,
+                        help="number of PPNs in the batch of the workers")
+    parser.add_argument("--workers", type=int, default=2, help="number of worker processes")
+    args = parser.parse_args()
+
+    PPNs = [str(100000000 + PPN) for PPN in range(120)]
+    results = checkSearchBatch(PPNs)
+    checkRetries()
+    checkAsync(PPNs, results)
+    checkWorkers([str(200000000 + PPN) for PPN in range(args.ppns)], args.workers)
+
+
+if __name__ == "__main__":
+    main()
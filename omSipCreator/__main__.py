@@ -5,4 +5,7 @@
 
 
 from .omSipCreator import main
-main()
+
+# Guard is needed because worker processes (--jobs) import this module again
+if __name__ == "__main__":
+    main()
@@ -8,21 +8,43 @@ import sys
 import shutil
 import glob
 import csv
+import json
+import time
+import sqlite3
 import logging
+import logging.handlers
+import multiprocessing
+from collections import deque
 from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
 from itertools import groupby
 from . import config
 from . import checksums
+from . import fileio
 from .ppn import PPN
+from .mods import getCatalogueRecords
+from .mods import CataloguePrefetch
+from .mods import checkNoRecords
+from .mods import reportCatalogueStats
+from .pipeline import StagePools
+from .pipeline import LogCollector
+from .checksumcache import ChecksumCache
+from .workqueue import WorkQueue
+from .workqueue import LeaseLostError
+from .kbapi import sru
+from .kbapi.cache import recordcache
 from .shared import errorExit
 from .shared import get_immediate_subdirectories
 
 
 class Batch:
     """Batch class"""
-    def __init__(self, batchDir):
+    def __init__(self, batchDir, context):
         """initialise Batch class instance"""
 
+        # Settings and state of this run (RunContext instance)
+        self.context = context
+
         # Batch directory (full path)
         self.batchDir = batchDir
         # Name of batch manifest file
@@ -31,6 +53,24 @@ class Batch:
         self.batchManifest = os.path.join(self.batchDir, self.fileBatchManifest)
         # Name of batch log file
         self.fileBatchLog = "batch.log"
+        # Name of prune journal file
+        self.filePruneJournal = "prune.journal"
+        # Prune journal file (full path; kept in the error batch, None if not pruning)
+        self.pruneJournal = None
+        if self.context.pruneBatch:
+            self.pruneJournal = os.path.join(self.context.batchErr, self.filePruneJournal)
+        # Name of checksum cache file
+        self.fileChecksumCache = "checksums.db"
+        # Checksum cache file (full path; None if no state directory is used)
+        self.checksumCacheFile = self.statePath(self.fileChecksumCache)
+        # Name of catalogue cache file
+        self.fileCatalogueCache = "catalogue.db"
+        # Catalogue cache file (full path; None if no state directory is used)
+        self.catalogueCacheFile = self.statePath(self.fileCatalogueCache)
+        # Name of work queue file (distributed processing only)
+        self.fileQueue = "queue.db"
+        # Work queue file (full path)
+        self.queueFile = self.statePath(self.fileQueue)
         # Name of iromlab version file
         self.fileIromlabVersion = "version.txt"
         # Iromlab version file (full path)
@@ -54,18 +94,168 @@ class Batch:
                                           'containsData',
                                           'cdExtra']
 
-        # List for storing directories as extracted from batch manifest
-        config.dirsInMetaCarriers = []
+    def statePath(self, fileName):
+        """Return path of fileName in the state directory, or None if no state
+        directory is used"""
+        if self.context.stateDir is None:
+            return None
+        return os.path.join(self.context.stateDir, fileName)
+
+    def createStateDir(self, fileName):
+        """Create state directory for the database fileName (if it does not exist
+        yet); returns False if this fails"""
+        try:
+            os.makedirs(self.context.stateDir, exist_ok=True)
+        except OSError:
+            logging.warning("cannot create state directory '" + self.context.stateDir +
+                            "', not using '" + fileName + "'")
+            return False
+        return True
+
+    def openChecksumCache(self):
+        """Check if the checksum cache can be opened, and return its file name, or
+        None if no checksum cache is used; if this fails we carry on without it
+        """
+        if self.checksumCacheFile is None:
+            return None
+        if not self.createStateDir(self.checksumCacheFile):
+            return None
+        try:
+            ChecksumCache(self.checksumCacheFile).close()
+        except sqlite3.Error:
+            logging.warning("cannot open checksum cache '" + self.checksumCacheFile +
+                            "', all checksums will be recalculated")
+            return None
+        return self.checksumCacheFile
 
     def process(self):
 
         """Process a batch"""
 
+        self.readManifest()
+
+        # Open checksum cache (if any)
+        self.context.checksumCache = None
+        cacheFile = self.openChecksumCache()
+        if cacheFile is not None:
+            self.context.checksumCache = ChecksumCache(cacheFile)
+
+        self.openCatalogueCache()
+
+        # Create output directory if in SIP creation mode
+        if self.context.createSIPs:
+            self.createDirOut()
+
+        # Start batched catalogue lookups of all PPNs in the background, so they
+        # overlap with the processing of the first PPNs (not needed with local
+        # records, which are only looked up if these are unusable)
+        if self.context.catalogueBatchSize > 1 and not self.context.localRecordsFlag:
+            PPNValues = list(dict.fromkeys([row[1] for row in self.rowsBatchManifest]))
+            self.context.cataloguePrefetch = CataloguePrefetch(PPNValues,
+                                                               self.context.catalogueBatchSize,
+                                                               self.context.stageWorkers["net"])
+
+        # Group by PPN
+        metaCarriersByPPN = groupby(self.rowsBatchManifest, itemgetter(1))
+
+        # ********
+        # ** Iterate over PPNs**
+        # ********
+
+        try:
+            if self.context.jobs > 1:
+                self.processPPNsParallel(metaCarriersByPPN)
+            elif self.context.pipelineFlag:
+                self.processPPNsStaged(metaCarriersByPPN)
+            else:
+                for PPNValue, carriers in metaCarriersByPPN:
+                    logging.info("Processing PPN " + PPNValue)
+                    # Create PPN class instance for this PPN
+                    thisPPN = PPN(PPNValue, self.context)
+                    # Call PPN processing function
+                    thisPPN.process(carriers, self.batchDir, self.colsBatchManifest)
+        finally:
+            # Stop remaining lookups (e.g. after a fatal error)
+            if self.context.cataloguePrefetch is not None:
+                self.context.cataloguePrefetch.shutdown()
+                self.context.cataloguePrefetch = None
+
+        self.checkCompleteness()
+
+        # Report throughput of hashing and copying
+        fileio.report_stats(self.context)
+        # Report latencies of catalogue lookups
+        reportCatalogueStats()
+
+        # Summarise no. of warnings / errors
+        logging.info("Verify / write resulted in " + str(self.context.errors) +
+                     " errors and " + str(self.context.warnings) + " warnings")
+
+        # Reset warnings/errors
+        self.context.errors = 0
+        self.context.warnings = 0
+
+    def prefetch(self):
+        """Look up the catalogue records of all PPNs in the batch manifest, and store
+        them in the catalogue cache, so later runs of the verify, prune and write
+        commands need no (or few) catalogue requests
+        """
+
+        self.readManifest()
+        if self.context.stateDir is None:
+            logging.fatal("no state directory for the catalogue cache (use --state-dir)")
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
+        self.openCatalogueCache()
+        if sru.cache is None:
+            logging.fatal("cannot prefetch catalogue records without catalogue cache")
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
+
+        PPNValues = list(dict.fromkeys([row[1] for row in self.rowsBatchManifest]))
+        catalogueRecords = getCatalogueRecords(PPNValues, self.context.catalogueBatchSize)
+
+        # Report PPNs without exactly one record, as verify would
+        for PPNValue in PPNValues:
+            if PPNValue in catalogueRecords:
+                checkNoRecords(self.context, PPNValue, len(catalogueRecords[PPNValue]))
+            else:
+                logging.error("PPN " + PPNValue + ": catalogue lookup failed")
+                self.context.addError(PPNValue)
+
+        reportCatalogueStats()
+        logging.info("Prefetched catalogue records of " + str(len(catalogueRecords)) +
+                     " out of " + str(len(PPNValues)) + " PPNs")
+
+        # Summarise no. of warnings / errors
+        logging.info("Prefetch resulted in " + str(self.context.errors) +
+                     " errors and " + str(self.context.warnings) + " warnings")
+
+    def openCatalogueCache(self):
+        """Open catalogue cache (unless it is disabled, or no state directory is
+        used), and use it for all catalogue lookups; if this fails we carry on
+        without it
+        """
+        if self.context.catalogueTTL <= 0 or sru.cache is not None:
+            return
+        if self.catalogueCacheFile is None:
+            return
+        if not self.createStateDir(self.catalogueCacheFile):
+            return
+        try:
+            sru.cache = recordcache(self.catalogueCacheFile, self.context.catalogueTTL)
+        except sqlite3.Error:
+            logging.warning("cannot open catalogue cache '" + self.catalogueCacheFile +
+                            "', all catalogue records will be looked up")
+
+    def readManifest(self):
+        """Read and check batch manifest, and list all directories in the batch"""
+
         # Check if batch dir exists
         if not os.path.isdir(self.batchDir):
             logging.fatal("input batch directory does not exist")
-            config.errors += 1
-            errorExit(config.errors, config.warnings)
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
 
         # Define dirs to ignore (jobs and jobsFailed)
         ignoreDirs = ["jobs", "jobsFailed"]
@@ -74,30 +264,30 @@ class Batch:
         # completeness check)
         # Note: all entries as full, absolute file paths!
 
-        dirsInBatch = get_immediate_subdirectories(self.batchDir, ignoreDirs)
+        self.dirsInBatch = get_immediate_subdirectories(self.batchDir, ignoreDirs)
 
         # Try to get Iromlab major / minor version from version file
         if os.path.isfile(self.iromlabVersionFile):
             try:
                 fVersion = open(self.iromlabVersionFile, "r", encoding="utf-8")
                 iromlabVersion = fVersion.readline().strip()
-                config.iromlabMajorVersion = int(iromlabVersion.split(".")[0])
-                config.iromlabMinorVersion = int(iromlabVersion.split(".")[1])
+                self.context.iromlabMajorVersion = int(iromlabVersion.split(".")[0])
+                self.context.iromlabMinorVersion = int(iromlabVersion.split(".")[1])
             except IOError:
                 logging.fatal("cannot read " + self.iromlabVersionFile)
-                config.errors += 1
-                errorExit(config.errors, config.warnings)
+                self.context.addError()
+                errorExit(self.context.errors, self.context.warnings)
 
         # Update list with required batch manifest columns if Iromlab
         # major version is 1
-        if config.iromlabMajorVersion == 1:
+        if self.context.iromlabMajorVersion == 1:
             self.requiredColsBatchManifest.extend(('mixedMode', 'cdInteractive'))
 
         # Check if batch manifest exists
         if not os.path.isfile(self.batchManifest):
             logging.fatal("file " + self.batchManifest + " does not exist")
-            config.errors += 1
-            errorExit(config.errors, config.warnings)
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
 
         # Read batch manifest as CSV and import header and
         # row data to 2 separate lists
@@ -109,12 +299,12 @@ class Batch:
             fBatchManifest.close()
         except IOError:
             logging.fatal("cannot read " + self.batchManifest)
-            config.errors += 1
-            errorExit(config.errors, config.warnings)
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
         except csv.Error:
             logging.fatal("error parsing " + self.batchManifest)
-            config.errors += 1
-            errorExit(config.errors, config.warnings)
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
 
         # Iterate over rows and check that number of columns
         # corresponds to number of header columns.
@@ -132,35 +322,8 @@ class Batch:
             elif colsRow != colsHeader:
                 logging.fatal("wrong number of columns in row " +
                               str(rowCount) + " of '" + self.batchManifest + "'")
-                config.errors += 1
-                errorExit(config.errors, config.warnings)
-
-        # Create output directory if in SIP creation mode
-        if config.createSIPs:
-            # Remove output dir tree if it exists already
-            # Potentially dangerous, so ask for user confirmation
-            if os.path.isdir(config.dirOut):
-
-                config.out.write("This will overwrite existing directory '" + config.dirOut +
-                                 "' and remove its contents!\nDo you really want to proceed" +
-                                 " (Y/N)? > ")
-                response = input()
-
-                if response.upper() == "Y":
-                    try:
-                        shutil.rmtree(config.dirOut)
-                    except OSError:
-                        logging.fatal("cannot remove '" + config.dirOut + "'")
-                        config.errors += 1
-                        errorExit(config.errors, config.warnings)
-
-            # Create new dir
-            try:
-                os.makedirs(config.dirOut)
-            except OSError:
-                logging.fatal("cannot create '" + config.dirOut + "'")
-                config.errors += 1
-                errorExit(config.errors, config.warnings)
+                self.context.addError()
+                errorExit(self.context.errors, self.context.warnings)
 
         # ********
         # ** Process batch manifest **
@@ -173,9 +336,9 @@ class Batch:
             if occurs != 1:
                 logging.fatal("found " + str(occurs) + " occurrences of column '" +
                               requiredCol + "' in " + self.batchManifest + " (expected 1)")
-                config.errors += 1
+                self.context.addError()
                 # No point in continuing if we end up here ...
-                errorExit(config.errors, config.warnings)
+                errorExit(self.context.errors, self.context.warnings)
 
         # Populate dictionary that gives for each header field the corresponding column number
 
@@ -187,43 +350,308 @@ class Batch:
         # Sort rows by PPN
         self.rowsBatchManifest.sort(key=itemgetter(1))
 
-        # Group by PPN
-        metaCarriersByPPN = groupby(self.rowsBatchManifest, itemgetter(1))
+    def createDirOut(self):
+        """Create output directory"""
 
-        # ********
-        # ** Iterate over PPNs**
-        # ********
+        # Remove output dir tree if it exists already (unless an interrupted
+        # write is resumed). Potentially dangerous, so ask for user confirmation
+        if os.path.isdir(self.context.dirOut) and not self.context.resumeFlag:
 
-        for PPNValue, carriers in metaCarriersByPPN:
-            logging.info("Processing PPN " + PPNValue)
-            # Create PPN class instance for this PPN
-            thisPPN = PPN(PPNValue)
-            # Call PPN processing function
-            thisPPN.process(carriers, self.batchDir, self.colsBatchManifest)
+            config.out.write("This will overwrite existing directory '" + self.context.dirOut +
+                             "' and remove its contents!\nDo you really want to proceed" +
+                             " (Y/N)? > ")
+            response = input()
+
+            if response.upper() == "Y":
+                try:
+                    shutil.rmtree(self.context.dirOut)
+                except OSError:
+                    logging.fatal("cannot remove '" + self.context.dirOut + "'")
+                    self.context.addError()
+                    errorExit(self.context.errors, self.context.warnings)
 
-        # Check if directories that are part of batch are all represented in carrier metadata file
-        # (reverse already covered by checks above)
+        # Create new dir
+        try:
+            os.makedirs(self.context.dirOut, exist_ok=self.context.resumeFlag)
+        except OSError:
+            logging.fatal("cannot create '" + self.context.dirOut + "'")
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
+
+    def checkCompleteness(self):
+        """Check if directories that are part of batch are all represented in
+        carrier metadata file (reverse already covered by PPN processing)"""
 
         # Diff as list
-        diffDirs = list(set(dirsInBatch) - set(config.dirsInMetaCarriers))
+        diffDirs = list(set(self.dirsInBatch) - set(self.context.dirsInMetaCarriers))
 
         # Report each item in list as an error
 
         for directory in diffDirs:
             logging.error("directory '" + directory + "' not referenced in '" + self.batchManifest + "'")
-            config.errors += 1
-            config.failedPPNs.append(PPN)
-
-        # Summarise no. of warnings / errors
-        logging.info("Verify / write resulted in " + str(config.errors) +
-                     " errors and " + str(config.warnings) + " warnings")
+            self.context.addError(PPN)
+
+    def processPPNsParallel(self, metaCarriersByPPN):
+        """Process PPNs concurrently in a pool of context.jobs worker processes
+        Log output of each PPN is buffered by the worker, and logged here in the
+        original PPN order. Error and warning counts, failed PPNs, carrier
+        directories and I/O statistics of all PPNs are merged into the context
+        """
+
+        cacheFile = None
+        if self.context.checksumCache is not None:
+            cacheFile = self.checksumCacheFile
+
+        # Worker processes are not forked: threads of this process (e.g. background
+        # catalogue lookups) may hold locks at the time of a fork, which would then
+        # stay locked forever in the worker. Process-wide settings are passed to the
+        # workers by initWorker instead
+        startMethod = "spawn"
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            startMethod = "forkserver"
+        with ProcessPoolExecutor(max_workers=self.context.jobs,
+                                 mp_context=multiprocessing.get_context(startMethod),
+                                 initializer=initWorker,
+                                 initargs=(workerSettings(),)) as executor:
+            # PPNs are submitted when there is room in the pool (and a queue of the
+            # same size), so the background catalogue lookup of each PPN has (usually)
+            # finished by then, and its records can be passed to the worker
+            futures = deque()
+            for PPNValue, carriers in metaCarriersByPPN:
+                if len(futures) >= 2 * self.context.jobs:
+                    self.finishPPNParallel(executor, *futures.popleft())
+                futures.append((PPNValue, executor.submit(processPPN,
+                                                          self.context.newWorkerContext(PPNValue),
+                                                          PPNValue, list(carriers), self.batchDir,
+                                                          self.colsBatchManifest, cacheFile)))
+            while futures:
+                self.finishPPNParallel(executor, *futures.popleft())
+
+    def finishPPNParallel(self, executor, PPNValue, future):
+        """Log buffered output of PPN that was processed by a worker process, and
+        merge its results into the context"""
+        logging.info("Processing PPN " + PPNValue)
+        records, workerContext, exited = future.result()
+        for record in records:
+            logging.getLogger().handle(record)
+        self.context.merge(workerContext)
+        if exited:
+            # Fatal error in this PPN, so stop as in serial processing
+            executor.shutdown(wait=True, cancel_futures=True)
+            errorExit(self.context.errors, self.context.warnings)
+
+    def processPPNsStaged(self, metaCarriersByPPN):
+        """Process PPNs in a staged pipeline, with separate worker pools for disk I/O,
+        CPU and network work (see StagePools), so reading and copying the carriers of
+        one PPN overlaps with building the METS of earlier PPNs and with catalogue
+        lookups. Stages of different PPNs run at the same time, so the log output of
+        each PPN is collected (see StagePools.collectLog), and logged in one piece
+        once the PPN is finished. PPNs are finished, and their output is logged, in
+        their original order
+        """
+
+        stagePools = StagePools(self.context)
+        logCollector = LogCollector(stagePools)
+        # Collected log records and future of the last stage of each PPN in the pipeline
+        pipelinePPNs = deque()
+        try:
+            for PPNValue, carriers in metaCarriersByPPN:
+                # Wait for oldest PPN if pipeline is full
+                if len(pipelinePPNs) >= stagePools.depth:
+                    self.finishPPNStaged(logCollector, pipelinePPNs)
+                segments = []
+                pipelinePPNs.append((segments, None))
+                with stagePools.collectLog(segments):
+                    logging.info("Processing PPN " + PPNValue)
+                    # Create PPN class instance for this PPN, and submit its stages
+                    thisPPN = PPN(PPNValue, self.context)
+                    pipelinePPNs[-1] = (segments, thisPPN.submit(stagePools, carriers,
+                                                                 self.batchDir,
+                                                                 self.colsBatchManifest))
+            while pipelinePPNs:
+                self.finishPPNStaged(logCollector, pipelinePPNs)
+        except BaseException:
+            # Fatal error (errorExit) in one of the PPNs, so cancel all queued work,
+            # and log the output of the PPNs in the pipeline (the first one is the
+            # PPN with the fatal error, unless the error was in submitting a PPN)
+            stagePools.shutdown(cancel=True)
+            for segments, future in pipelinePPNs:
+                logCollector.write(segments)
+            raise
+        finally:
+            logCollector.remove()
+        stagePools.shutdown()
+
+    def finishPPNStaged(self, logCollector, pipelinePPNs):
+        """Wait for oldest PPN in pipeline, and log its collected output; if the PPN
+        stopped because of a fatal error, it is left in pipelinePPNs"""
+        segments, future = pipelinePPNs[0]
+        future.result()
+        pipelinePPNs.popleft()
+        logCollector.write(segments)
+
+    def work(self, workerID, leaseTime):
+        """Process PPNs of batch as one of several worker processes (possibly on
+        different machines) that share a work queue in the state directory. The
+        worker claims one PPN at a time, and stores its results in the queue; these
+        are merged by collect
+        """
+
+        self.readManifest()
+
+        # Open checksum cache (if any); each PPN opens it again (see processPPN)
+        cacheFile = self.openChecksumCache()
+
+        self.openCatalogueCache()
+
+        # Create output directory (shared by all workers)
+        self.createDirOut()
+
+        # Carrier records by PPN
+        carriersByPPN = {}
+        for PPNValue, carriers in groupby(self.rowsBatchManifest, itemgetter(1)):
+            carriersByPPN[PPNValue] = list(carriers)
+
+        # Open work queue, and fill it if this is the first worker
+        try:
+            os.makedirs(self.context.stateDir, exist_ok=True)
+        except OSError:
+            logging.fatal("cannot create state directory '" + self.context.stateDir + "'")
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
+        try:
+            queue = WorkQueue(self.queueFile, leaseTime)
+            queueOK = queue.populate(list(carriersByPPN), os.path.abspath(self.context.dirOut))
+        except sqlite3.Error:
+            logging.fatal("cannot open work queue '" + self.queueFile + "'")
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
+        if not queueOK:
+            logging.fatal("work queue '" + self.queueFile +
+                          "' was created for another output directory")
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
+
+        noPPNs = 0
+        while True:
+            PPNValue = queue.claim(workerID)
+            if PPNValue is None:
+                break
+            logging.info("Processing PPN " + PPNValue)
+            try:
+                with queue.leased(PPNValue, workerID) as leaseLost:
+                    PPNContext = self.context.newWorkerContext()
+                    PPNContext.leaseLost = leaseLost
+                    records, PPNContext, exited = processPPN(PPNContext, PPNValue,
+                                                             carriersByPPN[PPNValue],
+                                                             self.batchDir,
+                                                             self.colsBatchManifest,
+                                                             cacheFile)
+            except LeaseLostError:
+                # Another worker has (or may have) claimed this PPN, and continues
+                # writing its SIP, so leave the output to that worker
+                logging.warning("worker " + workerID + " lost lease on PPN " + PPNValue +
+                                ", processing of this PPN is aborted")
+                self.context.addWarning()
+                continue
+            for record in records:
+                logging.getLogger().handle(record)
+            self.context.merge(PPNContext)
+            noPPNs += 1
+            if not queue.complete(PPNValue, workerID, records, PPNContext, exited):
+                logging.warning("worker " + workerID + " lost lease on PPN " + PPNValue +
+                                ", results of this worker are discarded")
+                self.context.addWarning()
+            if exited:
+                # Fatal error in this PPN, so stop this worker
+                queue.close()
+                errorExit(self.context.errors, self.context.warnings)
+
+        queue.close()
+
+        # Report throughput of hashing and copying
+        fileio.report_stats(self.context)
+        # Report latencies of catalogue lookups
+        reportCatalogueStats()
+
+        logging.info("Worker " + workerID + " processed " + str(noPPNs) + " PPNs with " +
+                     str(self.context.errors) + " errors and " + str(self.context.warnings) +
+                     " warnings")
+
+    def collect(self, waitFlag, waitTimeout=600, pollInterval=10):
+        """Merge results of all workers from the work queue, and report errors and
+        warnings of the whole batch. If waitFlag is True, wait until all PPNs are done,
+        or until no worker has made progress for waitTimeout seconds (i.e. no PPN was
+        finished, and no PPN was claimed by a worker with a live lease), e.g. because
+        all workers stopped. PPNs that are not done are reported as errors
+        """
+
+        self.readManifest()
+
+        if not os.path.isfile(self.queueFile):
+            logging.fatal("work queue '" + self.queueFile + "' does not exist")
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
 
-        # Reset warnings/errors
-        config.errors = 0
-        config.warnings = 0
+        try:
+            queue = WorkQueue(self.queueFile)
+            if waitFlag:
+                lastUnfinished = None
+                while True:
+                    unfinished = queue.unfinished()
+                    if unfinished == 0:
+                        break
+                    if unfinished != lastUnfinished or queue.busy() > 0:
+                        lastProgress = time.time()
+                        lastUnfinished = unfinished
+                    elif time.time() - lastProgress >= waitTimeout:
+                        logging.warning("no worker made progress in the last " +
+                                        str(waitTimeout) + " seconds, stopped waiting for " +
+                                        str(unfinished) + " unfinished PPNs")
+                        self.context.addWarning()
+                        break
+                    time.sleep(pollInterval)
+            results = queue.results()
+            queue.close()
+        except sqlite3.Error:
+            logging.fatal("cannot read work queue '" + self.queueFile + "'")
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
+
+        for result in results:
+            PPNValue = result["ppn"]
+            logging.info("Processing PPN " + PPNValue)
+            if result["status"] != "done":
+                logging.error("PPN " + PPNValue + " was not processed (status '" +
+                              result["status"] + "')")
+                self.context.addError(PPNValue)
+                continue
+            for name, levelno, levelname, msg in result["log"]:
+                logging.getLogger().handle(logging.makeLogRecord({"name": name,
+                                                                  "levelno": levelno,
+                                                                  "levelname": levelname,
+                                                                  "msg": msg}))
+            PPNContext = self.context.newWorkerContext()
+            PPNContext.errors = result["errors"]
+            PPNContext.warnings = result["warnings"]
+            if result["failed"]:
+                PPNContext.failedPPNs.add(PPNValue)
+            PPNContext.dirsInMetaCarriers = result["dirs"]
+            for ioMode, (noBytes, seconds) in result["io_stats"].items():
+                PPNContext.addIOStats(ioMode, noBytes, seconds)
+            self.context.merge(PPNContext)
+
+        # Carrier directories of unfinished PPNs are unknown, so the completeness
+        # check is only done if all PPNs are done
+        if all(result["status"] == "done" for result in results):
+            self.checkCompleteness()
+
+        # Report throughput of hashing and copying
+        fileio.report_stats(self.context)
 
-        # Get all unique values in failedPPNs by converting to a set (and then back to a list)
-        config.failedPPNs = (list(set(config.failedPPNs)))
+        # Summarise no. of warnings / errors
+        logging.info("Verify / write resulted in " + str(self.context.errors) +
+                     " errors and " + str(self.context.warnings) + " warnings")
 
     def prune(self):
         """Prune batch"""
@@ -233,35 +661,35 @@ class Batch:
         # Check if batchErr is an existing directory. If yes,
         # prompt user to confirm that it will be overwritten
 
-        if os.path.isdir(config.batchErr):
+        if os.path.isdir(self.context.batchErr):
 
             config.out.write("\nThis will overwrite existing directory '" +
-                             config.batchErr + "' and remove its contents!\n" +
+                             self.context.batchErr + "' and remove its contents!\n" +
                              "Do you really want to proceed (Y/N)? > ")
             response = input()
 
             if response.upper() == "Y":
                 try:
-                    shutil.rmtree(config.batchErr)
+                    shutil.rmtree(self.context.batchErr)
                 except OSError:
-                    logging.fatal("cannot remove '" + config.batchErr + "'")
-                    config.errors += 1
-                    errorExit(config.errors, config.warnings)
+                    logging.fatal("cannot remove '" + self.context.batchErr + "'")
+                    self.context.addError()
+                    errorExit(self.context.errors, self.context.warnings)
             else:
                 logging.error("exiting because user pressed 'N'")
-                errorExit(config.errors, config.warnings)
+                errorExit(self.context.errors, self.context.warnings)
 
         # Create batchErr directory
 
         try:
-            os.makedirs(config.batchErr)
+            os.makedirs(self.context.batchErr)
         except (OSError, IOError):
-            logging.fatal("Cannot create directory '" + config.batchErr + "'")
-            config.errors += 1
-            errorExit(config.errors, config.warnings)
+            logging.fatal("Cannot create directory '" + self.context.batchErr + "'")
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
 
         # Add batch manifest to batchErr directory
-        batchManifestErr = os.path.join(config.batchErr, self.fileBatchManifest)
+        batchManifestErr = os.path.join(self.context.batchErr, self.fileBatchManifest)
 
         # Add temporary (updated) batch manifest to batchIn
         fileBatchManifestTemp = "tmp.csv"
@@ -274,8 +702,8 @@ class Batch:
                 batchManifestTemp, "w", encoding="utf-8")
         except IOError:
             logging.fatal("cannot write batch manifest")
-            config.errors += 1
-            errorExit(config.errors, config.warnings)
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
 
         # Create CSV writer objects
         csvErr = csv.writer(fbatchManifestErr, lineterminator='\n')
@@ -285,8 +713,16 @@ class Batch:
         csvErr.writerow(self.headerBatchManifest)
         csvTemp.writerow(self.headerBatchManifest)
 
-        # Create list to store all image path directories
+        # If batchIn and batchErr are on the same file system, directories are moved
+        # to the error batch by renaming them, instead of copying them
+        renameFlag = os.stat(self.batchDir).st_dev == os.stat(self.context.batchErr).st_dev
+        if renameFlag:
+            logging.info("batchIn and batchErr are on the same file system, " +
+                         "moving directories by renaming them")
+
+        # Create lists to store all image path directories
         imagePathsIn = []
+        imagePathsErr = []
 
         # Iterate over all entries in batch manifest
 
@@ -294,17 +730,23 @@ class Batch:
             jobID = row[0]
             PPNValue = row[1]
 
-            if PPNValue in config.failedPPNs:
+            if PPNValue in self.context.failedPPNs:
                 # If PPN is in list of failed PPNs then add record to error batch
 
                 # Image path for this jobID in input, pruned and error batch
                 imagePathIn = os.path.normpath(os.path.join(self.batchDir, jobID))
-                imagePathErr = os.path.normpath(os.path.join(config.batchErr, jobID))
+                imagePathErr = os.path.normpath(os.path.join(self.context.batchErr, jobID))
 
                 imagePathInAbs = os.path.abspath(imagePathIn)
                 imagePathErrAbs = os.path.abspath(imagePathErr)
 
-                if os.path.isdir(imagePathInAbs):
+                if os.path.isdir(imagePathInAbs) and renameFlag:
+
+                    # Add paths to lists; directory is moved after all manifests are written
+                    imagePathsIn.append(imagePathInAbs)
+                    imagePathsErr.append(imagePathErrAbs)
+
+                elif os.path.isdir(imagePathInAbs):
 
                     # Add path to list
                     imagePathsIn.append(imagePathInAbs)
@@ -316,7 +758,7 @@ class Batch:
                         logging.error("jobID " + jobID +
                                       ": could not create directory '" +
                                       imagePathErrAbs)
-                        config.errors += 1
+                        self.context.addError()
 
                     # All files in directory
                     allFiles = glob.glob(imagePathInAbs + "/*")
@@ -324,30 +766,33 @@ class Batch:
                     # Copy all files to error batch and do post-copy checksum verification
                     logging.info("Copying files to error batch")
 
-                    for fileIn in allFiles:
-                        # File base name
-                        fileBaseName = os.path.basename(fileIn)
-
-                        # Path to copied file
-                        fileErr = os.path.join(imagePathErrAbs, fileBaseName)
+                    # Paths to copied files
+                    filesErr = [os.path.join(imagePathErrAbs, os.path.basename(fileIn))
+                                for fileIn in allFiles]
 
+                    for fileIn, fileErr in zip(allFiles, filesErr):
                         # Copy file to batchErr
                         try:
                             shutil.copy2(fileIn, fileErr)
                         except (IOError, OSError):
                             logging.error("jobID " + jobID + ": cannot copy '" +
                                           fileIn + "' to '" + fileErr + "'")
-                            config.errors += 1
+                            self.context.addError()
 
-                        # Verify checksum
-                        checksumIn = checksums.generate_file_sha512(fileIn)
-                        checksumErr = checksums.generate_file_sha512(fileErr)
+                    # Verify checksums (files are hashed concurrently)
+                    checksumsIn = checksums.get_files_sha512(self.context, allFiles)
+                    checksumsErr = checksums.map_hash_workers(self.context,
+                                                              checksums.generate_file_sha512,
+                                                              filesErr)
 
+                    for fileIn, fileErr, checksumIn, checksumErr in zip(allFiles, filesErr,
+                                                                        checksumsIn,
+                                                                        checksumsErr):
                         if checksumIn != checksumErr:
                             logging.critical("jobID " + jobID + ": checksum of '" +
                                           fileIn + "' does not match '" + fileErr + "'")
-                            config.errors += 1
-                            #errorExit(config.errors, config.warnings)
+                            self.context.addError()
+                            #errorExit(self.context.errors, self.context.warnings)
 
                 # Write row to error batch manifest
                 logging.info("Writing batch manifest entry (batchErr)")
@@ -361,7 +806,33 @@ class Batch:
         fbatchManifestErr.close()
         fbatchManifestTemp.close()
 
-        if config.errors == 0:
+        # Original batchManifest is kept with '.old' extension
+        fileBatchManifestOld = os.path.splitext(self.fileBatchManifest)[0] + ".old"
+        batchManifestOld = os.path.join(self.batchDir, fileBatchManifestOld)
+
+        if self.context.errors == 0 and renameFlag:
+
+            # Write journal with all remaining steps, which are then carried out. If
+            # pruning is interrupted, the journal is used to complete these steps
+            # (see rollForwardPrune)
+            journal = {"moves": list(zip(imagePathsIn, imagePathsErr)),
+                       "batchManifest": self.batchManifest,
+                       "batchManifestTemp": batchManifestTemp,
+                       "batchManifestOld": batchManifestOld,
+                       "copies": self.pruneCopies()}
+            try:
+                with open(self.pruneJournal, "w", encoding="utf-8") as fJournal:
+                    json.dump(journal, fJournal, indent=4)
+                    fJournal.flush()
+                    os.fsync(fJournal.fileno())
+            except IOError:
+                logging.fatal("cannot write '" + self.pruneJournal + "'")
+                self.context.addError()
+                errorExit(self.context.errors, self.context.warnings)
+
+            self.executePruneJournal(journal)
+
+        elif self.context.errors == 0:
 
             # Remove directories from input batch
             for imagePath in imagePathsIn:
@@ -371,11 +842,9 @@ class Batch:
                     shutil.rmtree(imagePath)
                 except OSError:
                     logging.error("cannot remove '" + imagePath + "'")
-                    config.errors += 1
+                    self.context.addError()
 
             # Rename original batchManifest to '.old' extension
-            fileBatchManifestOld = os.path.splitext(self.fileBatchManifest)[0] + ".old"
-            batchManifestOld = os.path.join(self.batchDir, fileBatchManifestOld)
             os.rename(self.batchManifest, batchManifestOld)
 
             # Rename batchManifestTemp to batchManifest
@@ -384,20 +853,171 @@ class Batch:
             logging.info("Saved old batch manifest in batchIn as '" +
                          fileBatchManifestOld + "'")
 
-            # Copy batch log to error batch
-            batchLogIn = os.path.join(self.batchDir, self.fileBatchLog)
-            batchLogErr = os.path.join(config.batchErr, self.fileBatchLog)
-            shutil.copy2(batchLogIn, batchLogErr)
-
-            if config.iromlabMajorVersion >= 1:
-                # Copy Iromlab version file to error batch
-                iromlabVersionFileErr = os.path.join(config.batchErr, self.fileIromlabVersion)
-                shutil.copy2(self.iromlabVersionFile, iromlabVersionFileErr)
+            # Copy batch log and Iromlab version file to error batch
+            for fileIn, fileErr in self.pruneCopies():
+                shutil.copy2(fileIn, fileErr)
 
         else:
             logging.info("Errors occurred so skipping updating of batch manifests")
-            os.remove(fbatchManifestTemp)    
+            os.remove(batchManifestTemp)
 
         # Summarise no. of additional warnings / errors during pruning
-        logging.info("Pruning resulted in additional " + str(config.errors) +
-                     " errors and " + str(config.warnings) + " warnings")
+        logging.info("Pruning resulted in additional " + str(self.context.errors) +
+                     " errors and " + str(self.context.warnings) + " warnings")
+
+    def pruneCopies(self):
+        """Return list of (source, destination) pairs of batch-level files that are
+        copied to the error batch when pruning
+        """
+        copies = [(os.path.join(self.batchDir, self.fileBatchLog),
+                   os.path.join(self.context.batchErr, self.fileBatchLog))]
+        if self.context.iromlabMajorVersion >= 1:
+            copies.append((self.iromlabVersionFile,
+                           os.path.join(self.context.batchErr, self.fileIromlabVersion)))
+        return copies
+
+    def executePruneJournal(self, journal):
+        """Carry out all steps in prune journal, and remove the journal afterwards
+        Steps that were already completed are skipped, so this can be used to roll
+        forward a prune that was interrupted
+        """
+
+        # Move directories to error batch
+        for imagePathIn, imagePathErr in journal["moves"]:
+            if os.path.isdir(imagePathIn) and not os.path.exists(imagePathErr):
+                logging.info("Moving directory '" + imagePathIn + "' to batchErr")
+                try:
+                    os.rename(imagePathIn, imagePathErr)
+                except OSError:
+                    logging.error("cannot move '" + imagePathIn + "' to '" +
+                                  imagePathErr + "'")
+                    self.context.addError()
+            elif os.path.exists(imagePathIn):
+                logging.error("cannot move '" + imagePathIn + "' to '" +
+                              imagePathErr + "' (destination exists)")
+                self.context.addError()
+
+        if self.context.errors != 0:
+            logging.info("Errors occurred so keeping prune journal '" + self.pruneJournal +
+                         "'; fix these errors and run prune again to complete pruning")
+            return
+
+        # Replace batch manifest by updated version, and keep original. If the
+        # batch manifest doesn't exist, it was already renamed before the interruption
+        if os.path.isfile(journal["batchManifestTemp"]):
+            if os.path.isfile(journal["batchManifest"]):
+                os.replace(journal["batchManifest"], journal["batchManifestOld"])
+            os.replace(journal["batchManifestTemp"], journal["batchManifest"])
+            logging.info("Saved old batch manifest in batchIn as '" +
+                         os.path.basename(journal["batchManifestOld"]) + "'")
+
+        # Copy batch log and Iromlab version file to error batch
+        for fileIn, fileErr in journal["copies"]:
+            shutil.copy2(fileIn, fileErr)
+
+        os.remove(self.pruneJournal)
+
+    def rollForwardPrune(self):
+        """Complete a prune that was interrupted, using the prune journal.
+        Returns True if a journal was found
+        """
+
+        if not os.path.isfile(self.pruneJournal):
+            return False
+
+        logging.info("Found prune journal '" + self.pruneJournal +
+                     "', completing interrupted prune")
+        try:
+            with open(self.pruneJournal, "r", encoding="utf-8") as fJournal:
+                journal = json.load(fJournal)
+        except (IOError, ValueError):
+            logging.fatal("cannot read '" + self.pruneJournal + "'")
+            self.context.addError()
+            errorExit(self.context.errors, self.context.warnings)
+
+        self.executePruneJournal(journal)
+        if self.context.errors != 0:
+            errorExit(self.context.errors, self.context.warnings)
+        return True
+
+
+def workerSettings():
+    """Return dictionary with the process-wide settings (module-level values in
+    config and the shared SRU client) that worker processes need"""
+    catalogueCache = None
+    if sru.cache is not None:
+        catalogueCache = (sru.cache.dbfile, sru.cache.ttl)
+    return {"scriptName": config.scriptName,
+            "version": config.version,
+            "mediaInfoExe": config.mediaInfoExe,
+            "catalogueURL": sru.baseurl,
+            "catalogueTimeout": sru.timeout,
+            "catalogueRetries": sru.retries,
+            "catalogueCache": catalogueCache}
+
+
+def initWorker(settings):
+    """Apply settings (see workerSettings) in a new worker process"""
+    config.scriptName = settings["scriptName"]
+    config.version = settings["version"]
+    config.mediaInfoExe = settings["mediaInfoExe"]
+    sru.baseurl = settings["catalogueURL"]
+    sru.timeout = settings["catalogueTimeout"]
+    sru.retries = settings["catalogueRetries"]
+    if settings["catalogueCache"] is not None and sru.cache is None:
+        try:
+            sru.cache = recordcache(*settings["catalogueCache"])
+        except sqlite3.Error:
+            sru.cache = None
+
+
+def processPPN(context, PPNValue, carriers, batchDir, colsBatchManifest, cacheFile):
+    """Process one PPN in a worker process. context is a RunContext with the
+    settings of the run (see RunContext.newWorkerContext). Returns tuple with
+    buffered log records, context (with the errors, warnings, failed PPNs,
+    carrier directories and I/O statistics of this PPN only) and a flag that
+    indicates if processing stopped because of a fatal error
+    """
+
+    # SQLite connections cannot be shared between processes, so each worker
+    # opens the checksum cache itself
+    if cacheFile is not None:
+        try:
+            context.checksumCache = ChecksumCache(cacheFile)
+        except sqlite3.Error:
+            context.checksumCache = None
+
+    # Buffer all log records of this PPN
+    logging.getLogger("requests").setLevel(logging.WARNING)
+    logger = logging.getLogger()
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+    bufferHandler = logging.handlers.BufferingHandler(sys.maxsize)
+    logger.addHandler(bufferHandler)
+    logger.setLevel(logging.INFO)
+
+    exited = False
+    try:
+        thisPPN = PPN(PPNValue, context)
+        thisPPN.process(carriers, batchDir, colsBatchManifest)
+    except SystemExit:
+        # Raised by errorExit, which also logs the number of errors of this PPN
+        # only; the batch totals are reported by the main process instead
+        exited = True
+        del bufferHandler.buffer[-1:]
+    finally:
+        logger.removeHandler(bufferHandler)
+        for handler in handlers:
+            logger.addHandler(handler)
+        if context.checksumCache is not None:
+            context.checksumCache.close()
+
+    # Format messages here, so records can be pickled
+    records = bufferHandler.buffer
+    for record in records:
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+
+    return records, context, exited
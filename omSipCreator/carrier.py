@@ -4,7 +4,6 @@ Class and processing functions for one carrier
 """
 
 import os
-import shutil
 import glob
 import logging
 from operator import itemgetter
@@ -15,12 +14,71 @@ from .shared import errorExit
 from .cdinfo import parseCDInfoLog
 from .premis import addCreationEvent
 from .premis import addObjectInstance
+from .mods import getLocalRecords
+from .templates import ElementTemplate
+
+# Qualified name of xlink:href attribute
+xlinkHref = "{%s}href" % (config.xlink_ns)
+
+
+def createFileTemplate():
+    """Return template for METS file element with FLocat child element; the slot
+    is the FLocat element. All attributes are set in the template (with empty
+    values if they differ for each file), so their order is fixed"""
+    fileEltName = etree.QName(config.mets_ns, "file")
+    fileElt = etree.Element(fileEltName, nsmap=config.NSMAP)
+    fileElt.attrib["ID"] = ""
+    fileElt.attrib["SIZE"] = ""
+    fLocat = etree.SubElement(
+        fileElt, "{%s}FLocat" % (config.mets_ns))
+    fLocat.attrib["LOCTYPE"] = "URL"
+    fLocat.attrib[xlinkHref] = ""
+    fileElt.attrib["MIMETYPE"] = ""
+    fileElt.attrib["CHECKSUM"] = ""
+    fileElt.attrib["CHECKSUMTYPE"] = "SHA-512"
+    fileElt.attrib["ADMID"] = ""
+    return ElementTemplate(fileElt, [fLocat])
+
+
+def createDivFileTemplate():
+    """Return template for file-level structMap div element with fptr child
+    element; the slot is the fptr element"""
+    divFileName = etree.QName(config.mets_ns, "div")
+    divFile = etree.Element(divFileName, nsmap=config.NSMAP)
+    divFile.attrib["TYPE"] = ""
+    divFile.attrib["ORDER"] = ""
+    fptr = etree.SubElement(divFile, "{%s}fptr" % (config.mets_ns))
+    fptr.attrib["FILEID"] = ""
+    return ElementTemplate(divFile, [fptr])
+
+
+def createTechMDPremisTemplate():
+    """Return template for techMD element that wraps PREMIS object information;
+    the slot is the xmlData element"""
+    techMDPremisName = etree.QName(config.mets_ns, "techMD")
+    techMDPremis = etree.Element(techMDPremisName, nsmap=config.NSMAP)
+    techMDPremis.attrib["ID"] = ""
+    mdWrapObjectPremis = etree.SubElement(
+        techMDPremis, "{%s}mdWrap" % (config.mets_ns))
+    mdWrapObjectPremis.attrib["MIMETYPE"] = "text/xml"
+    mdWrapObjectPremis.attrib["MDTYPE"] = "PREMIS:OBJECT"
+    mdWrapObjectPremis.attrib["MDTYPEVERSION"] = "3.0"
+    xmlDataObjectPremis = etree.SubElement(
+        mdWrapObjectPremis, "{%s}xmlData" % (config.mets_ns))
+    return ElementTemplate(techMDPremis, [xmlDataObjectPremis])
+
+
+# Templates for the METS elements of each file
+fileTemplate = createFileTemplate()
+divFileTemplate = createDivFileTemplate()
+techMDPremisTemplate = createTechMDPremisTemplate()
 
 
 class Carrier:
     """Carrier class"""
-    def __init__(self, jobID, PPN, imagePathFull, volumeNumber):
+    def __init__(self, jobID, PPN, imagePathFull, volumeNumber, context):
         """Initialise Carrier class instance"""
+        self.context = context
         self.jobID = jobID
         self.PPN = PPN
         self.imagePathFull = imagePathFull
@@ -31,27 +89,23 @@ class Carrier:
         self.fileElements = []
         self.techMDFileElements = []
         self.premisCreationEvents = []
+        # Catalogue records for PPN in meta-kbmdo.xml (None if not read)
+        self.localRecords = None
         cdInfoName = etree.QName(config.cdInfo_ns, "cd-info")
         self.cdInfoElt = etree.Element(cdInfoName, nsmap=config.NSMAP)
 
     def process(self, SIPPath, sipFileCounterStart, counterTechMDStart):
         """Process one carrier"""
+        self.processFiles(SIPPath)
+        return self.processMetadata(sipFileCounterStart, counterTechMDStart)
+
+    def processFiles(self, SIPPath):
+        """Verify carrier directory and checksums, and copy files to SIP
+        (I/O stage of process)"""
         # TODO: * check file type / extension matches carrierType!
         # TODO: currently lots of file path manipulations which make things hard to read,
         # could be better structured with more understandable naming conventions.
 
-        fileCounter = 1
-        sipFileCounter = sipFileCounterStart
-        counterTechMD = counterTechMDStart
-
-        # Mapping between mimeType and structmap TYPE field
-
-        mimeTypeMap = {
-            "application/x-iso9660-image": "disk image",
-            "audio/flac": "audio track",
-            "audio/wav": "audio track"
-        }
-
         # All files in directory
         allFiles = glob.glob(self.imagePathFull + "/*")
 
@@ -66,9 +120,8 @@ class Carrier:
                           " checksum files in directory '" +
                           self.imagePathFull + "', expected 1")
 
-            config.errors += 1
-            config.failedPPNs.append(self.PPN)
-            #errorExit(config.errors, config.warnings)
+            self.context.addError(self.PPN)
+            #errorExit(self.context.errors, self.context.warnings)
 
 
         # Find logfiles and reports (by name extension)
@@ -92,22 +145,19 @@ class Carrier:
                           " : expected 1 file 'cd-info.log' in directory '" +
                           self.imagePathFull +
                           " , found " + str(noCdinfoLogs))
-            config.errors += 1
-            config.failedPPNs.append(self.PPN)
+            self.context.addError(self.PPN)
 
         if noKbmdoMetaFiles != 1:
             logging.error("jobID " + self.jobID +
                           " : expected 1 file 'meta-kbmdo.xml' in directory '" +
                           self.imagePathFull +
                           " , found " + str(noKbmdoMetaFiles))
-            config.errors += 1
-            config.failedPPNs.append(self.PPN)
+            self.context.addError(self.PPN)
 
         if noOtherFiles == 0:
             logging.error("jobID " + self.jobID + ": found no files in directory '" +
                           self.imagePathFull)
-            config.errors += 1
-            config.failedPPNs.append(self.PPN)
+            self.context.addError(self.PPN)
 
         # Get number of ISO files and number of audio files, and cross-check consistency
         # with log file names
@@ -122,38 +172,50 @@ class Carrier:
                           " : expected 1 file 'isobuster.log' in directory '" +
                           self.imagePathFull +
                           " , found " + str(noIsobusterLogs))
-            config.errors += 1
-            config.failedPPNs.append(self.PPN)
+            self.context.addError(self.PPN)
 
         if noIsoFiles > 0 and noIsobusterReports != 1:
             logging.error("jobID " + self.jobID +
                           " : expected 1 file 'isobuster-report.xml' in directory '" +
                           self.imagePathFull +
                           " , found " + str(noIsobusterReports))
-            config.errors += 1
-            config.failedPPNs.append(self.PPN)
+            self.context.addError(self.PPN)
 
         if noAudioFiles > 0 and noDbpowerampLogs != 1:
             logging.error("jobID " + self.jobID +
                           " : expected 1 file 'dbpoweramp.log' in directory '" +
                           self.imagePathFull + " , found " +
                           str(noDbpowerampLogs))
-            config.errors += 1
-            config.failedPPNs.append(self.PPN)
+            self.context.addError(self.PPN)
 
         # Read contents of checksum file to list
         try:
-            checksumsFromFile = checksums.readChecksums(checksumFiles[0])
+            checksumsFromFile = checksums.readChecksums(self.context, checksumFiles[0])
         except IndexError:
             checksumsFromFile = []
             logging.error("jobID " + self.jobID +
                           " : error reading checksum file")
-            config.errors += 1
-            config.failedPPNs.append(self.PPN)
+            self.context.addError(self.PPN)
 
         # Sort ascending by file name - this ensures correct order when making structMap
         checksumsFromFile.sort(key=itemgetter(1))
 
+        # Calculate SHA-512 hashes of all files that need hashing up front, so
+        # they can be hashed concurrently. In write mode, hashes of files that are
+        # copied to the SIP are calculated while copying (see below), so these are
+        # not hashed here
+        filesToHash = []
+        for entry in checksumsFromFile:
+            fileName = entry[1]
+            fileNameWithPath = os.path.normpath(
+                self.imagePathFull + "/" + fileName)
+            deferChecksum = self.context.createSIPs and not fileName.endswith(('.log', '.xml'))
+            if os.path.isfile(fileNameWithPath) and not deferChecksum and \
+                    self.context.skipChecksumFlag == False:
+                filesToHash.append(fileNameWithPath)
+        checksumsCalculated = dict(zip(filesToHash,
+                                       checksums.get_files_sha512(self.context, filesToHash)))
+
         # List to store names of all files that are referenced in the checksum file
         allFilesinChecksumFile = []
         for entry in checksumsFromFile:
@@ -164,24 +226,25 @@ class Carrier:
             fileNameWithPath = os.path.normpath(
                 self.imagePathFull + "/" + fileName)
 
-            # Calculate SHA-512 hash of actual file
-            if os.path.isfile(fileNameWithPath) and config.skipChecksumFlag == False:
-                checksumCalculated = checksums.generate_file_sha512(fileNameWithPath)
-            elif os.path.isfile(fileNameWithPath) and config.skipChecksumFlag == True:
+            # Look up SHA-512 hash of actual file
+            if fileNameWithPath in checksumsCalculated:
+                checksumCalculated = checksumsCalculated[fileNameWithPath]
+            elif os.path.isfile(fileNameWithPath) and self.context.skipChecksumFlag == False:
+                # Hash is verified while copying
+                checksumCalculated = checksum
+            elif os.path.isfile(fileNameWithPath) and self.context.skipChecksumFlag == True:
                 checksumCalculated = "bogus"
             else:
                 logging.fatal("jobID " + self.jobID + ": file '" +
                               fileNameWithPath + "' is referenced in '" + checksumFiles[0] +
                               "', but does not exist")
-                config.errors += 1
-                config.failedPPNs.append(self.PPN)
-                errorExit(config.errors, config.warnings)
+                self.context.addError(self.PPN)
+                errorExit(self.context.errors, self.context.warnings)
 
-            if checksumCalculated != checksum and config.skipChecksumFlag == False:
+            if checksumCalculated != checksum and self.context.skipChecksumFlag == False:
                 logging.error("jobID " + self.jobID + ": checksum mismatch for file '" +
                               fileNameWithPath + "'")
-                config.errors += 1
-                config.failedPPNs.append(self.PPN)
+                self.context.addError(self.PPN)
 
             # Get file size and append to allFilesinChecksumFile list
             # (needed later for METS file entry)
@@ -196,8 +259,114 @@ class Carrier:
                 logging.error("jobID " + self.jobID + ": file '" + f +
                               "' not referenced in '" +
                               checksumFiles[0] + "'")
-                config.errors += 1
-                config.failedPPNs.append(self.PPN)
+                self.context.addError(self.PPN)
+
+        # Keep logs and reports for metadata stage
+        self.cdinfoLogs = cdinfoLogs
+        self.isobusterLogs = isobusterLogs
+        self.isobusterReports = isobusterReports
+        self.dBpowerampLogs = dBpowerampLogs
+        self.kbmdoMetaFiles = kbmdoMetaFiles
+
+        # List with (checksum file entry, calculated hashes) of all copied files
+        self.filesCopied = []
+
+        # Verification may take a while, so check if the lease on this PPN is still
+        # held before anything is written (worker mode only)
+        self.context.checkLease()
+
+        if self.context.createSIPs:
+
+            # Create Volume directory
+            logging.info("creating carrier directory")
+            dirVolume = os.path.join(
+                SIPPath, self.volumeNumber)
+            self.dirVolume = dirVolume
+            try:
+                os.makedirs(dirVolume, exist_ok=self.context.resumeFlag)
+            except (OSError, IOError):
+                logging.fatal("jobID " + self.jobID +
+                              ": cannot create '" + dirVolume + "'")
+                self.context.addError()
+                errorExit(self.context.errors, self.context.warnings)
+
+            # Copy files to SIP Volume directory
+            logging.info("copying files to carrier directory")
+
+            # Get file names from checksum file, as this is the easiest way to make
+            # post-copy checksum verification work. Filter out log files first!
+
+            filesToCopy = [
+                i for i in checksumsFromFile if not i[1].endswith(('.log', '.xml'))]
+
+            # Copy to volume dir, and calculate hashes of copied data for all fixity
+            # algorithms. Files are copied concurrently; results are in the same order
+            # as filesToCopy
+            filesIn = [os.path.join(self.imagePathFull, i[1]) for i in filesToCopy]
+            filesSIP = [os.path.join(dirVolume, i[1]) for i in filesToCopy]
+            hashesCopied = checksums.map_hash_workers(self.context, copyFile,
+                                                      filesIn, filesSIP)
+
+            # Optionally re-read copied files, and calculate their hashes
+            checksumsReadBack = {}
+            if self.context.readBackFlag:
+                filesCopied = [f for f, h in zip(filesSIP, hashesCopied) if h is not None]
+                checksumsReadBack = dict(zip(filesCopied, checksums.map_hash_workers(
+                    self.context, checksums.generate_file_sha512, filesCopied)))
+
+            for entry, hashesCalculated in zip(filesToCopy, hashesCopied):
+
+                checksum = entry[0]
+                fileName = entry[1]
+                # Construct path relative to carrier directory
+                fIn = os.path.join(self.imagePathFull, fileName)
+
+                # Construct path relative to volume directory
+                fSIP = os.path.join(dirVolume, fileName)
+                if hashesCalculated is None:
+                    logging.fatal("jobID " + self.jobID +
+                                  ": cannot copy '" +
+                                  fileName + "' to '" + fSIP + "'")
+                    self.context.addError()
+                    errorExit(self.context.errors, self.context.warnings)
+
+                # Verify hash of copied data against known value
+                if hashesCalculated["sha512"] != checksum:
+                    logging.error("jobID " + self.jobID + ": checksum mismatch for file '" +
+                                  fIn + "'")
+                    self.context.addError(self.PPN)
+
+                # Verify hash of re-read copied file against known value
+                if self.context.readBackFlag:
+                    if checksumsReadBack[fSIP] != checksum:
+                        logging.error("jobID " + self.jobID + ": checksum mismatch for file '" +
+                                      fSIP + "'")
+                        self.context.addError(self.PPN)
+
+                self.filesCopied.append((entry, hashesCalculated))
+
+    def processMetadata(self, sipFileCounterStart, counterTechMDStart):
+        """Parse logs and reports, and create METS file, structMap and PREMIS elements
+        for all copied files (CPU stage of process). Returns updated file and techMD
+        counters
+        """
+        fileCounter = 1
+        sipFileCounter = sipFileCounterStart
+        counterTechMD = counterTechMDStart
+
+        # Mapping between mimeType and structmap TYPE field
+
+        mimeTypeMap = {
+            "application/x-iso9660-image": "disk image",
+            "audio/flac": "audio track",
+            "audio/wav": "audio track"
+        }
+
+        cdinfoLogs = self.cdinfoLogs
+        isobusterLogs = self.isobusterLogs
+        isobusterReports = self.isobusterReports
+        dBpowerampLogs = self.dBpowerampLogs
+        kbmdoMetaFiles = self.kbmdoMetaFiles
 
         # Carrier-level (representation) tech metadata from cd-info.log
         if cdinfoLogs != []:
@@ -213,7 +382,7 @@ class Carrier:
             except:
                 logging.error("jobID " + self.jobID +
                               ": error parsing '" + isobusterReports[0] + "'")
-                config.errors += 1
+                self.context.addError()
                 isobusterReportElt = etree.Element("dfxml")
         else:
             isobusterReportElt = etree.Element("dfxml")
@@ -229,15 +398,18 @@ class Carrier:
         if kbmdoMetaFiles != []:
             try:
                 kbmdoMetaFileElt = etree.parse(kbmdoMetaFiles[0]).getroot()
+                # Catalogue records, used for creating MODS without catalogue lookup
+                if self.context.localRecordsFlag:
+                    self.localRecords = getLocalRecords(kbmdoMetaFileElt, self.PPN)
             except:
                 logging.error("jobID " + self.jobID +
                               ": error parsing '" + kbmdoMetaFiles[0] + "'")
-                config.errors += 1
+                self.context.addError()
                 kbmdoMetaFileElt = etree.Element("searchRetrieveResponse")
         else:
             kbmdoMetaFileElt = etree.Element("searchRetrieveResponse")
 
-        if config.createSIPs:
+        if self.context.createSIPs:
 
             # Generate event metadata from Isobuster/dBpoweramp logs
             # For each carrier we can have an Isobuster even, a dBpoweramp event, or both
@@ -249,71 +421,25 @@ class Carrier:
                 premisEvent = addCreationEvent(dBpowerampLogs[0])
                 self.premisCreationEvents.append(premisEvent)
 
-            # Create Volume directory
-            logging.info("creating carrier directory")
-            dirVolume = os.path.join(
-                SIPPath, self.volumeNumber)
-            try:
-                os.makedirs(dirVolume)
-            except (OSError, IOError):
-                logging.fatal("jobID " + self.jobID +
-                              ": cannot create '" + dirVolume + "'")
-                config.errors += 1
-                errorExit(config.errors, config.warnings)
-
-            # Copy files to SIP Volume directory
-            logging.info("copying files to carrier directory")
-
-            # Get file names from checksum file, as this is the easiest way to make
-            # post-copy checksum verification work. Filter out log files first!
-
-            filesToCopy = [
-                i for i in checksumsFromFile if not i[1].endswith(('.log', '.xml'))]
-
-            for entry in filesToCopy:
+            for entry, hashesCalculated in self.filesCopied:
 
                 checksum = entry[0]
                 fileName = entry[1]
                 fileSize = entry[2]
                 # Generate unique file ID (used in structMap)
                 fileID = "file_" + str(sipFileCounter)
-                # Construct path relative to carrier directory
-                fIn = os.path.join(self.imagePathFull, fileName)
 
                 # Construct path relative to volume directory
-                fSIP = os.path.join(dirVolume, fileName)
-                try:
-                    # Copy to volume dir
-                    shutil.copy2(fIn, fSIP)
-                except OSError:
-                    logging.fatal("jobID " + self.jobID +
-                                  ": cannot copy '" +
-                                  fileName + "' to '" + fSIP + "'")
-                    config.errors += 1
-                    errorExit(config.errors, config.warnings)
-
-                # Calculate hash of copied file, and verify against known value
-                checksumCalculated = checksums.generate_file_sha512(fSIP)
-                if checksumCalculated != checksum:
-                    logging.error("jobID " + self.jobID + ": checksum mismatch for file '" +
-                                  fSIP + "'")
-                    config.errors += 1
-                    config.failedPPNs.append(self.PPN)
-
-                # Create METS file and FLocat elements
+                fSIP = os.path.join(self.dirVolume, fileName)
 
-                fileEltName = etree.QName(config.mets_ns, "file")
-                fileElt = etree.Element(
-                    fileEltName, nsmap=config.NSMAP)
+                # Create METS file and FLocat elements from template
+                fileElt, (fLocat,) = fileTemplate.new()
 
                 fileElt.attrib["ID"] = fileID
                 fileElt.attrib["SIZE"] = fileSize
 
-                fLocat = etree.SubElement(
-                    fileElt, "{%s}FLocat" % (config.mets_ns))
-                fLocat.attrib["LOCTYPE"] = "URL"
                 # File locations relative to SIP root (= location of METS file)
-                fLocat.attrib[etree.QName(config.xlink_ns, "href")] = "file:///" + \
+                fLocat.attrib[xlinkHref] = "file:///" + \
                     self.volumeNumber + "/" + fileName
 
                 # Add MIME type and checksum to file element
@@ -330,39 +456,33 @@ class Carrier:
                     mimeType = "application/octet-stream"
                 fileElt.attrib["MIMETYPE"] = mimeType
                 fileElt.attrib["CHECKSUM"] = checksum
-                fileElt.attrib["CHECKSUMTYPE"] = "SHA-512"
 
                 # TODO: check if mimeType values matches carrierType
                 # (e.g. no audio/x-wav if cd-rom, etc.)
 
-                # Create track divisor element for structmap
-                divFileName = etree.QName(config.mets_ns, "div")
-                divFile = etree.Element(divFileName, nsmap=config.NSMAP)
+                # Create track divisor element for structmap from template
+                divFile, (fptr,) = divFileTemplate.new()
                 divFile.attrib["TYPE"] = mimeTypeMap[mimeType]
                 divFile.attrib["ORDER"] = str(fileCounter)
-                fptr = etree.SubElement(divFile, "{%s}fptr" % (config.mets_ns))
                 fptr.attrib["FILEID"] = fileID
 
                 # Add divisor element to divFileElements
                 self.divFileElements.append(divFile)
 
-                # Create techMD element for PREMIS object information
-                techMDPremisName = etree.QName(config.mets_ns, "techMD")
-                techMDPremis = etree.Element(techMDPremisName, nsmap=config.NSMAP)
+                # Create techMD element (with wrapper element) for PREMIS object
+                # information from template
+                techMDPremis, (xmlDataObjectPremis,) = techMDPremisTemplate.new()
                 techMDPremisID = "techMD_" + str(counterTechMD)
                 techMDPremis.attrib["ID"] = techMDPremisID
 
-                # Add wrapper element for PREMIS object metadata
-                mdWrapObjectPremis = etree.SubElement(
-                    techMDPremis, "{%s}mdWrap" % (config.mets_ns))
-                mdWrapObjectPremis.attrib["MIMETYPE"] = "text/xml"
-                mdWrapObjectPremis.attrib["MDTYPE"] = "PREMIS:OBJECT"
-                mdWrapObjectPremis.attrib["MDTYPEVERSION"] = "3.0"
-                xmlDataObjectPremis = etree.SubElement(
-                    mdWrapObjectPremis, "{%s}xmlData" % (config.mets_ns))
+                # Hashes for any additional fixity algorithms
+                extraChecksums = [(algorithm, hashesCalculated[algorithm])
+                                  for algorithm in self.context.fixityAlgorithms
+                                  if algorithm != "sha512"]
 
                 premisObjectInfo = addObjectInstance(
-                    fSIP, fileSize, mimeType, checksum, dataSectorOffset, isobusterReportElt)
+                    fSIP, fileSize, mimeType, checksum, dataSectorOffset, isobusterReportElt,
+                    extraChecksums)
                 xmlDataObjectPremis.append(premisObjectInfo)
                 self.techMDFileElements.append(techMDPremis)
 
@@ -380,3 +500,21 @@ class Carrier:
                 counterTechMD += 1
 
         return sipFileCounter, counterTechMD
+
+    def releaseElements(self):
+        """Release METS and PREMIS elements of carrier (once these are written)"""
+        self.divFileElements = []
+        self.fileElements = []
+        self.techMDFileElements = []
+        self.premisCreationEvents = []
+        self.cdInfoElt = None
+
+
+def copyFile(context, fileIn, fileOut):
+    """Copy fileIn to fileOut and return dictionary with hashes of the copied data
+    for all fixity algorithms, or None if the file could not be copied
+    """
+    try:
+        return checksums.copy_file(context, fileIn, fileOut, context.fixityAlgorithms)
+    except OSError:
+        return None
@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+"""
+Persistent cache of file checksums
+"""
+
+import os
+import sqlite3
+import threading
+
+
+class ChecksumCache:
+    """Cache of file checksums, stored in an SQLite database
+    Entries are keyed by file path, device, inode, size and modification time,
+    so a cached checksum is only used if the file is unchanged since it was hashed.
+    The database also holds the chunk manifest: digests of consecutive fixed-size
+    chunks of each file, which are used to validate and resume partial copies
+    """
+    def __init__(self, dbFile):
+        """Initialise ChecksumCache class instance"""
+        self.dbFile = dbFile
+        # Connection may be shared between threads, so access is serialised with a lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.dbFile, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS checksums ("
+                              "path TEXT NOT NULL, "
+                              "algorithm TEXT NOT NULL, "
+                              "device INTEGER NOT NULL, "
+                              "inode INTEGER NOT NULL, "
+                              "size INTEGER NOT NULL, "
+                              "mtime_ns INTEGER NOT NULL, "
+                              "checksum TEXT NOT NULL, "
+                              "PRIMARY KEY (path, algorithm))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS chunks ("
+                              "path TEXT NOT NULL, "
+                              "chunk_size INTEGER NOT NULL, "
+                              "chunk_index INTEGER NOT NULL, "
+                              "device INTEGER NOT NULL, "
+                              "inode INTEGER NOT NULL, "
+                              "size INTEGER NOT NULL, "
+                              "mtime_ns INTEGER NOT NULL, "
+                              "digest TEXT NOT NULL, "
+                              "PRIMARY KEY (path, chunk_size, chunk_index))")
+
+    def get(self, fileIn, fileStat, algorithm="sha512"):
+        """Return cached checksum of fileIn, or None if fileIn is not in the cache
+        or if it changed since it was hashed. fileStat is the os.stat result of fileIn
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT device, inode, size, mtime_ns, checksum "
+                                    "FROM checksums WHERE path = ? AND algorithm = ?",
+                                    (os.path.abspath(fileIn), algorithm)).fetchone()
+        if row is None:
+            return None
+        if tuple(row[:4]) != (fileStat.st_dev, fileStat.st_ino,
+                              fileStat.st_size, fileStat.st_mtime_ns):
+            return None
+        return row[4]
+
+    def put(self, fileIn, fileStat, checksum, algorithm="sha512"):
+        """Store checksum of fileIn. fileStat is the os.stat result of fileIn
+        before it was hashed; nothing is stored if fileIn changed in the meantime
+        """
+        if not sameFile(fileStat, os.stat(fileIn)):
+            return
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (os.path.abspath(fileIn), algorithm, fileStat.st_dev,
+                               fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns,
+                               checksum))
+
+    def get_chunks(self, fileIn, fileStat, chunkSize):
+        """Return list with cached digests of all chunks of fileIn (in file order),
+        or None if there are no chunk digests for fileIn, or if it changed since
+        they were calculated. fileStat is the os.stat result of fileIn
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT chunk_index, device, inode, size, mtime_ns, digest "
+                                     "FROM chunks WHERE path = ? AND chunk_size = ? "
+                                     "ORDER BY chunk_index",
+                                     (os.path.abspath(fileIn), chunkSize)).fetchall()
+        noChunks = -(-fileStat.st_size // chunkSize)
+        if len(rows) != noChunks or noChunks == 0:
+            return None
+        digests = []
+        for row in rows:
+            if row[0] != len(digests) or tuple(row[1:5]) != (fileStat.st_dev, fileStat.st_ino,
+                                                             fileStat.st_size,
+                                                             fileStat.st_mtime_ns):
+                return None
+            digests.append(row[5])
+        return digests
+
+    def put_chunks(self, fileIn, fileStat, chunkSize, digests):
+        """Store digests of all chunks of fileIn, replacing any existing ones. fileStat
+        is the os.stat result of fileIn before it was hashed; nothing is stored if
+        fileIn changed in the meantime
+        """
+        if not sameFile(fileStat, os.stat(fileIn)):
+            return
+        path = os.path.abspath(fileIn)
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM chunks WHERE path = ? AND chunk_size = ?",
+                              (path, chunkSize))
+            self.conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                  [(path, chunkSize, i, fileStat.st_dev, fileStat.st_ino,
+                                    fileStat.st_size, fileStat.st_mtime_ns, digest)
+                                   for i, digest in enumerate(digests)])
+
+    def close(self):
+        """Close the database connection"""
+        with self.lock:
+            self.conn.close()
+
+
+def sameFile(stat1, stat2):
+    """Return True if stat1 and stat2 describe the same, unchanged file"""
+    return ((stat1.st_dev, stat1.st_ino, stat1.st_size, stat1.st_mtime_ns) ==
+            (stat2.st_dev, stat2.st_ino, stat2.st_size, stat2.st_mtime_ns))
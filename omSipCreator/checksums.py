@@ -4,13 +4,29 @@ Checksum reading and generation
 """
 
 import os
+import mmap
+import errno
+import shutil
 import logging
 import hashlib
-from . import config
+import time
+import functools
+import random
+from concurrent.futures import ThreadPoolExecutor
+from . import fileio
 from .shared import errorExit
 
+# fcntl module is only available on Unix-like platforms
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-def readChecksums(fileIn):
+# FICLONE ioctl request code (Linux), used for reflink copies
+FICLONE = 0x40049409
+
+
+def readChecksums(context, fileIn):
     """Read checksum file, return contents as nested list
     Also strip away any file paths if they exist (return names only)
     """
@@ -29,22 +45,499 @@ def readChecksums(fileIn):
         return data
     except IOError:
         logging.fatal("cannot read '" + fileIn + "'")
-        config.errors += 1
-        errorExit(config.errors, config.warnings)
+        context.addError()
+        errorExit(context.errors, context.warnings)
+
+
+# Names of supported hash algorithms (hashlib name: name used in PREMIS and METS)
+algorithmNames = {"md5": "MD5",
+                  "sha1": "SHA-1",
+                  "sha256": "SHA-256",
+                  "sha384": "SHA-384",
+                  "sha512": "SHA-512"}
+
+
+# Hash algorithm for chunk digests in the chunk manifest
+chunkAlgorithm = "sha512"
+
+# Number of randomly selected chunks (in addition to the first and last one)
+# that are checked by a quick verification
+quickSamples = 3
+
+
+class ChunkDigests:
+    """Calculates digests of consecutive chunks of chunkSize bytes of a data stream.
+    Has the same update method as hashlib hash objects, so it can be fed with
+    the same blocks
+    """
+    def __init__(self, chunkSize):
+        """Initialise ChunkDigests class instance"""
+        self.chunkSize = chunkSize
+        self.digests = []
+        self.m = hashlib.new(chunkAlgorithm)
+        self.noBytes = 0
+
+    def update(self, data):
+        """Add data, which may span chunk boundaries"""
+        data = memoryview(data)
+        while data:
+            noBytes = min(len(data), self.chunkSize - self.noBytes)
+            self.m.update(data[:noBytes])
+            self.noBytes += noBytes
+            data = data[noBytes:]
+            if self.noBytes == self.chunkSize:
+                self.digests.append(self.m.hexdigest())
+                self.m = hashlib.new(chunkAlgorithm)
+                self.noBytes = 0
+
+    def finish(self):
+        """Add digest of last (partial) chunk, and return list with all digests"""
+        if self.noBytes:
+            self.digests.append(self.m.hexdigest())
+            self.m = hashlib.new(chunkAlgorithm)
+            self.noBytes = 0
+        return self.digests
+
+
+def new_chunk_digests(context):
+    """Return new ChunkDigests instance if chunk digests are recorded, and None otherwise"""
+    if context.chunkManifest and context.checksumCache is not None:
+        return ChunkDigests(fileio.chunkSize)
+    return None
 
 
-def generate_file_sha512(fileIn):
-    """Generate sha512 hash of file
-    fileIn is read in chunks to ensure it will work with (very) large files as well
+def new_hashes(algorithms):
+    """Return list of new hash objects for all algorithms"""
+    return [hashlib.new(algorithm) for algorithm in algorithms]
+
+
+def hexdigests(algorithms, hashes):
+    """Return dictionary with hexadecimal digest of each hash object, by algorithm"""
+    return {algorithm: m.hexdigest() for algorithm, m in zip(algorithms, hashes)}
+
+
+def hash_read(context, fileIn, algorithms):
+    """Return dictionary with hexadecimal hashes of file for all algorithms,
+    reading file in blocks with read()
     Adapted from: http://stackoverflow.com/a/1131255/1209004
     """
 
-    blocksize = 2**20
-    m = hashlib.sha512()
+    hashes = new_hashes(algorithms)
     with open(fileIn, "rb") as f:
         while True:
-            buf = f.read(blocksize)
+            buf = f.read(fileio.blocksize)
             if not buf:
                 break
-            m.update(buf)
-    return m.hexdigest()
+            for m in hashes:
+                m.update(buf)
+    return hexdigests(algorithms, hashes)
+
+
+def hash_readinto(context, fileIn, algorithms):
+    """Return dictionary with hexadecimal hashes of file for all algorithms,
+    reading file with readinto() into one preallocated buffer, so no new bytes
+    object is allocated for each block
+    """
+
+    hashes = new_hashes(algorithms)
+    for block in fileio.read_blocks(context, fileIn):
+        for m in hashes:
+            m.update(block)
+    return hexdigests(algorithms, hashes)
+
+
+def hash_mmap(context, fileIn, algorithms):
+    """Return dictionary with hexadecimal hashes of file for all algorithms,
+    which is memory-mapped (regular files only)
+    """
+
+    hashes = new_hashes(algorithms)
+    with open(fileIn, "rb") as f:
+        fileSize = os.fstat(f.fileno()).st_size
+        # Empty files cannot be mapped
+        if fileSize == 0:
+            return hexdigests(algorithms, hashes)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                for offset in range(0, fileSize, fileio.blocksize):
+                    for m in hashes:
+                        m.update(view[offset:offset + fileio.blocksize])
+    return hexdigests(algorithms, hashes)
+
+
+def hash_pipeline(context, fileIn, algorithms):
+    """Return dictionary with hexadecimal hashes of file for all algorithms,
+    reading file in a background thread, so reading and hashing overlap
+    """
+
+    hashes = new_hashes(algorithms)
+    for block in fileio.read_blocks_pipelined(context, fileIn):
+        for m in hashes:
+            m.update(block)
+    return hexdigests(algorithms, hashes)
+
+
+def hash_file_digest(context, fileIn, algorithms):
+    """Return dictionary with hexadecimal hashes of file for all algorithms,
+    using hashlib.file_digest (Python 3.11+). Since file_digest only supports
+    one algorithm, multiple algorithms are handled by hash_readinto
+    """
+
+    if len(algorithms) != 1:
+        return hash_readinto(context, fileIn, algorithms)
+    with open(fileIn, "rb", buffering=0) as f:
+        return {algorithms[0]: hashlib.file_digest(f, algorithms[0]).hexdigest()}
+
+
+# Available hashing backends
+hashBackends = {"read": hash_read,
+                "readinto": hash_readinto,
+                "pipeline": hash_pipeline,
+                "mmap": hash_mmap}
+
+# Backends that read files with fileio (which supports I/O modes and records
+# throughput statistics)
+fileioBackends = [hash_readinto, hash_pipeline]
+if hasattr(hashlib, "file_digest"):
+    hashBackends["file_digest"] = hash_file_digest
+
+
+def select_hash_backend(name="auto"):
+    """Return name of hashing backend that is used for name. For 'auto', the
+    fastest available backend is selected: hashlib.file_digest (which hashes
+    from a reused buffer in C) if it exists, otherwise readinto
+    """
+
+    if name == "auto":
+        if "file_digest" in hashBackends:
+            name = "file_digest"
+        else:
+            name = "readinto"
+    return name
+
+
+def generate_file_hashes(context, fileIn, algorithms, chunks=None):
+    """Generate hashes of file for all algorithms from one read of the file,
+    using the selected hashing backend. Returns dictionary with hexadecimal hash
+    by algorithm. fileIn is read in chunks to ensure it will work with (very)
+    large files as well. Except in buffered I/O mode, the readinto backend is
+    used instead of any backend that doesn't support the page cache hints and
+    direct I/O. If chunks (ChunkDigests instance) is given, chunk digests are
+    calculated from the same read
+    """
+
+    hashBackend = hashBackends[context.hashBackendName]
+    if chunks is not None:
+        hashes = new_hashes(algorithms)
+        if hashBackend is hash_pipeline:
+            blocks = fileio.read_blocks_pipelined(context, fileIn)
+        else:
+            blocks = fileio.read_blocks(context, fileIn)
+        for block in blocks:
+            for m in hashes:
+                m.update(block)
+            chunks.update(block)
+        return hexdigests(algorithms, hashes)
+    if hashBackend in fileioBackends:
+        # Throughput statistics are recorded by fileio
+        return hashBackend(context, fileIn, algorithms)
+    if context.ioMode != "buffered":
+        return hash_readinto(context, fileIn, algorithms)
+
+    timeStart = time.perf_counter()
+    hashes = hashBackend(context, fileIn, algorithms)
+    fileio.add_stats(context, os.path.getsize(fileIn), time.perf_counter() - timeStart)
+    return hashes
+
+
+def generate_file_sha512(context, fileIn):
+    """Generate sha512 hash of file"""
+
+    return generate_file_hashes(context, fileIn, ["sha512"])["sha512"]
+
+
+def get_file_hashes(context, fileIn, algorithms):
+    """Return dictionary with hexadecimal hashes of file for all algorithms
+    If a checksum cache is in use and fileIn didn't change since it was last hashed,
+    cached values are returned; any other hashes are calculated (from one read of
+    the file) and cached. If the chunk manifest is enabled, missing chunk digests
+    are calculated and cached as well
+    """
+
+    cache = context.checksumCache
+    if cache is None:
+        return generate_file_hashes(context, fileIn, algorithms)
+
+    fileStat = os.stat(fileIn)
+    hashes = {}
+    chunks = new_chunk_digests(context)
+    if not context.rehashFlag:
+        for algorithm in algorithms:
+            checksum = cache.get(fileIn, fileStat, algorithm)
+            if checksum is not None:
+                hashes[algorithm] = checksum
+        if chunks is not None and \
+                cache.get_chunks(fileIn, fileStat, fileio.chunkSize) is not None:
+            chunks = None
+
+    missingAlgorithms = [i for i in algorithms if i not in hashes]
+    if missingAlgorithms or chunks is not None:
+        hashesCalculated = generate_file_hashes(context, fileIn, missingAlgorithms, chunks)
+        for algorithm, checksum in hashesCalculated.items():
+            cache.put(fileIn, fileStat, checksum, algorithm)
+        if chunks is not None:
+            cache.put_chunks(fileIn, fileStat, fileio.chunkSize, chunks.finish())
+        hashes.update(hashesCalculated)
+    return hashes
+
+
+def get_file_sha512(context, fileIn):
+    """Return sha512 hash of file, using the checksum cache if possible"""
+
+    return get_file_hashes(context, fileIn, ["sha512"])["sha512"]
+
+
+def hash_chunk(context, fileIn, index):
+    """Return digest of chunk number index of fileIn"""
+
+    chunk = ChunkDigests(fileio.chunkSize)
+    for block in fileio.read_blocks(context, fileIn, index * fileio.chunkSize):
+        chunk.update(block)
+        if chunk.digests:
+            break
+    digests = chunk.finish()
+    if not digests:
+        # Chunk is beyond end of file
+        return ""
+    return digests[0]
+
+
+def quick_file_sha512(context, fileIn):
+    """Return sha512 hash of file, using a quick check instead of a full read of
+    the file if possible. The quick check re-reads the first and last chunk of
+    fileIn plus quickSamples randomly selected other chunks, and compares their
+    digests with the chunk manifest of an earlier full run. If they all match,
+    the cached sha512 hash is returned. If there is no chunk manifest for fileIn,
+    or if any chunk doesn't match, the hash is calculated from the full file
+    """
+
+    cache = context.checksumCache
+    if cache is None or context.rehashFlag:
+        return get_file_sha512(context, fileIn)
+
+    fileStat = os.stat(fileIn)
+    checksum = cache.get(fileIn, fileStat, "sha512")
+    digests = cache.get_chunks(fileIn, fileStat, fileio.chunkSize)
+    if checksum is None or digests is None:
+        # Full hash (which also records the chunk manifest)
+        return get_file_sha512(context, fileIn)
+
+    noChunks = len(digests)
+    indices = sorted(set([0, noChunks - 1] +
+                         random.sample(range(1, max(noChunks - 1, 1)),
+                                       min(quickSamples, max(noChunks - 2, 0)))))
+    for index in indices:
+        if hash_chunk(context, fileIn, index) != digests[index]:
+            break
+    else:
+        return checksum
+
+    # File content changed since it was hashed, so calculate full hash and
+    # replace the cached values
+    logging.warning("quick check failed for '" + fileIn + "', calculating full checksum")
+    chunks = ChunkDigests(fileio.chunkSize)
+    checksum = generate_file_hashes(context, fileIn, ["sha512"], chunks)["sha512"]
+    cache.put(fileIn, fileStat, checksum, "sha512")
+    cache.put_chunks(fileIn, fileStat, fileio.chunkSize, chunks.finish())
+    return checksum
+
+
+def copy_file_hashes(context, fileIn, fileOut, algorithms):
+    """Copy fileIn to fileOut, and return dictionary with hexadecimal hashes of the
+    copied data for all algorithms. The hashes are calculated on the data while they
+    are streamed to fileOut, so fileIn is read only once. File metadata are copied
+    as with shutil.copy2. If the chunk manifest is enabled, chunk digests are
+    calculated from the same read
+    """
+
+    fileStat = os.stat(fileIn)
+    hashes = new_hashes(algorithms)
+    chunks = new_chunk_digests(context)
+    updaters = hashes + [chunks] if chunks is not None else hashes
+    with open(fileOut, "wb", buffering=0) as fOut:
+        if hashBackends[context.hashBackendName] is hash_pipeline:
+            # Reading, hashing and writing overlap
+            for block in fileio.read_blocks_pipelined(context, fileIn, fOut):
+                for m in updaters:
+                    m.update(block)
+        else:
+            for block in fileio.read_blocks(context, fileIn):
+                for m in updaters:
+                    m.update(block)
+                fileio.write_all(fOut, block)
+    shutil.copystat(fileIn, fileOut)
+    hashesOut = hexdigests(algorithms, hashes)
+    if context.checksumCache is not None:
+        for algorithm, checksum in hashesOut.items():
+            context.checksumCache.put(fileIn, fileStat, checksum, algorithm)
+        if chunks is not None:
+            context.checksumCache.put_chunks(fileIn, fileStat, fileio.chunkSize,
+                                            chunks.finish())
+    return hashesOut
+
+
+def resume_copy(context, fileIn, fileOut, algorithms):
+    """Complete (partial) copy fileOut of fileIn, using the chunk manifest. The chunks
+    of fileOut are validated against the cached chunk digests of fileIn, and only the
+    data from the first missing or bad chunk onwards are copied. Returns dictionary
+    with hexadecimal hashes of fileIn for all algorithms (taken from the checksum
+    cache, so fileIn is not re-read), or None if the copy cannot be resumed (no
+    cached hashes or chunk digests for fileIn, or the copied data don't match)
+    """
+
+    cache = context.checksumCache
+    if cache is None or context.rehashFlag:
+        return None
+    fileStat = os.stat(fileIn)
+    hashes = {}
+    for algorithm in algorithms:
+        hashes[algorithm] = cache.get(fileIn, fileStat, algorithm)
+        if hashes[algorithm] is None:
+            return None
+    digestsIn = cache.get_chunks(fileIn, fileStat, fileio.chunkSize)
+    if digestsIn is None:
+        return None
+
+    # Validate chunks that were already copied; stop at first bad chunk
+    chunksOut = ChunkDigests(fileio.chunkSize)
+    for block in fileio.read_blocks(context, fileOut):
+        chunksOut.update(block)
+        noChunks = len(chunksOut.digests)
+        if noChunks > len(digestsIn) or chunksOut.digests[:noChunks] != digestsIn[:noChunks]:
+            break
+    digestsOut = chunksOut.finish()
+    noChunksValid = 0
+    while noChunksValid < min(len(digestsIn), len(digestsOut)) and \
+            digestsOut[noChunksValid] == digestsIn[noChunksValid]:
+        noChunksValid += 1
+    offset = min(noChunksValid * fileio.chunkSize, fileStat.st_size)
+
+    # Copy remaining data, and validate its chunks as well
+    if noChunksValid < len(digestsIn):
+        logging.info("resuming copy of '" + fileIn + "' at chunk " + str(noChunksValid) +
+                     " of " + str(len(digestsIn)))
+    chunksCopied = ChunkDigests(fileio.chunkSize)
+    with open(fileOut, "r+b", buffering=0) as fOut:
+        fOut.truncate(offset)
+        fOut.seek(offset)
+        if noChunksValid < len(digestsIn):
+            for block in fileio.read_blocks(context, fileIn, offset):
+                chunksCopied.update(block)
+                fileio.write_all(fOut, block)
+    if chunksCopied.finish() != digestsIn[noChunksValid:]:
+        return None
+    shutil.copystat(fileIn, fileOut)
+    return hashes
+
+
+def copy_file_sha512(context, fileIn, fileOut):
+    """Copy fileIn to fileOut, and return sha512 hash of the copied data"""
+
+    return copy_file_hashes(context, fileIn, fileOut, ["sha512"])["sha512"]
+
+
+def reflink_file(fileIn, fileOut):
+    """Clone fileIn to fileOut with the FICLONE ioctl, so both files share the same
+    data blocks (Linux only; needs a file system with reflink support such as
+    Btrfs or XFS). Raises OSError if cloning is not supported
+    """
+
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflink not supported on this platform")
+    with open(fileIn, "rb") as fIn, open(fileOut, "wb") as fOut:
+        fcntl.ioctl(fOut.fileno(), FICLONE, fIn.fileno())
+
+
+def copy_range_file(fileIn, fileOut):
+    """Copy fileIn to fileOut with os.copy_file_range, so data are copied inside
+    the kernel (Linux, Python 3.8+). Raises OSError if this is not supported
+    """
+
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range not supported on this platform")
+    with open(fileIn, "rb") as fIn, open(fileOut, "wb") as fOut:
+        noBytesLeft = os.fstat(fIn.fileno()).st_size
+        while noBytesLeft > 0:
+            noBytesCopied = os.copy_file_range(fIn.fileno(), fOut.fileno(), noBytesLeft)
+            if noBytesCopied == 0:
+                break
+            noBytesLeft -= noBytesCopied
+    if noBytesLeft > 0:
+        # Source ended early (or the kernel stopped copying), so the copy is
+        # incomplete; the next copy method is used instead
+        raise OSError(errno.EIO, "copy_file_range stopped before end of '" + fileIn + "'")
+
+
+# Copy methods that are tried (in this order) for each copy strategy. The
+# 'stream' method (copy_file_hashes) is always used as the last fallback
+copyStrategies = {"stream": [],
+                  "copy_file_range": [copy_range_file],
+                  "reflink": [reflink_file, copy_range_file]}
+
+
+def copy_file(context, fileIn, fileOut, algorithms):
+    """Copy fileIn to fileOut using the method(s) defined by context.copyStrategy,
+    and return dictionary with hexadecimal hashes for all algorithms
+    For reflink and copy_file_range copies the data are not read by this process,
+    so the hashes are taken from the source file (using the checksum cache if
+    possible); the copy is only checked by its size. Unless the copied files are
+    re-read afterwards (--readback), these hashes therefore describe the source and
+    not the copy. Otherwise the hashes are calculated on the data while copying.
+    In resume mode, an existing fileOut is completed with resume_copy if possible
+    """
+
+    if context.resumeFlag and os.path.isfile(fileOut):
+        try:
+            hashes = resume_copy(context, fileIn, fileOut, algorithms)
+        except OSError:
+            # Copy from scratch
+            hashes = None
+        if hashes is not None:
+            return hashes
+
+    for copyMethod in copyStrategies[context.copyStrategy]:
+        try:
+            copyMethod(fileIn, fileOut)
+        except OSError:
+            # Not supported for these files, try next method
+            continue
+        if os.path.getsize(fileOut) != os.path.getsize(fileIn):
+            # Incomplete copy, try next method (which overwrites fileOut)
+            continue
+        shutil.copystat(fileIn, fileOut)
+        return get_file_hashes(context, fileIn, algorithms)
+
+    return copy_file_hashes(context, fileIn, fileOut, algorithms)
+
+
+def map_hash_workers(context, function, *iterables):
+    """Apply function to context and every item of iterables, and return list of results
+    in input order. Items are processed concurrently by a pool of context.hashWorkers
+    threads (hashlib releases the GIL while hashing, so this scales with the number of
+    threads)
+    """
+
+    function = functools.partial(function, context)
+    if context.hashWorkers <= 1:
+        return list(map(function, *iterables))
+    with ThreadPoolExecutor(max_workers=context.hashWorkers) as executor:
+        return list(executor.map(function, *iterables))
+
+
+def get_files_sha512(context, filesIn):
+    """Return list with sha512 hashes of all files in filesIn (in input order)
+    In quick mode the hashes are obtained with quick_file_sha512
+    """
+    if context.quickFlag:
+        return map_hash_workers(context, quick_file_sha512, filesIn)
+    return map_hash_workers(context, get_file_sha512, filesIn)
@@ -1,7 +1,8 @@
 #! /usr/bin/env python
 
 """
-Variables that are shared between modules
+Variables and constants that are shared between modules. Settings and state of
+a run are kept in a RunContext instance (see context.py) instead
 """
 import sys
 import codecs
@@ -10,34 +11,45 @@ version = ""
 scriptPath = ""
 scriptName = ""
 mediaInfoExe = ""
-mets_ns = ""
-mods_ns = ""
-premis_ns = ""
-ebucore_ns = ""
-xlink_ns = ""
-xsi_ns = ""
-isolyzer_ns = ""
-cdInfo_ns = ""
-dfxml_ns = ""
-dc_ns = ""
-hfs_ns = ""
-metsSchema = ""
-modsSchema = ""
-premisSchema = ""
-ebucoreSchema = ""
-NSMAP = {}
-failedPPNs = []
-errors = 0
-warnings = 0
-createSIPs = False
-pruneBatch = False
-skipChecksumFlag = False
-batchErr = ""
-dirOut = ""
-dirsInMetaCarriers = []
-carrierTypeAllowedValues = []
-iromlabMajorVersion = 0
-iromlabMinorVersion = 11
+
+# Name spaces for METS output
+mets_ns = 'http://www.loc.gov/METS/'
+mods_ns = 'http://www.loc.gov/mods/v3'
+premis_ns = 'http://www.loc.gov/premis/v3'
+ebucore_ns = 'urn:ebu:metadata-schema:ebucore'
+isolyzer_ns = 'https://github.com/KBNLresearch/isolyzer'
+cdInfo_ns = 'https://www.gnu.org/software/libcdio/libcdio.html#cd_002dinfo'  # TODO: is this a proper namespace?
+dfxml_ns = 'http://www.forensicswiki.org/wiki/Category:Digital_Forensics_XML'
+dc_ns = 'http://purl.org/dc/elements/1.1/'
+hfs_ns ='http://www.forensicswiki.org/wiki/HFS'
+xlink_ns = 'http://www.w3.org/1999/xlink'
+xsi_ns = 'http://www.w3.org/2001/XMLSchema-instance'
+metsSchema = 'http://www.loc.gov/METS/ http://www.loc.gov/standards/mets/mets.xsd'
+modsSchema = 'http://www.loc.gov/mods/v3 https://www.loc.gov/standards/mods/v3/mods-3-4.xsd'
+premisSchema = 'http://www.loc.gov/premis/v3 https://www.loc.gov/standards/premis/premis.xsd'
+ebucoreSchema = 'https://raw.githubusercontent.com/ebu/ebucore/master/ebucore.xsd'
+
+NSMAP = {"mets": mets_ns,
+         "mods": mods_ns,
+         "premis": premis_ns,
+         "ebucore": ebucore_ns,
+         "isolyzer": isolyzer_ns,
+         "cd-info": cdInfo_ns,
+         "dfxml": dfxml_ns,
+         "dc": dc_ns,
+         "hfs": hfs_ns,
+         "xlink": xlink_ns,
+         "xsi": xsi_ns}
+
+# Controlled vocabulary for 'carrierType' field
+carrierTypeAllowedValues = ['cd-rom',
+                            'cd-audio',
+                            'dvd-rom',
+                            'dvd-video',
+                            'cd-interactive',
+                            'cd-extra',
+                            'cd-mixedmode']
+
 # Set encoding of the terminal to UTF-8
 if sys.version.startswith("2"):
     out = codecs.getwriter("UTF-8")(sys.stdout)
@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+"""
+Settings and state of one run
+"""
+
+import threading
+from .workqueue import LeaseLostError
+
+
+class RunContext:
+    """Settings and state (error and warning counters, failed PPNs, etc.) of one run,
+    i.e. the processing of one batch. An instance is passed explicitly to all
+    classes and functions that need it, so several batches can be processed
+    concurrently within one process. Counters are thread-safe
+    """
+    def __init__(self):
+        """Initialise RunContext class instance"""
+        self.lock = threading.Lock()
+
+        # Counters for number of errors and warnings
+        self.errors = 0
+        self.warnings = 0
+
+        # Set for storing failed PPN values (needed for pruning)
+        self.failedPPNs = set()
+
+        # List for storing directories as extracted from batch manifest
+        self.dirsInMetaCarriers = []
+
+        # Iromlab version, read from batch
+        self.iromlabMajorVersion = 0
+        self.iromlabMinorVersion = 11
+
+        # Flag that indicates if SIPs will be written
+        self.createSIPs = False
+
+        # Output directory for SIPs (write mode only!)
+        self.dirOut = None
+
+        # Directory for the databases that are kept between runs, such as the
+        # checksum cache (None if these are not used). This is never inside the
+        # input batch, which is only read
+        self.stateDir = None
+
+        # Flag that indicates if prune option is used
+        self.pruneBatch = False
+
+        # Error batch (prune mode only!)
+        self.batchErr = ""
+
+        # Flag that indicates if checksum checking is skipped (verify mode only!)
+        self.skipChecksumFlag = False
+
+        # Flag that indicates if quick checksum verification is used (verify mode only!)
+        self.quickFlag = False
+
+        # Flag that indicates if copied files are re-read for checksum verification (write mode only!)
+        self.readBackFlag = False
+
+        # Flag that indicates if cached checksums are ignored
+        self.rehashFlag = False
+
+        # Checksum cache (ChecksumCache instance, or None if no cache is used)
+        self.checksumCache = None
+
+        # Flag that indicates if chunk digests are recorded in the checksum cache
+        self.chunkManifest = False
+
+        # Flag that indicates if an interrupted write is resumed (write mode only!)
+        self.resumeFlag = False
+
+        # Number of files that are hashed concurrently
+        self.hashWorkers = 1
+
+        # Number of PPNs that are processed concurrently
+        self.jobs = 1
+
+        # Flag that indicates if PPNs are processed in a staged pipeline
+        self.pipelineFlag = False
+
+        # Number of workers of each pipeline stage (disk I/O, CPU and network)
+        self.stageWorkers = {"io": 2, "cpu": 2, "net": 4}
+
+        # Name of hashing backend
+        self.hashBackendName = "readinto"
+
+        # I/O mode for reading files
+        self.ioMode = "buffered"
+
+        # Throughput statistics: number of bytes read and time spent, by I/O mode
+        self.ioStats = {}
+
+        # Fixity algorithms; SHA-512 is always used, others are optional (write mode only!)
+        self.fixityAlgorithms = ["sha512"]
+
+        # Method for copying files to the SIPs (write mode only!)
+        self.copyStrategy = "stream"
+
+        # Flag that indicates if METS files are written without indentation (write mode only!)
+        self.compactMetsFlag = False
+
+        # Number of PPNs per catalogue request (1 means no batched lookups)
+        self.catalogueBatchSize = 50
+
+        # Flag that indicates if MODS are created from the catalogue records in the
+        # meta-kbmdo.xml files of the carriers (with catalogue lookup as fallback)
+        self.localRecordsFlag = False
+
+        # Time (in seconds) after which entries in the catalogue cache expire
+        # (0 means no catalogue cache is used)
+        self.catalogueTTL = 86400
+
+        # Prefetched catalogue records: for each PPN, a list with the metadata
+        # fields of each matching record (entries are removed once used)
+        self.catalogueRecords = {}
+
+        # Background catalogue lookups (CataloguePrefetch instance, or None)
+        self.cataloguePrefetch = None
+
+        # Event that is set if the lease on the PPN that is processed is lost
+        # (worker mode only!)
+        self.leaseLost = None
+
+    def __getstate__(self):
+        """Return state for pickling (e.g. for worker processes); the lock, the
+        checksum cache, the background catalogue lookups and the lease event cannot
+        be pickled, so these are left out
+        """
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["checksumCache"] = None
+        state["cataloguePrefetch"] = None
+        state["leaseLost"] = None
+        return state
+
+    def __setstate__(self, state):
+        """Restore pickled state"""
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def addError(self, PPN=None):
+        """Increase error count, and add PPN (if given) to failed PPNs"""
+        with self.lock:
+            self.errors += 1
+            if PPN is not None:
+                self.failedPPNs.add(PPN)
+
+    def addWarning(self):
+        """Increase warning count"""
+        with self.lock:
+            self.warnings += 1
+
+    def checkLease(self):
+        """Raise LeaseLostError if the lease on the PPN that is processed was lost
+        (worker mode only), so the PPN is aborted before anything else is written
+        """
+        if self.leaseLost is not None and self.leaseLost.is_set():
+            raise LeaseLostError()
+
+    def addDirInMetaCarriers(self, directory):
+        """Add carrier directory that is referenced in the batch manifest"""
+        with self.lock:
+            self.dirsInMetaCarriers.append(directory)
+
+    def addIOStats(self, ioMode, noBytes, seconds):
+        """Add number of bytes read and time spent to statistics of ioMode"""
+        with self.lock:
+            modeBytes, modeSeconds = self.ioStats.get(ioMode, (0, 0.0))
+            self.ioStats[ioMode] = (modeBytes + noBytes, modeSeconds + seconds)
+
+    def newWorkerContext(self, PPNValue=None):
+        """Return new RunContext with the same settings, but with reset counters,
+        failed PPNs, carrier directories and statistics (used for processing
+        one PPN in a worker process). Only the prefetched catalogue records of
+        PPNValue (if any) are included; this waits for their background lookup
+        """
+        worker = RunContext()
+        for name, value in self.__getstate__().items():
+            if name != "catalogueRecords":
+                setattr(worker, name, value)
+        if PPNValue in self.catalogueRecords:
+            worker.catalogueRecords = {PPNValue: self.catalogueRecords.pop(PPNValue)}
+        elif PPNValue is not None and self.cataloguePrefetch is not None:
+            records = self.cataloguePrefetch.take(PPNValue)
+            if records is not None:
+                worker.catalogueRecords = {PPNValue: records}
+        worker.errors = 0
+        worker.warnings = 0
+        worker.failedPPNs = set()
+        worker.dirsInMetaCarriers = []
+        worker.ioStats = {}
+        return worker
+
+    def merge(self, other):
+        """Merge counters, failed PPNs, carrier directories and statistics of other
+        RunContext (e.g. from a worker process) into this one
+        """
+        with self.lock:
+            self.errors += other.errors
+            self.warnings += other.warnings
+            self.failedPPNs.update(other.failedPPNs)
+            self.dirsInMetaCarriers.extend(other.dirsInMetaCarriers)
+        for ioMode, (noBytes, seconds) in other.ioStats.items():
+            self.addIOStats(ioMode, noBytes, seconds)
@@ -0,0 +1,219 @@
+#! /usr/bin/env python
+"""
+Low-level file reading, with page cache hints and throughput statistics
+"""
+
+import os
+import mmap
+import time
+import errno
+import queue
+import logging
+import threading
+
+# Size of blocks that are read from (and written to) files
+blocksize = 2**20
+
+# Size of chunks for which digests are recorded in the chunk manifest (must be
+# a multiple of blocksize)
+chunkSize = 64 * 2**20
+
+# I/O modes:
+# - buffered: plain reads through the page cache
+# - nocache: sequential access hint, and pages are dropped from the page
+#   cache behind the read cursor
+# - direct: direct I/O (O_DIRECT) with page-aligned buffers, bypassing the
+#   page cache altogether
+ioModes = ["buffered", "nocache", "direct"]
+
+# Number of buffers that are used by pipelined reading
+pipelineBuffers = 4
+
+
+def open_source(context, fileIn):
+    """Open fileIn for reading, and return unbuffered file object
+    Except in buffered mode, the file is opened with O_NOATIME (if permitted, which
+    requires ownership of the file) and the kernel is told that it will be read
+    sequentially. In direct mode the file is opened with O_DIRECT; if the file
+    system doesn't support this, it is read as in nocache mode
+    """
+
+    flags = os.O_RDONLY | getattr(os, "O_BINARY", 0)
+    if context.ioMode != "buffered":
+        flags |= getattr(os, "O_NOATIME", 0)
+    if context.ioMode == "direct":
+        flags |= getattr(os, "O_DIRECT", 0)
+
+    while True:
+        try:
+            fd = os.open(fileIn, flags)
+            break
+        except OSError as e:
+            if e.errno == errno.EPERM and flags & getattr(os, "O_NOATIME", 0):
+                flags &= ~os.O_NOATIME
+            elif e.errno == errno.EINVAL and flags & getattr(os, "O_DIRECT", 0):
+                flags &= ~os.O_DIRECT
+            else:
+                raise
+
+    if context.ioMode != "buffered" and hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return os.fdopen(fd, "rb", buffering=0)
+
+
+def new_buffer(context):
+    """Return new read buffer of blocksize bytes. In direct mode the buffer is
+    page-aligned anonymous memory, as required for O_DIRECT reads
+    """
+
+    if context.ioMode == "direct":
+        return mmap.mmap(-1, blocksize)
+    return bytearray(blocksize)
+
+
+def drop_behind(context, f, offset, length):
+    """Drop pages of file object f that were read (range offset, offset + length)
+    from the page cache (nocache mode only)
+    """
+
+    if context.ioMode == "nocache" and hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_DONTNEED)
+
+
+def read_blocks(context, fileIn, offsetStart=0):
+    """Generator that reads fileIn in blocks into one reused buffer, and yields
+    a memoryview of each block. Each view is only valid until the next block is
+    read. Reading starts at offsetStart, which must be a multiple of blocksize.
+    Throughput is added to the statistics of the current I/O mode
+    """
+
+    buf = new_buffer(context)
+    view = memoryview(buf)
+    offset = offsetStart
+    timeStart = time.perf_counter()
+    try:
+        with open_source(context, fileIn) as f:
+            f.seek(offsetStart)
+            while True:
+                noBytes = f.readinto(buf)
+                if not noBytes:
+                    break
+                yield view[:noBytes]
+                drop_behind(context, f, offset, noBytes)
+                offset += noBytes
+    finally:
+        add_stats(context, offset - offsetStart, time.perf_counter() - timeStart)
+
+
+def read_blocks_pipelined(context, fileIn, fOut=None):
+    """Generator that yields a memoryview of each block of fileIn, like read_blocks,
+    but reads ahead in a background thread into a bounded pool of preallocated
+    buffers. This way the read of the next block overlaps with the processing
+    (e.g. hashing) of the current one. If fOut (unbuffered file object) is given,
+    each block is written to fOut by a second background thread once it has been
+    processed, so writing overlaps with reading and processing as well.
+    Each view is only valid until the next block is requested
+    """
+
+    freeBuffers = queue.Queue()
+    for _ in range(pipelineBuffers):
+        freeBuffers.put(new_buffer(context))
+    filledBuffers = queue.Queue()
+    writeBuffers = queue.Queue()
+    stopReading = threading.Event()
+    errors = []
+
+    def reader():
+        """Fill free buffers with data from fileIn"""
+        try:
+            with open_source(context, fileIn) as f:
+                offset = 0
+                while not stopReading.is_set():
+                    buf = freeBuffers.get()
+                    if buf is None:
+                        break
+                    noBytes = f.readinto(buf)
+                    if not noBytes:
+                        break
+                    filledBuffers.put((buf, noBytes))
+                    drop_behind(context, f, offset, noBytes)
+                    offset += noBytes
+        except OSError as e:
+            errors.append(e)
+        finally:
+            filledBuffers.put(None)
+
+    def writer():
+        """Write processed buffers to fOut, and return them to the pool"""
+        while True:
+            item = writeBuffers.get()
+            if item is None:
+                break
+            buf, noBytes = item
+            if not errors:
+                try:
+                    write_all(fOut, memoryview(buf)[:noBytes])
+                except OSError as e:
+                    errors.append(e)
+            freeBuffers.put(buf)
+
+    readerThread = threading.Thread(target=reader, daemon=True)
+    readerThread.start()
+    if fOut is not None:
+        writerThread = threading.Thread(target=writer, daemon=True)
+        writerThread.start()
+
+    noBytesTotal = 0
+    timeStart = time.perf_counter()
+    try:
+        while True:
+            item = filledBuffers.get()
+            if item is None:
+                break
+            buf, noBytes = item
+            yield memoryview(buf)[:noBytes]
+            noBytesTotal += noBytes
+            if fOut is not None:
+                writeBuffers.put(item)
+            else:
+                freeBuffers.put(buf)
+    finally:
+        # Stop reader (which may be waiting for a free buffer) and writer
+        stopReading.set()
+        freeBuffers.put(None)
+        readerThread.join()
+        if fOut is not None:
+            writeBuffers.put(None)
+            writerThread.join()
+        add_stats(context, noBytesTotal, time.perf_counter() - timeStart)
+
+    if errors:
+        raise errors[0]
+
+
+def write_all(fOut, data):
+    """Write all of data to unbuffered file object fOut (which may do partial writes)"""
+
+    noBytesWritten = 0
+    while noBytesWritten < len(data):
+        noBytesWritten += fOut.write(data[noBytesWritten:])
+
+
+def add_stats(context, noBytes, seconds):
+    """Add number of bytes read and time spent to statistics of current I/O mode"""
+
+    context.addIOStats(context.ioMode, noBytes, seconds)
+
+
+def report_stats(context):
+    """Report throughput for each I/O mode that was used"""
+
+    with context.lock:
+        for ioMode, (noBytes, seconds) in sorted(context.ioStats.items()):
+            if seconds > 0:
+                throughput = noBytes / seconds / 2**20
+            else:
+                throughput = 0.0
+            logging.info("I/O mode '" + ioMode + "': read " + str(noBytes // 2**20) +
+                         " MiB in " + "{:.1f}".format(seconds) + " s (" +
+                         "{:.1f}".format(throughput) + " MiB/s per stream)")
@@ -1,7 +1,8 @@
 from .sru import sru
+from .sru import asyncsru
 __version__ = '0.1.5'
 
-__all__ = ['sru']
+__all__ = ['sru', 'asyncsru']
 __author__ = 'WillemJan Faber <willemjan.faber@kb.nl'
 
 sru = sru()
@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+"""
+Persistent cache of SRU records
+"""
+
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+
+class recordcache():
+    # Cache of the raw record XML returned by SRU searches, stored in an
+    # SQLite database. Entries are keyed by the base URL of the service, the
+    # collection, the record schema and the query, and expire after ttl
+    # seconds. Negative results (searches without any records) are cached as
+    # well, and expire after negativettl seconds (by default the same as ttl). Several processes can
+    # use the same database at once: each process opens its own connection,
+    # and threads within a process share it.
+    def __init__(self, dbfile, ttl=86400, negativettl=None):
+        self.dbfile = dbfile
+        self.ttl = ttl
+        if negativettl is None:
+            negativettl = ttl
+        self.negativettl = negativettl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+        with self.lock:
+            conn = self.connection()
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS records ("
+                             "url TEXT NOT NULL, "
+                             "collection TEXT NOT NULL, "
+                             "recordschema TEXT NOT NULL, "
+                             "query TEXT NOT NULL, "
+                             "records TEXT NOT NULL, "
+                             "negative INTEGER NOT NULL, "
+                             "fetched REAL NOT NULL, "
+                             "PRIMARY KEY (url, collection, recordschema, query))")
+        self.purge()
+
+    def connection(self):
+        # Return connection of this process; a connection that was inherited
+        # from a parent process (fork) cannot be used, so a new one is opened
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.dbfile, timeout=60,
+                                        check_same_thread=False)
+            self.pid = os.getpid()
+        return self.conn
+
+    def get(self, url, collection, recordschema, query):
+        # Return list with the record XML strings of query, or None if query
+        # is not in the cache or its entry expired
+        try:
+            with self.lock:
+                row = self.connection().execute(
+                    "SELECT records, negative, fetched FROM records WHERE url = ? "
+                    "AND collection = ? AND recordschema = ? AND query = ?",
+                    (url, collection, recordschema, query)).fetchone()
+        except sqlite3.Error as e:
+            logging.debug('SRU record cache lookup failed: %s' % e)
+            row = None
+        if row is not None:
+            ttl = self.negativettl if row[1] else self.ttl
+            if row[2] >= time.time() - ttl:
+                with self.lock:
+                    self.hits += 1
+                return json.loads(row[0])
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, url, collection, recordschema, entries):
+        # Store entries, a dictionary with a list with the record XML strings
+        # of each query (an empty list is a negative result), in one
+        # transaction
+        now = time.time()
+        rows = [(url, collection, recordschema, query, json.dumps(records),
+                 int(not records), now) for query, records in entries.items()]
+        try:
+            with self.lock:
+                conn = self.connection()
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO records VALUES "
+                                     "(?, ?, ?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            logging.debug('SRU record cache update failed: %s' % e)
+
+    def purge(self):
+        # Remove expired entries
+        now = time.time()
+        try:
+            with self.lock:
+                conn = self.connection()
+                with conn:
+                    conn.execute("DELETE FROM records WHERE (negative = 0 AND fetched < ?) "
+                                 "OR (negative = 1 AND fetched < ?)",
+                                 (now - self.ttl, now - self.negativettl))
+        except sqlite3.Error as e:
+            logging.debug('SRU record cache purge failed: %s' % e)
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None and self.pid == os.getpid():
+                self.conn.close()
+            self.conn = None
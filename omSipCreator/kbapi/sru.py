@@ -3,17 +3,62 @@
 Python API for KB SRU
 """
 
+import re
 import sys
+import time
+import random
 import urllib
+import asyncio
+import logging
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import requests.adapters
 from lxml import etree
 
-SRU_BASEURL = 'http://jsru.kb.nl/sru/sru'
-SRU_BASEURL += '?version=1.2&maximumRecords=%i'
-SRU_BASEURL += '&operation=searchRetrieve'
-SRU_BASEURL += '&startRecord=%i'
-SRU_BASEURL += '&recordSchema=%s'
-SRU_BASEURL += '&x-collection=%s&query=%s'
+SRU_URL = 'http://jsru.kb.nl/sru/sru'
+
+SRU_PARAMS = '?version=1.2&maximumRecords=%i'
+SRU_PARAMS += '&operation=searchRetrieve'
+SRU_PARAMS += '&startRecord=%i'
+SRU_PARAMS += '&recordSchema=%s'
+SRU_PARAMS += '&x-collection=%s&query=%s'
+
+SRU_BASEURL = SRU_URL + SRU_PARAMS
+
+# HTTP status codes of responses that are worth retrying
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+# Elements that contain the identifiers of a record (used for splitting the
+# records of a batch search)
+IDENTIFIER_TAGS = ['{http://purl.org/dc/elements/1.1/}identifier',
+                   '{http://krait.kb.nl/coop/tel/handbook/telterms.html}recordIdentifier']
+
+# Precompiled XPath expressions for SRU responses
+SRW_NS = {'zs': 'http://www.loc.gov/zing/srw/'}
+RECORDS_XPATH = etree.XPath("zs:records/zs:record", namespaces=SRW_NS)
+# Number of records (child of the response root, in any namespace)
+NR_OF_RECORDS_XPATH = etree.XPath("*[local-name()='numberOfRecords']/text()")
+
+
+def quote_query(query):
+    # Return query, encoded for use in a URL
+    if sys.version.startswith('2'):
+        return urllib.quote_plus(query)
+    return urllib.parse.quote_plus(query)
+
+
+def identifier_values(record_data, index='PPN'):
+    # Return set with all values of the form index=value or index:value in
+    # the identifiers of record_data (an srw:record element)
+    pattern = re.compile(re.escape(index) + r'[=:]([^\s&"/<]+)')
+    values = set()
+    for identifier in record_data.iter(*IDENTIFIER_TAGS):
+        values.update(pattern.findall(identifier.text or ''))
+    return values
+
 
 SETS = {'ANP': {'collection': 'ANP',
                 'description_en': 'Radio Bulletins ANP Press Agency',
@@ -68,33 +113,34 @@ class response():
     def __init__(self, record_data, sru):
         self.record_data = record_data
         self.sru = sru
+        self.index = None
+
+    def build_index(self):
+        # Index the text content of all elements in one pass over the tree:
+        # (tag, '', '') maps to the texts of all elements with that tag, and
+        # (tag, attribute name, attribute value) to the texts of the elements
+        # that also have that attribute value. Texts are in document order.
+        index = {}
+        for r in self.record_data.iter(tag=etree.Element):
+            index.setdefault((r.tag, '', ''), []).append(r.text)
+            for name, value in r.attrib.items():
+                index.setdefault((r.tag, name, value), []).append(r.text)
+        self.index = index
 
     def getElementText(self, tagName, attributeName, attributeValue):
         # Returns text content of all elements for which tag matches tagName,
         # and attribute value equals attributeValue. Set attributeName to empty
-        # string to get all tagName matches.
-        textFields = []
-        for r in self.record_data.iter():
-            if r.tag == tagName:
-                if attributeName != '':
-                    try:
-                        if r.attrib[attributeName] == attributeValue:
-                            textFields.append(r.text)
-                    except KeyError:
-                        pass
-                else:
-                    textFields.append(r.text)
-        return textFields
+        # string to get all tagName matches. The index is built on first use.
+        if self.index is None:
+            self.build_index()
+        if attributeName == '':
+            attributeValue = ''
+        return list(self.index.get((tagName, attributeName, attributeValue), []))
 
     @property
     def records(self):
-        if self.sru.nr_of_records == 0:
-            record_data = "<xml></xml>"
-        else:
-            ns = {'zs': 'http://www.loc.gov/zing/srw/'}
-            record_data = self.record_data.xpath("zs:records/zs:record",
-                                                 namespaces=ns)[0]
-        return record(record_data, self.sru)
+        # Iterator over all records of the search (see record)
+        return record(self.record_data, self.sru)
 
     # Below property functions all return a list with all instances that satisfy
     # criteria
@@ -253,93 +299,368 @@ class response():
 
 
 class record():
-    def __init__(self, record_data, sru):
-        self.record_data = record_data
+    # Iterator over the records of a search, which returns a response instance
+    # for each record. record_data is the response of the search, whose
+    # records are returned first. Following records are fetched in pages of
+    # pagesize records (by default the maximumrecords of the search) with one
+    # request per page, and returned from a local buffer. The query state of
+    # the search is not changed, so several iterators can be used at once.
+    def __init__(self, record_data, sru, pagesize=None):
         self.sru = sru
+        self.pagesize = pagesize or sru.maximumrecords
+        self.buffer = deque()
+        self.nextrecord = sru.startrecord
+        self.exhausted = sru.nr_of_records == 0
+        if not self.exhausted:
+            self.buffer.extend(RECORDS_XPATH(record_data))
+            self.nextrecord += len(self.buffer)
 
     def __iter__(self):
         return self
 
-    # This works under Python 2.7
-    def next(self):
-        if self.sru.nr_of_records == 0:
-            raise StopIteration
-        if self.sru.startrecord < self.sru.nr_of_records + 1:
-            record_data = self.sru.run_query()
-            self.sru.startrecord += 1
-            return response(record_data, self.sru)
-        else:
-            raise StopIteration
+    def fill(self):
+        # Fetch next page if the buffer is empty; returns False if there are
+        # no more records
+        if self.buffer:
+            return True
+        if self.exhausted or self.nextrecord > self.sru.nr_of_records:
+            return False
+        state = sruquery(self.sru.client, self.sru.query, self.sru.collection,
+                         self.sru.recordschema, self.nextrecord, self.pagesize)
+        page = RECORDS_XPATH(state.run_query())
+        if not page:
+            # Fewer records than reported by the server
+            self.exhausted = True
+            return False
+        self.buffer.extend(page)
+        self.nextrecord += len(page)
+        return True
 
     # This works under Python 3
     def __next__(self):
-        if self.sru.nr_of_records == 0:
-            raise StopIteration
-        if self.sru.startrecord < self.sru.nr_of_records + 1:
-            record_data = self.sru.run_query()
-            self.sru.startrecord += 1
-            return response(record_data, self.sru)
-        else:
+        if not self.fill():
             raise StopIteration
+        return response(self.buffer.popleft(), self.sru)
+
+    # This works under Python 2.7
+    def next(self):
+        return self.__next__()
+
+
+class sruquery():
+    # State of one search (query, collection, record schema, position of first
+    # record, maximum number of records per request and number of matching
+    # records). Each search gets its own instance,
+    # so the sru client itself holds no per-query state and can be shared
+    # between threads.
+    def __init__(self, client, query, collection, recordschema,
+                 startrecord, maximumrecords):
+        self.client = client
+        self.query = query
+        self.collection = collection
+        self.recordschema = recordschema
+        self.startrecord = startrecord
+        self.maximumrecords = maximumrecords
+        self.nr_of_records = 0
+
+    def run_query(self):
+        return self.client.run_query(self)
 
 
 class sru():
     DEBUG = False
 
-    collection = False
-    maximumrecords = 50
-    nr_of_records = 0
-    query = ""
-    recordschema = False
     sru_collections = SETS
-    startrecord = 0
+
+    def __init__(self, baseurl=SRU_URL, timeout=30, retries=3, backoff=0.5,
+                 maxbackoff=30, poolsize=10):
+        # Only configuration, the connection pool and latency statistics are
+        # stored here, so one instance can be used for concurrent searches.
+        # timeout is the connect and read timeout (in seconds) of each
+        # request; failed requests are retried up to retries times, after a
+        # random delay of at most backoff * 2^attempt (and maxbackoff) seconds.
+        self.baseurl = baseurl
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+
+        # Persistent connections (keep-alive) from a pool that is shared by
+        # all threads; responses are gzip-compressed if the server supports it
+        self.session = requests.Session()
+        self.set_poolsize(poolsize)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+        # Record cache (recordcache instance) that is used by search_batch, or
+        # None
+        self.cache = None
+
+        # Latency statistics
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=10000)
+        self.requestcount = 0
+        self.retrycount = 0
+        self.failurecount = 0
+
+    def set_poolsize(self, poolsize):
+        # Keep at most poolsize idle connections per host; this should be at
+        # least the number of threads that search concurrently
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=poolsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def search(self, query, collection=False,
                startrecord=1, maximumrecords=1, recordschema=False):
 
-        self.maximumrecords = maximumrecords
-        if sys.version.startswith('3'):
-            self.query = urllib.parse.quote_plus(query)
-        elif sys.version.startswith('2'):
-            self.query = urllib.quote_plus(query)
-        self.startrecord = startrecord
+        query = quote_query(query)
 
         if collection not in self.sru_collections:
             raise Exception('Unknown collection')
 
-        self.collection = self.sru_collections[collection]['collection']
+        collectionName = self.sru_collections[collection]['collection']
 
-        if not self.collection:
+        if not collectionName:
             raise Exception('Error, no collection specified')
 
         if not recordschema:
-            self.recordschema = self.sru_collections[collection]['recordschema']
-        else:
-            self.recordschema = recordschema
+            recordschema = self.sru_collections[collection]['recordschema']
+
+        state = sruquery(self, query, collectionName, recordschema,
+                         startrecord, maximumrecords)
 
-        record_data = self.run_query()
+        record_data = state.run_query()
 
-        nr_of_records = [i.text for i in record_data.iter() if
-                         i.tag.endswith('numberOfRecords')][0]
+        nr_of_records = NR_OF_RECORDS_XPATH(record_data)[0]
 
-        self.nr_of_records = int(nr_of_records)
+        state.nr_of_records = int(nr_of_records)
 
-        if self.nr_of_records > 0:
-            return response(record_data, self)
+        if state.nr_of_records > 0:
+            return response(record_data, state)
 
         return False
 
-    def run_query(self):
-        url = SRU_BASEURL % (self.maximumrecords, self.startrecord,
-                             self.recordschema, self.collection, self.query)
+    def iter_records(self, query, collection=False, pagesize=100,
+                     recordschema=False, startrecord=1):
+        # Generator that returns a response instance for each record of query,
+        # starting at startrecord. Records are fetched in pages of pagesize
+        # records, so only one page is held in memory at a time.
+        found = self.search(query, collection, startrecord, pagesize, recordschema)
+        if not found:
+            return
+        for result in found.records:
+            yield result
+
+    def search_batch(self, values, collection=False, index='PPN',
+                     batchsize=50, recordschema=False):
+        # Search records for many identifier values (e.g. PPNs) with few
+        # requests: the clauses for up to batchsize values are combined into
+        # one OR'd CQL query, with maximumRecords set to the number of values
+        # (following pages are fetched if there are more matches). Returns a
+        # dictionary with, for each value, a list with a response instance for
+        # each matching record. If a query combines several values, records
+        # are assigned to values by the identifiers in the record of the form
+        # index=value or index:value; all records of a query for one value
+        # belong to that value. If such a query returns records that cannot be
+        # assigned to any value (e.g. because their identifiers are formatted
+        # differently), the values without records are searched once more on
+        # their own, so no matches are lost.
+        # If a record cache is set, the records of each value are taken from
+        # (and stored in) the cache, so only values that are not in the cache
+        # are searched.
+        if collection not in self.sru_collections:
+            raise Exception('Unknown collection')
+        if not recordschema:
+            recordschema = self.sru_collections[collection]['recordschema']
+
+        values = list(dict.fromkeys(values))
+        records = {}
+        pending = []
+        for value in values:
+            cached = None
+            if self.cache is not None:
+                cached = self.cache.get(self.baseurl, collection, recordschema,
+                                        '"' + index + '=' + value + '"')
+            if cached is None:
+                pending.append(value)
+            else:
+                records[value] = [etree.fromstring(record) for record in cached]
+
+        chunks = deque([pending[first:first + max(batchsize, 1)]
+                        for first in range(0, len(pending), max(batchsize, 1))])
+        while chunks:
+            chunk = chunks.popleft()
+            query = ' OR '.join(['"' + index + '=' + value + '"' for value in chunk])
+            for value in chunk:
+                records[value] = []
+            unassigned = False
+            for found in self.iter_records(query, collection, len(chunk), recordschema):
+                if len(chunk) == 1:
+                    # Query for one value, so all records belong to it (as with
+                    # search), whatever their identifiers
+                    records[chunk[0]].append(found.record_data)
+                    continue
+                matches = identifier_values(found.record_data, index)
+                assigned = False
+                for value in chunk:
+                    if value in matches:
+                        records[value].append(found.record_data)
+                        assigned = True
+                unassigned = unassigned or not assigned
+            # Values without records may own the unassigned records, so these
+            # are searched on their own (and their empty results are not cached)
+            requery = []
+            if unassigned:
+                requery = [value for value in chunk if not records[value]]
+                chunks.extend([[value] for value in requery])
+            if self.cache is not None:
+                self.cache.put(self.baseurl, collection, recordschema,
+                               {'"' + index + '=' + value + '"':
+                                [etree.tostring(record, encoding='unicode')
+                                 for record in records[value]]
+                                for value in chunk if value not in requery})
+
+        results = {}
+        for value in values:
+            state = sruquery(self, quote_query('"' + index + '=' + value + '"'),
+                             self.sru_collections[collection]['collection'],
+                             recordschema, 1, len(records[value]))
+            state.nr_of_records = len(records[value])
+            results[value] = [response(record, state) for record in records[value]]
+        return results
+
+    def run_query(self, state):
+        url = self.baseurl + SRU_PARAMS % (state.maximumrecords, state.startrecord,
+                                           state.recordschema, state.collection,
+                                           state.query)
         if self.DEBUG:
             sys.stdout.write(url)
 
-        r = requests.get(url)
-
-        if not r.status_code == 200:
+        r = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                # Exponential backoff with full jitter
+                time.sleep(random.uniform(0, min(self.maxbackoff,
+                                                 self.backoff * 2 ** (attempt - 1))))
+                with self.lock:
+                    self.retrycount += 1
+            start = time.perf_counter()
+            try:
+                r = self.session.get(url, timeout=self.timeout)
+                status = r.status_code
+            except (requests.ConnectionError, requests.Timeout):
+                r = None
+                status = None
+            self.add_latency(time.perf_counter() - start, url, status)
+            if r is not None and r.status_code not in RETRY_STATUS:
+                break
+
+        if r is None or not r.status_code == 200:
+            with self.lock:
+                self.failurecount += 1
             raise Exception('Error while getting data from %s' % url)
 
         record_data = etree.fromstring(r.content)
 
         return record_data
+
+    def add_latency(self, latency, url, status):
+        # Record latency (in seconds) of one request
+        with self.lock:
+            self.requestcount += 1
+            self.latencies.append(latency)
+        logging.debug('SRU request (status %s) took %.3f s: %s' % (status, latency, url))
+
+    def latency_stats(self):
+        # Return dictionary with number of requests, retries and failed
+        # searches, and mean, median, 95th percentile and maximum latency (in
+        # seconds) of the most recent requests
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {'requests': self.requestcount,
+                     'retries': self.retrycount,
+                     'failures': self.failurecount,
+                     'cachehits': 0}
+        if self.cache is not None:
+            stats['cachehits'] = self.cache.hits
+        if latencies:
+            stats['mean'] = sum(latencies) / len(latencies)
+            stats['median'] = latencies[len(latencies) // 2]
+            stats['p95'] = latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)]
+            stats['max'] = latencies[-1]
+        return stats
+
+
+class asyncsru():
+    # asyncio variant of sru. Searches are done by a (shared) sru client in a
+    # pool of threads; a semaphore limits the number of concurrent searches to
+    # maxconcurrent.
+    def __init__(self, client=None, maxconcurrent=8):
+        if client is None:
+            client = sru()
+        self.client = client
+        self.maxconcurrent = maxconcurrent
+        self.executor = ThreadPoolExecutor(max_workers=maxconcurrent)
+        self.semaphore = None
+
+    async def search(self, query, collection=False,
+                     startrecord=1, maximumrecords=1, recordschema=False):
+        # Semaphore is created here, so it belongs to the running event loop
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.maxconcurrent)
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            return await loop.run_in_executor(self.executor, functools.partial(
+                self.client.search, query, collection, startrecord,
+                maximumrecords, recordschema))
+
+    async def search_all(self, queries, collection=False,
+                         startrecord=1, maximumrecords=1, recordschema=False):
+        # Run searches for all queries concurrently, and return list of
+        # results in the order of queries
+        return await asyncio.gather(*[self.search(query, collection, startrecord,
+                                                  maximumrecords, recordschema)
+                                      for query in queries])
+
+    async def iter_records(self, query, collection=False, pagesize=100,
+                           recordschema=False, startrecord=1):
+        # Asynchronous generator variant of sru.iter_records; pages are
+        # fetched in the thread pool
+        found = await self.search(query, collection, startrecord, pagesize,
+                                  recordschema)
+        if not found:
+            return
+        loop = asyncio.get_running_loop()
+        records = found.records
+        while True:
+            if not records.buffer:
+                async with self.semaphore:
+                    more = await loop.run_in_executor(self.executor, records.fill)
+                if not more:
+                    return
+            yield next(records)
+
+    async def search_batch(self, values, collection=False, index='PPN',
+                           batchsize=50, recordschema=False):
+        # Batch search (see sru.search_batch), with the requests for different
+        # batches running concurrently
+        values = list(dict.fromkeys(values))
+        chunks = [values[first:first + max(batchsize, 1)]
+                  for first in range(0, len(values), max(batchsize, 1))]
+        loop = asyncio.get_running_loop()
+
+        async def searchChunk(chunk):
+            async with self.semaphore:
+                return await loop.run_in_executor(self.executor, functools.partial(
+                    self.client.search_batch, chunk, collection, index,
+                    len(chunk), recordschema))
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.maxconcurrent)
+        results = {}
+        for chunkResults in await asyncio.gather(*[searchChunk(chunk) for chunk in chunks]):
+            results.update(chunkResults)
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=True)
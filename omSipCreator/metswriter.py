@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+"""
+Incremental writer for METS files
+"""
+
+import shutil
+import tempfile
+from lxml import etree
+from . import config
+
+# Size (in bytes) up to which spooled sections are kept in memory
+spoolSize = 4*1024*1024
+
+# Identifiers of the dmdSec and amdSec elements
+dmdSecID = "dmdSec_1"
+amdSecID = "amdSec_1"
+
+
+class MetsWriter:
+    """Writer of the METS file of one SIP. Elements of the amdSec, fileSec and
+    structMap are serialized as soon as they are added (i.e. after each carrier),
+    so the element trees of a carrier can be released right away. Serialized
+    elements are kept in a spool file for each section (in memory up to spoolSize
+    bytes, on disk beyond that). The dmdSec comes first in the METS file, but its
+    MODS depend on all carriers; write therefore writes the METS file once the
+    PPN is finished, copying the spooled sections in document order. If fileName
+    is None nothing is spooled or written (verify mode)
+    """
+
+    # Sections with the nesting level of their elements, in document order
+    sections = [("techMDFile", 2),
+                ("techMDRep", 2),
+                ("digiprovMD", 2),
+                ("file", 3),
+                ("div", 3)]
+
+    def __init__(self, fileName=None, prettyPrint=True):
+        """initialise MetsWriter class instance"""
+        self.fileName = fileName
+        self.prettyPrint = prettyPrint
+        self.levels = dict(self.sections)
+        self.spools = {}
+        # Elements are serialized as child of scope, which declares the namespaces
+        # of config.NSMAP, so these are not declared again on each element
+        self.scope = etree.Element(etree.QName(config.mets_ns, "mets"), nsmap=config.NSMAP)
+        self.scope.text = ""
+        scopeXML = etree.tostring(self.scope, encoding="utf-8")
+        self.scopeStart = scopeXML.index(b">") + 1
+        self.scopeEnd = scopeXML.rindex(b"<") - len(scopeXML)
+        if fileName is not None:
+            for section, level in self.sections:
+                self.spools[section] = tempfile.SpooledTemporaryFile(max_size=spoolSize)
+
+    def add(self, section, element):
+        """Serialize element and append it to section"""
+        if self.fileName is None:
+            return
+        self.spools[section].write(self.serialize(element, self.levels[section]))
+
+    def serialize(self, element, level):
+        """Return element as UTF-8 bytes, without the namespace declarations of
+        scope; with pretty-printing the element is indented to level"""
+        element.tail = None
+        indentation = b""
+        if self.prettyPrint:
+            etree.indent(element, level=level)
+            indentation = b"\n" + b"  "*level
+        self.scope.append(element)
+        scopeXML = etree.tostring(self.scope, encoding="utf-8")
+        self.scope.remove(element)
+        return indentation + scopeXML[self.scopeStart:self.scopeEnd]
+
+    def indent(self, xf, level):
+        """Write newline and indentation of level (pretty-printing only)"""
+        if self.prettyPrint:
+            xf.write("\n" + "  "*level)
+
+    def copySpools(self, xf, fOut, sections):
+        """Copy spooled sections to fOut, after anything pending in xf"""
+        xf.flush()
+        for section in sections:
+            spool = self.spools[section]
+            spool.seek(0)
+            shutil.copyfileobj(spool, fOut)
+
+    def write(self, mods):
+        """Write METS file, with mods as descriptive metadata, and close spool files"""
+        if self.fileName is None:
+            return
+
+        # dmdSec with mdWrap and xmlData child elements
+        dmdSec = etree.Element(etree.QName(config.mets_ns, "dmdSec"), nsmap=config.NSMAP)
+        dmdSec.attrib["ID"] = dmdSecID
+        mdWrapDmd = etree.SubElement(dmdSec, "{%s}mdWrap" % (config.mets_ns))
+        mdWrapDmd.attrib["MDTYPE"] = "MODS"
+        mdWrapDmd.attrib["MDTYPEVERSION"] = "3.4"
+        xmlDataDmd = etree.SubElement(mdWrapDmd, "{%s}xmlData" % (config.mets_ns))
+        xmlDataDmd.append(mods)
+
+        # METS element with schema reference and TYPE attribute
+        metsAttrib = {etree.QName(config.xsi_ns, "schemaLocation"): "".join(
+            [config.metsSchema, " ", config.modsSchema, " ", config.premisSchema]),
+                      "TYPE": "SIP"}
+        # Top-level divisor element of structMap
+        divTopAttrib = {"TYPE": "physical",
+                        "LABEL": "volumes",
+                        "DMDID": dmdSecID}
+
+        try:
+            with open(self.fileName, "wb") as fOut:
+                with etree.xmlfile(fOut, encoding="utf-8") as xf:
+                    xf.write_declaration()
+                    with xf.element(etree.QName(config.mets_ns, "mets"), metsAttrib,
+                                    nsmap=config.NSMAP):
+                        xf.flush()
+                        fOut.write(self.serialize(dmdSec, 1))
+                        self.indent(xf, 1)
+                        with xf.element(etree.QName(config.mets_ns, "amdSec"),
+                                        {"ID": amdSecID}):
+                            self.copySpools(xf, fOut, ["techMDFile", "techMDRep", "digiprovMD"])
+                            self.indent(xf, 1)
+                        self.indent(xf, 1)
+                        with xf.element(etree.QName(config.mets_ns, "fileSec")):
+                            self.indent(xf, 2)
+                            with xf.element(etree.QName(config.mets_ns, "fileGrp")):
+                                self.copySpools(xf, fOut, ["file"])
+                                self.indent(xf, 2)
+                            self.indent(xf, 1)
+                        self.indent(xf, 1)
+                        with xf.element(etree.QName(config.mets_ns, "structMap")):
+                            self.indent(xf, 2)
+                            with xf.element(etree.QName(config.mets_ns, "div"), divTopAttrib):
+                                self.copySpools(xf, fOut, ["div"])
+                                self.indent(xf, 2)
+                            self.indent(xf, 1)
+                        self.indent(xf, 0)
+                if self.prettyPrint:
+                    fOut.write(b"\n")
+        finally:
+            self.close()
+
+    def close(self):
+        """Close spool files"""
+        for spool in self.spools.values():
+            spool.close()
+        self.spools = {}
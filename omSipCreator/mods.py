@@ -4,15 +4,206 @@
 Module for writing MODS metadata
 """
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from lxml import etree
 from . import config
 from .kbapi import sru
+from .kbapi.sru import response
+from .kbapi.sru import identifier_values
+from .kbapi.sru import RECORDS_XPATH
 
 
-def createMODS(PPNGroup):
+# Metadata fields that are extracted from catalogue records
+recordFields = ["titles", "creators", "contributors", "publishers", "dates",
+                "subjectsBrinkman", "annotations", "identifiersURI", "identifiersISBN",
+                "recordIdentifiersURI", "collectionIdentifiers"]
+
+
+def getCatalogueRecord(context, PPN):
+    """Search GGC records in KBMDO for PPN, and return dictionary with the metadata
+    fields of the first matching record (empty lists if no record was found).
+    Records that were prefetched (context.catalogueRecords, or the background
+    lookups of context.cataloguePrefetch) are used if available
+    """
+
+    records = None
+    if PPN in context.catalogueRecords:
+        records = context.catalogueRecords.pop(PPN)
+    elif context.cataloguePrefetch is not None:
+        # Wait until the background lookup of this PPN is finished
+        records = context.cataloguePrefetch.take(PPN)
+
+    if records is None:
+        # Search on PPN identifier (uses the catalogue cache if there is one)
+        try:
+            results = sru.search_batch([PPN], "GGC", "PPN", 1)
+        except Exception as e:
+            # Catalogue could not be reached, even after retries
+            logging.error("PPN " + PPN + ": catalogue lookup failed (" + str(e) + ")")
+            context.addError(PPN)
+            return {field: [] for field in recordFields}
+        records = [extractRecordFields(record) for record in results[PPN]]
+
+    # This should return exactly one record. Return error if this is not the case
+    checkNoRecords(context, PPN, len(records))
+
+    if not records:
+        # Empty lists for all metadata fields in case no record was found
+        return {field: [] for field in recordFields}
+
+    # Select first record
+    return records[0]
+
+
+def getCatalogueRecords(PPNValues, batchSize=50):
+    """Search GGC records for all PPNs in PPNValues with batched requests (batchSize
+    PPNs per request), and return dictionary with, for each PPN, a list with the
+    metadata fields of each matching record. PPNs of batches for which the lookup
+    failed are left out, so these are looked up again by getCatalogueRecord
+    """
+    catalogueRecords = {}
+    PPNValues = list(PPNValues)
+    for first in range(0, len(PPNValues), batchSize):
+        catalogueRecords.update(lookupRecords(PPNValues[first:first + batchSize]))
+    return catalogueRecords
+
+
+def lookupRecords(PPNValues):
+    """Search GGC records for PPNValues with one batched request, and return
+    dictionary with a list with the metadata fields of each matching record for
+    each PPN (empty dictionary if the lookup failed)
+    """
+    try:
+        results = sru.search_batch(PPNValues, "GGC", "PPN", len(PPNValues))
+    except Exception as e:
+        logging.warning("batched catalogue lookup of " + str(len(PPNValues)) +
+                        " PPNs failed (" + str(e) + "), PPNs will be looked up " +
+                        "individually")
+        return {}
+    return {PPN: [extractRecordFields(record) for record in records]
+            for PPN, records in results.items()}
+
+
+class CataloguePrefetch:
+    """Batched catalogue lookups for all PPNs of a batch, which run in the background
+    (in the order of PPNValues, with up to workers requests at a time) while the
+    carriers of the first PPNs are processed. getCatalogueRecord takes the records
+    of each PPN with take
+    """
+    def __init__(self, PPNValues, batchSize=50, workers=1):
+        """Initialise CataloguePrefetch class instance, and start lookups"""
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1),
+                                           thread_name_prefix="omSipCreator-prefetch")
+        # Future of the lookup of each PPN (shared by all PPNs of one request)
+        self.futures = {}
+        PPNValues = list(PPNValues)
+        for first in range(0, len(PPNValues), batchSize):
+            chunk = PPNValues[first:first + batchSize]
+            future = self.executor.submit(lookupRecords, chunk)
+            for PPN in chunk:
+                self.futures[PPN] = future
+
+    def take(self, PPN, wait=True):
+        """Return list with the metadata fields of each record of PPN, and forget
+        them. Waits until the lookup of PPN is finished, unless wait is False.
+        Returns None if PPN was not prefetched, if its lookup failed, or if it is
+        not finished yet and wait is False
+        """
+        with self.lock:
+            future = self.futures.get(PPN)
+            if future is None or (not wait and not future.done()):
+                return None
+            del self.futures[PPN]
+        return future.result().get(PPN)
+
+    def shutdown(self):
+        """Cancel lookups that did not start yet, and wait for running lookups"""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def getLocalRecords(kbmdoElt, PPN):
+    """Return list with the metadata fields of each record for PPN in kbmdoElt, the
+    root element of a carrier's meta-kbmdo.xml file (the catalogue search result
+    that Iromlab stored when the carrier was imaged)
+    """
+    records = RECORDS_XPATH(kbmdoElt)
+    return [extractRecordFields(response(record, None)) for record in records
+            if PPN in identifier_values(record, "PPN")]
+
+
+def getLocalCatalogueRecord(context, PPN, carriers):
+    """Return metadata fields of the catalogue record in the meta-kbmdo.xml files of
+    carriers, or None if a carrier has no usable file, if a file does not contain
+    exactly one record for PPN, or if the records of the carriers differ
+    """
+    records = []
+    for carrier in carriers:
+        if carrier.localRecords is None:
+            # File is missing or could not be parsed (reported by carrier)
+            return None
+        if len(carrier.localRecords) != 1:
+            logging.warning("jobID " + carrier.jobID + ": meta-kbmdo.xml contains " +
+                            str(len(carrier.localRecords)) + " catalogue records for PPN " +
+                            PPN + " (expected 1)")
+            context.addWarning()
+            return None
+        records.append(carrier.localRecords[0])
+
+    if any(record != records[0] for record in records[1:]):
+        logging.warning("PPN " + PPN + ": catalogue records in meta-kbmdo.xml files " +
+                        "of carriers are not identical")
+        context.addWarning()
+        return None
+
+    return records[0]
+
+
+def checkNoRecords(context, PPN, noGGCRecords):
+    """Report error if the search for PPN did not return exactly one record"""
+    if noGGCRecords != 1:
+        logging.error("PPN " + PPN + ": search for PPN=" + PPN + " returned " +
+                      str(noGGCRecords) + " catalogue records (expected 1)")
+        context.addError(PPN)
+
+
+def extractRecordFields(record):
+    """Return dictionary with the metadata fields of catalogue record"""
+    catalogueRecord = {field: getattr(record, field) for field in recordFields}
+
+    # Title  info can be in either titles element OR in titles element
+    # with maintitle attribute. Use titlesMain if it exists
+    titlesMain = record.titlesMain
+    if titlesMain != []:
+        catalogueRecord["titles"] = titlesMain
+
+    return catalogueRecord
+
+
+def reportCatalogueStats():
+    """Log number of catalogue requests, retries and failures, and request
+    latencies of the catalogue client of this process
+    """
+    stats = sru.latency_stats()
+    if stats["cachehits"] > 0:
+        logging.info("Catalogue lookups: records of " + str(stats["cachehits"]) +
+                     " PPNs taken from catalogue cache")
+    if stats["requests"] == 0:
+        return
+    logging.info("Catalogue lookups: " + str(stats["requests"]) + " requests, " +
+                 str(stats["retries"]) + " retries, " + str(stats["failures"]) +
+                 " failed lookups; latency mean " + "{:.3f}".format(stats["mean"]) +
+                 " s, median " + "{:.3f}".format(stats["median"]) + " s, 95th percentile " +
+                 "{:.3f}".format(stats["p95"]) + " s, max " + "{:.3f}".format(stats["max"]) +
+                 " s")
+
+
+def createMODS(PPNGroup, catalogueRecord=None):
     """Create MODS metadata based on GGC records in KBMDO
     Dublin Core to MODS mapping follows http://www.loc.gov/standards/mods/dcsimple-mods.html
     General structure: bibliographic md is wrapped in relatedItem / type = host element
+    If catalogueRecord is None, the record is looked up with getCatalogueRecord
     """
 
     # Dictionary maps carrier types  to MODS resource types
@@ -26,6 +217,7 @@ def createMODS(PPNGroup):
         "cd-mixedmode": "software, multimedia"
     }
 
+    context = PPNGroup.context
     PPN = PPNGroup.PPN
     carrierTypes = PPNGroup.carrierTypes
 
@@ -33,58 +225,18 @@ def createMODS(PPNGroup):
     modsName = etree.QName(config.mods_ns, "mods")
     mods = etree.Element(modsName, nsmap=config.NSMAP)
 
-    # SRU search string (searches on dc:identifier field)
-    sruSearchString = '"PPN=' + PPN + '"'
-    response = sru.search(sruSearchString, "GGC")
+    if catalogueRecord is None:
+        catalogueRecord = getCatalogueRecord(context, PPN)
 
-    if not response:
-        # Sru.search returns False if no match was found
-        noGGCRecords = 0
-    else:
-        noGGCRecords = response.sru.nr_of_records
-
-    # This should return exactly one record. Return error if this is not the case
-    noGGCRecords = response.sru.nr_of_records
-    if noGGCRecords != 1:
-        logging.error("PPN " + PPN + ": search for PPN=" + PPN + " returned " +
-                      str(noGGCRecords) + " catalogue records (expected 1)")
-        config.errors += 1
-        config.failedPPNs.append(PPN)
-
-    # Select first record
-    try:
-        record = next(response.records)
-        # Extract metadata
-        # Title  info can be in either titles element OR in titles element
-        # with maintitle attribute
-        titlesMain = record.titlesMain
-        titles = record.titles
-        # Use titlesMain if it exists
-        if titlesMain != []:
-            titles = titlesMain
-        creators = record.creators
-        contributors = record.contributors
-        publishers = record.publishers
-        dates = record.dates
-        subjectsBrinkman = record.subjectsBrinkman
-        annotations = record.annotations
-        identifiersURI = record.identifiersURI
-        identifiersISBN = record.identifiersISBN
-        recordIdentifiersURI = record.recordIdentifiersURI
-        collectionIdentifiers = record.collectionIdentifiers
-    except StopIteration:
-        # Create empty lists fot all metadata fields in case noGGCRecords = 0
-        titles = []
-        creators = []
-        contributors = []
-        publishers = []
-        dates = []
-        subjectsBrinkman = []
-        annotations = []
-        identifiersURI = []
-        identifiersISBN = []
-        recordIdentifiersURI = []
-        collectionIdentifiers = []
+    titles = catalogueRecord["titles"]
+    creators = catalogueRecord["creators"]
+    contributors = catalogueRecord["contributors"]
+    publishers = catalogueRecord["publishers"]
+    dates = catalogueRecord["dates"]
+    subjectsBrinkman = catalogueRecord["subjectsBrinkman"]
+    annotations = catalogueRecord["annotations"]
+    identifiersURI = catalogueRecord["identifiersURI"]
+    identifiersISBN = catalogueRecord["identifiersISBN"]
 
     # Create MODS entries
 
@@ -6,10 +6,15 @@ SIP Creator for Offline Media Images.
 import sys
 import os
 import imp
+import socket
 import argparse
 import logging
 from . import config
+from . import checksums
+from . import fileio
+from .kbapi import sru
 from .batch import Batch
+from .context import RunContext
 
 # Bind raw_input (Python 3) to input (Python 2)
 # Source: http://stackoverflow.com/a/21731110/1209004
@@ -61,11 +66,188 @@ def checkFileExists(fileIn):
 def parseCommandLine():
     """Parse command-line arguments"""
 
+    # Parent parser with checksum and processing options that are shared by all commands
+
+    parser_checksums = argparse.ArgumentParser(add_help=False)
+
+    parser_checksums.add_argument('--rehash',
+                                  action='store_true',
+                                  dest='rehashFlag',
+                                  default=False,
+                                  help="ignore cached checksums and recalculate all checksums")
+
+    parser_checksums.add_argument('--hash-workers',
+                                  action='store',
+                                  type=int,
+                                  dest='hashWorkers',
+                                  default=1,
+                                  help="number of files that are hashed concurrently")
+
+    parser_checksums.add_argument('--jobs', '-j',
+                                  action='store',
+                                  type=int,
+                                  dest='jobs',
+                                  default=1,
+                                  help="number of PPNs that are processed concurrently \
+                         (in separate processes)")
+
+    parser_checksums.add_argument('--pipeline',
+                                  action='store_true',
+                                  dest='pipelineFlag',
+                                  default=False,
+                                  help="process PPNs in a staged pipeline that overlaps disk I/O, \
+                         CPU work and catalogue lookups (ignored if --jobs > 1)")
+
+    parser_checksums.add_argument('--io-workers',
+                                  action='store',
+                                  type=int,
+                                  dest='ioWorkers',
+                                  default=2,
+                                  help="number of carriers that are verified and copied \
+                         concurrently (pipeline only)")
+
+    parser_checksums.add_argument('--cpu-workers',
+                                  action='store',
+                                  type=int,
+                                  dest='cpuWorkers',
+                                  default=2,
+                                  help="number of PPNs for which metadata are extracted and \
+                         METS is built concurrently (pipeline only)")
+
+    parser_checksums.add_argument('--net-workers',
+                                  action='store',
+                                  type=int,
+                                  dest='netWorkers',
+                                  default=4,
+                                  help="number of concurrent catalogue lookups (pipeline, and \
+                         batched lookups at the start of a batch)")
+
+    parser_checksums.add_argument('--local-records',
+                                  action='store_true',
+                                  dest='localRecordsFlag',
+                                  default=False,
+                                  help="create MODS from the catalogue records in the \
+                         meta-kbmdo.xml files of the carriers; the catalogue is only \
+                         searched if these are missing or inconsistent")
+
+    parser_checksums.add_argument('--hash-backend',
+                                  action='store',
+                                  type=str,
+                                  choices=['auto'] + sorted(checksums.hashBackends),
+                                  dest='hashBackend',
+                                  default='auto',
+                                  help="method used for reading files while hashing \
+                         ('auto' selects the fastest available method)")
+
+    parser_checksums.add_argument('--io-mode',
+                                  action='store',
+                                  type=str,
+                                  choices=fileio.ioModes,
+                                  dest='ioMode',
+                                  default='buffered',
+                                  help="I/O mode for reading files: 'nocache' drops data \
+                         from the page cache after reading; 'direct' uses direct I/O")
+
+    parser_checksums.add_argument('--chunk-manifest',
+                                  action='store_true',
+                                  dest='chunkManifest',
+                                  default=False,
+                                  help="record digests of 64 MiB chunks of each file in the \
+                         checksum cache, so interrupted copies can be resumed")
+
+    # Parent parser with catalogue lookup options, shared by all commands that
+    # look up catalogue records
+
+    parser_catalogue = argparse.ArgumentParser(add_help=False)
+
+    parser_catalogue.add_argument('--catalogue-timeout',
+                                  action='store',
+                                  type=float,
+                                  dest='catalogueTimeout',
+                                  default=30,
+                                  help="timeout (in seconds) of each catalogue request")
+
+    parser_catalogue.add_argument('--catalogue-retries',
+                                  action='store',
+                                  type=int,
+                                  dest='catalogueRetries',
+                                  default=3,
+                                  help="number of times a failed catalogue request is retried \
+                         (with exponential backoff)")
+
+    parser_catalogue.add_argument('--catalogue-batch',
+                                  action='store',
+                                  type=int,
+                                  dest='catalogueBatchSize',
+                                  default=50,
+                                  help="number of PPNs that are looked up in the catalogue \
+                         with one request (1 disables batched lookups)")
+
+    parser_catalogue.add_argument('--catalogue-ttl',
+                                  action='store',
+                                  type=float,
+                                  dest='catalogueTTL',
+                                  default=24,
+                                  help="time (in hours) after which records in the catalogue \
+                         cache expire (0 disables the catalogue cache)")
+
+    # Parent parser with the location of the databases that are kept between runs,
+    # shared by all commands
+
+    parser_state = argparse.ArgumentParser(add_help=False)
+
+    parser_state.add_argument('--state-dir',
+                              action='store',
+                              type=str,
+                              dest='stateDir',
+                              default=None,
+                              help="directory for the checksum cache, the catalogue \
+                         cache and the work queue (default for write, worker and collect: \
+                         'dirOut.state' next to the output directory; otherwise no caches \
+                         are used). The input batch is never written to")
+
+    # Parent parser with options for writing SIPs, shared by write and worker commands
+
+    parser_sip = argparse.ArgumentParser(add_help=False)
+
+    parser_sip.add_argument('--readback', '-r',
+                            action='store_true',
+                            dest='readBackFlag',
+                            default=False,
+                            help="re-read copied files for post-copy checksum verification")
+
+    parser_sip.add_argument('--fixity',
+                            action='store',
+                            type=str,
+                            dest='fixity',
+                            default='',
+                            help="comma-separated list of additional fixity algorithms \
+                         for PREMIS (md5, sha1, sha256, sha384)")
+
+    parser_sip.add_argument('--copy-strategy',
+                            action='store',
+                            type=str,
+                            choices=sorted(checksums.copyStrategies),
+                            dest='copyStrategy',
+                            default='stream',
+                            help="method for copying files to the SIPs: 'stream' \
+                         hashes files while copying; 'reflink' and 'copy_file_range' \
+                         use fast file system copies if possible, and fall back to \
+                         'stream' otherwise")
+
+    parser_sip.add_argument('--compact-mets',
+                            action='store_true',
+                            dest='compactMetsFlag',
+                            default=False,
+                            help="write METS files without indentation")
+
     # Sub-parsers for check and write commands
 
     subparsers = parser.add_subparsers(help='sub-command help',
                                        dest='subcommand')
     parser_verify = subparsers.add_parser('verify',
+                                          parents=[parser_checksums, parser_catalogue,
+                                                   parser_state],
                                           help='only verify input batch without writing SIPs')
 
     parser_verify.add_argument('batchIn',
@@ -79,7 +261,16 @@ def parseCommandLine():
                                default=False,
                                help="skip checksum verification")
 
+    parser_verify.add_argument('--quick', '-q',
+                               action='store_true',
+                               dest='quickFlag',
+                               default=False,
+                               help="quick checksum verification: only re-read the first, \
+                         last and some random chunks of files that were fully hashed \
+                         before (implies --chunk-manifest)")
+
     parser_prune = subparsers.add_parser('prune',
+                                         parents=[parser_checksums, parser_catalogue, parser_state],
                                          help="verify input batch, then write 'pruned' version \
                          of batch that omits all PPNs that have errors. Write PPNs with \
                          errors to a separate batch.")
@@ -95,6 +286,8 @@ def parseCommandLine():
                               help="name of batch that will contain all PPNs with errors")
 
     parser_write = subparsers.add_parser('write',
+                                         parents=[parser_checksums, parser_catalogue, parser_sip,
+                                                  parser_state],
                                          help="verify input batch and write SIPs. Before using \
                          'write' first run the 'verify' command and fix any reported errors.")
 
@@ -108,6 +301,91 @@ def parseCommandLine():
                               type=str,
                               help="output directory where SIPs are written")
 
+    parser_write.add_argument('--resume',
+                              action='store_true',
+                              dest='resumeFlag',
+                              default=False,
+                              help="resume an interrupted write: keep existing dirOut, and \
+                         only copy data that are missing from (or bad in) the SIPs \
+                         (implies --chunk-manifest)")
+
+    parser_worker = subparsers.add_parser('worker',
+                                          parents=[parser_checksums, parser_catalogue, parser_sip,
+                                                   parser_state],
+                                          help="write SIPs for PPNs that are claimed from a work \
+                         queue in the state directory. Any number of workers (on one or \
+                         more machines that share the batch and output directories) can \
+                         process the same batch. Use the 'collect' command to report the \
+                         results. The work queue is an SQLite database, which relies on \
+                         file locking: on network file systems (NFS, SMB) this is not \
+                         always reliable, so check that the state directory is on a file \
+                         system with working locks.")
+
+    parser_worker.add_argument('batchIn',
+                               action="store",
+                               type=str,
+                               help="input batch")
+
+    parser_worker.add_argument('dirOut',
+                               action="store",
+                               type=str,
+                               help="output directory where SIPs are written (shared by all \
+                         workers)")
+
+    parser_worker.add_argument('--worker-id',
+                               action='store',
+                               type=str,
+                               dest='workerID',
+                               default=socket.gethostname() + "-" + str(os.getpid()),
+                               help="name of this worker (default: host name and process ID)")
+
+    parser_worker.add_argument('--lease',
+                               action='store',
+                               type=int,
+                               dest='leaseTime',
+                               default=300,
+                               help="lease time in seconds; a PPN whose worker did not renew \
+                         its lease within this time is claimed by another worker")
+
+    parser_prefetch = subparsers.add_parser('prefetch',
+                                            parents=[parser_catalogue, parser_state],
+                                            help="look up the catalogue records of all PPNs in \
+                         the batch manifest, and store them in the catalogue cache")
+
+    parser_prefetch.add_argument('batchIn',
+                                 action="store",
+                                 type=str,
+                                 help="input batch")
+
+    parser_collect = subparsers.add_parser('collect',
+                                           parents=[parser_state],
+                                           help="report merged results of all workers that \
+                         processed a batch")
+
+    parser_collect.add_argument('batchIn',
+                                action="store",
+                                type=str,
+                                help="input batch")
+
+    parser_collect.add_argument('dirOut',
+                                action="store",
+                                type=str,
+                                help="output directory of the workers")
+
+    parser_collect.add_argument('--wait', '-w',
+                                action='store_true',
+                                dest='waitFlag',
+                                default=False,
+                                help="wait until all PPNs are processed")
+
+    parser_collect.add_argument('--wait-timeout',
+                                action='store',
+                                type=int,
+                                dest='waitTimeout',
+                                default=600,
+                                help="with --wait, stop waiting if no worker has made \
+                         progress for this many seconds (default: 600)")
+
     parser.add_argument('--version', '-v',
                         action='version',
                         version=__version__)
@@ -137,59 +415,8 @@ def main():
     consoleHandler.setFormatter(logFormatter)
     logger.addHandler(consoleHandler)
 
-    # Controlled vocabulary for 'carrierType' field
-    config.carrierTypeAllowedValues = ['cd-rom',
-                                       'cd-audio',
-                                       'dvd-rom',
-                                       'dvd-video',
-                                       'cd-interactive',
-                                       'cd-extra',
-                                       'cd-mixedmode']
-
-    # Define name spaces for METS output
-    config.mets_ns = 'http://www.loc.gov/METS/'
-    config.mods_ns = 'http://www.loc.gov/mods/v3'
-    config.premis_ns = 'http://www.loc.gov/premis/v3'
-    config.ebucore_ns = 'urn:ebu:metadata-schema:ebucore'
-    config.isolyzer_ns = 'https://github.com/KBNLresearch/isolyzer'
-    config.cdInfo_ns = 'https://www.gnu.org/software/libcdio/libcdio.html#cd_002dinfo'  # TODO: is this a proper namespace?
-    config.dfxml_ns = 'http://www.forensicswiki.org/wiki/Category:Digital_Forensics_XML'
-    config.dc_ns = 'http://purl.org/dc/elements/1.1/'
-    config.hfs_ns ='http://www.forensicswiki.org/wiki/HFS'
-    config.xlink_ns = 'http://www.w3.org/1999/xlink'
-    config.xsi_ns = 'http://www.w3.org/2001/XMLSchema-instance'
-    config.metsSchema = 'http://www.loc.gov/METS/ http://www.loc.gov/standards/mets/mets.xsd'
-    config.modsSchema = 'http://www.loc.gov/mods/v3 https://www.loc.gov/standards/mods/v3/mods-3-4.xsd'
-    config.premisSchema = 'http://www.loc.gov/premis/v3 https://www.loc.gov/standards/premis/premis.xsd'
-    config.ebucoreSchema = 'https://raw.githubusercontent.com/ebu/ebucore/master/ebucore.xsd'
-
-    config.NSMAP = {"mets": config.mets_ns,
-                    "mods": config.mods_ns,
-                    "premis": config.premis_ns,
-                    "ebucore": config.ebucore_ns,
-                    "isolyzer": config.isolyzer_ns,
-                    "cd-info": config.cdInfo_ns,
-                    "dfxml": config.dfxml_ns,
-                    "dc": config.dc_ns,
-                    "hfs": config.hfs_ns,
-                    "xlink": config.xlink_ns,
-                    "xsi": config.xsi_ns}
-
-    # Counters for number of errors and warnings
-    config.errors = 0
-    config.warnings = 0
-
-    # List for storing failed PPN values (needed for pruning)
-    config.failedPPNs = []
-
-    # Flag that indicates if SIPs will be written
-    config.createSIPs = False
-
-    # Flag that indicates if prune option is used
-    config.pruneBatch = False
-
-    # Flag that indicates if checksum checking is skipped (prune mode only!)
-    config.skipChecksumFlag = False
+    # Settings and state of this run
+    context = RunContext()
 
     # Get input from command line
     args = parseCommandLine()
@@ -200,18 +427,70 @@ def main():
 
     batchDir = os.path.normpath(args.batchIn)
 
+    # Databases that are kept between runs are stored in the state directory; by
+    # default this is next to the output directory (if any), never in batchDir
+    if args.stateDir is not None:
+        context.stateDir = os.path.normpath(args.stateDir)
+    elif getattr(args, "dirOut", None) is not None:
+        context.stateDir = os.path.normpath(args.dirOut) + ".state"
+
+    if action == "collect":
+        Batch(batchDir, context).collect(args.waitFlag, args.waitTimeout)
+        return
+
+    context.catalogueBatchSize = max(args.catalogueBatchSize, 1)
+    context.catalogueTTL = max(args.catalogueTTL, 0) * 3600
+    # Catalogue client is shared by all threads of this process
+    sru.timeout = args.catalogueTimeout
+    sru.retries = max(args.catalogueRetries, 0)
+
+    if action == "prefetch":
+        Batch(batchDir, context).prefetch()
+        return
+
+    context.rehashFlag = args.rehashFlag
+    context.localRecordsFlag = args.localRecordsFlag
+    context.hashWorkers = max(args.hashWorkers, 1)
+    context.jobs = max(args.jobs, 1)
+    context.pipelineFlag = args.pipelineFlag
+    context.stageWorkers = {"io": max(args.ioWorkers, 1),
+                            "cpu": max(args.cpuWorkers, 1),
+                            "net": max(args.netWorkers, 1)}
+    sru.set_poolsize(max(context.stageWorkers["net"], 10))
+    context.hashBackendName = checksums.select_hash_backend(args.hashBackend)
+    context.ioMode = args.ioMode
+    context.chunkManifest = args.chunkManifest
+
     if action == "verify":
-        config.skipChecksumFlag = args.skipChecksumFlag
-    elif action == "write":
-        config.dirOut = os.path.normpath(args.dirOut)
-        config.createSIPs = True
+        context.skipChecksumFlag = args.skipChecksumFlag
+        context.quickFlag = args.quickFlag
+        if context.quickFlag:
+            if context.stateDir is None:
+                parser.error("--quick needs the chunk manifest in the checksum cache of " +
+                             "an earlier run, so --state-dir must be given")
+            context.chunkManifest = True
+    elif action in ["write", "worker"]:
+        context.dirOut = os.path.normpath(args.dirOut)
+        context.createSIPs = True
+        context.readBackFlag = args.readBackFlag
+        context.copyStrategy = args.copyStrategy
+        context.compactMetsFlag = args.compactMetsFlag
+        # Workers share the output directory, and resume PPNs that were left
+        # unfinished by a worker that crashed
+        context.resumeFlag = action == "worker" or args.resumeFlag
+        if context.resumeFlag:
+            context.chunkManifest = True
+        for algorithm in args.fixity.split(","):
+            algorithm = algorithm.strip().lower()
+            if algorithm == "":
+                continue
+            if algorithm not in checksums.algorithmNames:
+                parser.error("unsupported fixity algorithm '" + algorithm + "'")
+            if algorithm not in context.fixityAlgorithms:
+                context.fixityAlgorithms.append(algorithm)
     elif action == "prune":
-        config.batchErr = os.path.normpath(args.batchErr)
-        config.dirOut = None
-        config.pruneBatch = True
-    else:
-        # Dummy value
-        config.dirOut = None
+        context.batchErr = os.path.normpath(args.batchErr)
+        context.pruneBatch = True
 
     # Locate package directory
     packageDir = os.path.dirname(os.path.abspath(__file__))
@@ -227,13 +506,20 @@ def main():
     checkFileExists(config.mediaInfoExe)
 
     # Create Batch instance
-    thisBatch = Batch(batchDir)
+    thisBatch = Batch(batchDir, context)
+
+    # Complete any earlier prune that was interrupted
+    if context.pruneBatch:
+        thisBatch.rollForwardPrune()
 
     # Process batch
+    if action == "worker":
+        thisBatch.work(args.workerID, max(args.leaseTime, 1))
+        return
     thisBatch.process()
 
     # Start pruning if prune command was issued
-    if config.pruneBatch and config.failedPPNs != []:
+    if context.pruneBatch and context.failedPPNs:
         thisBatch.prune()
 
 
@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+"""
+Worker pools for the stages of the staged processing pipeline
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Pipeline stages: disk I/O (verifying checksums, hashing and copying files),
+# CPU (parsing logs and reports, isolyzer, MediaInfo, building METS) and
+# network (catalogue lookups)
+stages = ["io", "cpu", "net"]
+
+
+class StagePools:
+    """Bounded worker pools for the stages of the pipeline; the number of workers
+    of each stage is set by context.stageWorkers. Each pool has its own task queue,
+    so work of one stage never waits for a free worker of another stage
+    """
+    def __init__(self, context):
+        """Initialise StagePools class instance"""
+        self.executors = {}
+        for stage in stages:
+            self.executors[stage] = ThreadPoolExecutor(
+                max_workers=max(context.stageWorkers[stage], 1),
+                thread_name_prefix="omSipCreator-" + stage)
+
+        # Maximum number of PPNs in the pipeline at the same time; this bounds
+        # the queues, and is enough to keep the I/O and CPU stages busy
+        self.depth = max(context.stageWorkers["io"] + context.stageWorkers["cpu"], 1)
+
+        # List to which log records of the current thread are added, and list of
+        # such lists of the PPN it works on (see collectLog)
+        self.local = threading.local()
+
+    @contextmanager
+    def collectLog(self, segments):
+        """Context manager that collects the log records of the current thread,
+        and of all tasks that it submits, in segments (a list with a list of
+        records for this thread, followed by one for each task in the order of
+        submission), so the log output of a PPN can be written in one piece
+        """
+        records = []
+        segments.append(records)
+        self.local.records = records
+        self.local.segments = segments
+        try:
+            yield
+        finally:
+            self.local.records = None
+            self.local.segments = None
+
+    def submit(self, stage, function, *args):
+        """Submit function(*args) to the pool of stage, and return its future"""
+        segments = getattr(self.local, "segments", None)
+        records = None
+        if segments is not None:
+            records = []
+            segments.append(records)
+        return self.executors[stage].submit(self.run, records, function, *args)
+
+    def run(self, records, function, *args):
+        """Run function(*args), and add log records of this thread to records"""
+        self.local.records = records
+        try:
+            return function(*args)
+        finally:
+            self.local.records = None
+
+    def shutdown(self, cancel=False):
+        """Wait until all pools are finished. If cancel is True, queued tasks that
+        did not start yet are cancelled. The I/O and network pools are shut down
+        first, as tasks in the CPU pool wait for their results
+        """
+        for stage in ["io", "net", "cpu"]:
+            self.executors[stage].shutdown(wait=True, cancel_futures=cancel)
+
+
+class LogCollector(logging.Handler):
+    """Log handler that replaces the handlers of the root logger while a StagePools
+    instance is used. Records of threads that collect their log (see
+    StagePools.collectLog) are added to their list; all other records are passed
+    on to the original handlers
+    """
+    def __init__(self, stagePools):
+        """Initialise LogCollector class instance, and install it"""
+        logging.Handler.__init__(self)
+        self.stagePools = stagePools
+        self.logger = logging.getLogger()
+        self.handlers = self.logger.handlers[:]
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(self)
+
+    def emit(self, record):
+        """Add record to list of current thread, or pass it on"""
+        records = getattr(self.stagePools.local, "records", None)
+        if records is not None:
+            records.append(record)
+        else:
+            self.passOn(record)
+
+    def passOn(self, record):
+        """Pass record on to the original handlers"""
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def write(self, segments):
+        """Pass on collected records of segments (see StagePools.collectLog)"""
+        for records in segments:
+            for record in records:
+                self.passOn(record)
+            del records[:]
+
+    def remove(self):
+        """Restore the original handlers of the root logger"""
+        self.logger.removeHandler(self)
+        for handler in self.handlers:
+            self.logger.addHandler(handler)
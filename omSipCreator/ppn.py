@@ -11,16 +11,20 @@ from itertools import groupby
 from lxml import etree
 from . import config
 from .carrier import Carrier
+from .metswriter import MetsWriter
 from .shared import errorExit
 from .mods import createMODS
+from .mods import getCatalogueRecord
+from .mods import getLocalCatalogueRecord
 
 
 # PPN class
 
 class PPN:
     """PPN class"""
-    def __init__(self, PPNValue):
+    def __init__(self, PPNValue, context):
         """initialise PPN class instance"""
+        self.context = context
         self.carriers = []
         self.PPN = PPNValue
         self.carrierTypes = []
@@ -36,70 +40,96 @@ class PPN:
         # PPN is PPN identifier (by which we grouped data)
         # carriers is another iterator that contains individual carrier records
 
-        # Create METS element for this SIP
-        metsName = etree.QName(config.mets_ns, "mets")
-        mets = etree.Element(metsName, nsmap=config.NSMAP)
-        # Add schema reference
-        mets.attrib[etree.QName(config.xsi_ns, "schemaLocation")] = "".join(
-            [config.metsSchema, " ", config.modsSchema, " ", config.premisSchema])
-        # Add TYPE attribute
-        mets.attrib["TYPE"] = "SIP"
-        # Subelements for dmdSec, amdSec, fileSec and structMap
-        # dmdSec
-        dmdSec = etree.SubElement(mets, "{%s}dmdSec" % (config.mets_ns))
-        # Add identifier
-        dmdSecID = "dmdSec_1"
-        dmdSec.attrib["ID"] = dmdSecID
-        # Create mdWrap and xmlData child elements
-        mdWrapDmd = etree.SubElement(dmdSec, "{%s}mdWrap" % (config.mets_ns))
-        mdWrapDmd.attrib["MDTYPE"] = "MODS"
-        mdWrapDmd.attrib["MDTYPEVERSION"] = "3.4"
-        xmlDataDmd = etree.SubElement(mdWrapDmd, "{%s}xmlData" % (config.mets_ns))
-        # amdSec
-        amdSec = etree.SubElement(mets, "{%s}amdSec" % (config.mets_ns))
-        # Add identifier
-        amdSecID = "amdSec_1"
-        amdSec.attrib["ID"] = amdSecID
-
-        # Create fileSec and structMap elements
-        fileSec = etree.SubElement(mets, "{%s}fileSec" % (config.mets_ns))
-        fileGrp = etree.SubElement(fileSec, "{%s}fileGrp" % (config.mets_ns))
-        structMap = etree.SubElement(mets, "{%s}structMap" % (config.mets_ns))
-        # Add top-level divisor element to structMap
-        structDivTop = etree.SubElement(structMap, "{%s}div" % (config.mets_ns))
-        structDivTop.attrib["TYPE"] = "physical"
-        structDivTop.attrib["LABEL"] = "volumes"
-        structDivTop.attrib["DMDID"] = dmdSecID
+        self.prepare()
+
+        for thisCarrier, carrier in self.readCarriers(carriers, batchDir, colsBatchManifest):
+            self.context.checkLease()
+            thisCarrier.processFiles(self.dirSIP)
+            self.addCarrier(thisCarrier, carrier, colsBatchManifest)
+
+        # Get metadata of this PPN from carriers or catalogue
+        self.finish(self.getRecord())
+
+    def submit(self, stages, carriers, batchDir, colsBatchManifest):
+        """Submit processing of a PPN to the worker pools of a StagePools instance,
+        and return future of the last stage. The catalogue lookup (network stage,
+        not used with local records) and the verification and copying of the
+        carriers (I/O stage) run concurrently; metadata of the carriers are then added in carrier order
+        (CPU stage), so identifiers in the METS are the same as with process
+        """
+        self.prepare()
+        carriersPPN = list(self.readCarriers(carriers, batchDir, colsBatchManifest))
+
+        recordFuture = None
+        if not self.context.localRecordsFlag:
+            recordFuture = stages.submit("net", getCatalogueRecord, self.context, self.PPN)
+        filesFutures = [stages.submit("io", thisCarrier.processFiles, self.dirSIP)
+                        for thisCarrier, carrier in carriersPPN]
+        return stages.submit("cpu", self.complete, carriersPPN, filesFutures,
+                             recordFuture, colsBatchManifest)
+
+    def complete(self, carriersPPN, filesFutures, recordFuture, colsBatchManifest):
+        """Add metadata of each carrier once its I/O stage is finished, and
+        write METS (CPU stage of submit)"""
+        for (thisCarrier, carrier), filesFuture in zip(carriersPPN, filesFutures):
+            filesFuture.result()
+            self.addCarrier(thisCarrier, carrier, colsBatchManifest)
+        self.finish(self.getRecord(recordFuture))
+
+    def getRecord(self, recordFuture=None):
+        """Return catalogue metadata of this PPN. With local records these are taken
+        from the meta-kbmdo.xml files of the carriers, unless these are missing or
+        inconsistent. Otherwise the result of recordFuture (a pending catalogue
+        lookup) is used if given, and else the record is looked up in the catalogue
+        """
+        if self.context.localRecordsFlag:
+            catalogueRecord = getLocalCatalogueRecord(self.context, self.PPN, self.carriers)
+            if catalogueRecord is not None:
+                return catalogueRecord
+            logging.info("PPN " + self.PPN + ": no usable catalogue record in " +
+                         "meta-kbmdo.xml, looking up record in catalogue")
+        if recordFuture is not None:
+            return recordFuture.result()
+        return getCatalogueRecord(self.context, self.PPN)
+
+    def prepare(self):
+        """Set up METS writer and create SIP directory"""
 
         # Initialise counters that are used to assign file and carrier-level IDs
-        sipFileCounterStart = 1
-        counterTechMDStart = 1
-        carrierCounter = 1
-        counterDigiprovMD = 1
+        self.sipFileCounterStart = 1
+        self.counterTechMDStart = 1
+        self.carrierCounter = 1
+        self.counterDigiprovMD = 1
 
         # Dummy value for dirSIP (needed if createSIPs = False)
-        dirSIP = "rubbish"
+        self.dirSIP = "rubbish"
 
-        if config.createSIPs:
+        if self.context.createSIPs:
             logging.info("creating SIP directory")
             # Create SIP directory
-            dirSIP = os.path.join(config.dirOut, self.PPN)
+            self.dirSIP = os.path.join(self.context.dirOut, self.PPN)
             try:
-                os.makedirs(dirSIP)
+                os.makedirs(self.dirSIP, exist_ok=self.context.resumeFlag)
             except OSError:
-                logging.fatal("cannot create '" + dirSIP + "'")
-                config.errors += 1
-                errorExit(config.errors, config.warnings)
+                logging.fatal("cannot create '" + self.dirSIP + "'")
+                self.context.addError()
+                errorExit(self.context.errors, self.context.warnings)
+
+        # METS file is only written if SIPs are created
+        metsFname = None
+        if self.context.createSIPs:
+            metsFname = os.path.join(self.dirSIP, "mets.xml")
+        self.metsWriter = MetsWriter(metsFname, not self.context.compactMetsFlag)
 
         # Set up lists for all record fields in this PPN (needed for verifification only)
-        jobIDs = []
-        volumeNumbers = []
-        carrierTypes = []
+        self.jobIDs = []
+        self.volumeNumbers = []
+        self.carrierTypesManifest = []
 
-        # Set up list that will is used to collect all representation-level techMD and
-        # digiProv elements for all carriers within PPN
-        techMDRepElements = []
-        digiProvElements = []
+    def readCarriers(self, carriers, batchDir, colsBatchManifest):
+        """Generator that yields a (Carrier instance, batch manifest record) tuple
+        for each carrier record, sorted by carrier type
+        """
 
         # Convert to list (needed because othwerwise we can't sort)
         carriers = list(carriers)
@@ -112,22 +142,9 @@ class PPN:
 
                 jobID = carrier[colsBatchManifest["jobID"]]
                 volumeNumber = carrier[colsBatchManifest["volumeNo"]]
-                title = carrier[colsBatchManifest["title"]]
-                volumeID = carrier[colsBatchManifest["volumeID"]]
-                success = carrier[colsBatchManifest["success"]]
-                containsAudio = carrier[colsBatchManifest["containsAudio"]]
-                containsData = carrier[colsBatchManifest["containsData"]]
-                cdExtra = carrier[colsBatchManifest["cdExtra"]]
-
-                if config.iromlabMajorVersion == 1:
-                    mixedMode = carrier[colsBatchManifest["mixedMode"]]
-                    cdInteractive = carrier[colsBatchManifest["cdInteractive"]]
-                else:
-                    mixedMode = "False"
-                    cdInteractive = "False"
 
                 # Update jobIDs list
-                jobIDs.append(jobID)
+                self.jobIDs.append(jobID)
 
                 # Check for some obvious errors
 
@@ -138,198 +155,211 @@ class PPN:
                 imagePathAbs = os.path.abspath(imagePathFull)
 
                 # Append absolute path to list (used later for completeness check)
-                config.dirsInMetaCarriers.append(imagePathAbs)
+                self.context.addDirInMetaCarriers(imagePathAbs)
 
                 if not os.path.isdir(imagePathFull):
                     logging.error("jobID " + jobID + ": '" + imagePathFull +
                                   "' is not a directory")
-                    config.errors += 1
-                    config.failedPPNs.append(self.PPN)
-                
+                    self.context.addError(self.PPN)
+
                 # Create Carrier class instance for this carrier
                 thisCarrier = Carrier(jobID, self.PPN, imagePathFull,
-                                      volumeNumber)
-
-                # Process carrier
-                sipFileCounter, counterTechMD = thisCarrier.process(dirSIP,
-                                                                    sipFileCounterStart,
-                                                                    counterTechMDStart)
-
-                # Set carrierType value, based on Isobuster carrier type and info read
-                # from batch manifest. TODO: could be more fine-grained for CD-Extra,
-                # cd-i, etc.
-
-                if thisCarrier.isobusterCarrierType == "DVD":
-                    # TODO:
-                    # 1. Check if value reported by Isobuster is really "DVD" 
-                    # 2. Update resourceTypeMap in mods.py, which also contains dvd-video.
-                    #    Probably better to merge both in one generic dvd class
-                    carrierType = "dvd-rom"
-                elif cdInteractive == "True":
-                    carrierType = "cd-interactive"
-                elif cdExtra == "True":
-                    # TODO: vaguely recall cd-info flagging mixed mode CDs as cd-extra as well,
-                    # or vice versa. If so needs additional exclusion here.
-                    carrierType = "cd-extra"
-                elif mixedMode == "True":
-                    # TODO: vaguely recall cd-info flagging mixed mode CDs as cd-extra as well,
-                    # or vice versa. If so needs additional exclusion here.
-                    carrierType = "cd-mixedmode"
-                elif containsData == "True":
-                    carrierType = "cd-rom"
-                elif containsAudio == "True":
-                    carrierType = "cd-audio"
-                else:
-                    # Bogus value, needed below
-                    carrierType = "unknown"
- 
-                # Append file elements to fileGrp
-                for fileElement in thisCarrier.fileElements:
-                    fileGrp.append(fileElement)
-
-                # Create carrier-level METS div entry
-                divDiscName = etree.QName(config.mets_ns, "div")
-                divDisc = etree.Element(divDiscName, nsmap=config.NSMAP)
-                divDisc.attrib["TYPE"] = carrierType
-                divDisc.attrib["ORDER"] = thisCarrier.volumeNumber
-
-                # Construct unique identifiers for digiProvMD and techMD (see below)
-                # and add to divDisc as ADMID
-                digiProvID = "digiprovMD_" + str(counterDigiprovMD)
-                techID = "techMD_" + str(counterTechMD)
-                divDisc.attrib["ADMID"] = " ".join([digiProvID, techID])
-
-                # Append file-level div elements to carrier-level div element
-                for divFile in thisCarrier.divFileElements:
-                    divDisc.append(divFile)
-
-                # Update structmap in METS
-                structDivTop.append(divDisc)
-
-                # Append file-level techMD elements to amdSec
-                for techMD in thisCarrier.techMDFileElements:
-                    amdSec.append(techMD)
-
-                counterTechMD += 1
-
-                # Create representation-level techMD, digiprovMD, mdWrap and xmlData
-                # child elements
-                techMDRepName = etree.QName(config.mets_ns, "techMD")
-                techMDRep = etree.Element(techMDRepName, nsmap=config.NSMAP)
-                techMDRep.attrib["ID"] = techID
-                mdWrapTechMDRep = etree.SubElement(
-                    techMDRep, "{%s}mdWrap" % (config.mets_ns))
-                mdWrapTechMDRep.attrib["MIMETYPE"] = "text/xml"
-                mdWrapTechMDRep.attrib["MDTYPE"] = "OTHER"
-                mdWrapTechMDRep.attrib["OTHERMDTYPE"] = "cd-info output"
-                xmlDatatechMDRep = etree.SubElement(
-                    mdWrapTechMDRep, "{%s}xmlData" % (config.mets_ns))
-                xmlDatatechMDRep.append(thisCarrier.cdInfoElt)
-
-                digiprovMDName = etree.QName(config.mets_ns, "digiprovMD")
-                digiprovMD = etree.Element(digiprovMDName, nsmap=config.NSMAP)
-                digiprovMD.attrib["ID"] = digiProvID
-                mdWrapdigiprov = etree.SubElement(
-                    digiprovMD, "{%s}mdWrap" % (config.mets_ns))
-                mdWrapdigiprov.attrib["MIMETYPE"] = "text/xml"
-                mdWrapdigiprov.attrib["MDTYPE"] = "PREMIS:EVENT"
-                mdWrapdigiprov.attrib["MDTYPEVERSION"] = "3.0"
-                xmlDatadigiprov = etree.SubElement(
-                    mdWrapdigiprov, "{%s}xmlData" % (config.mets_ns))
-
-                # Append PREMIS events that were returned by ProcessCarrier
-                for premisEvent in thisCarrier.premisCreationEvents:
-                    xmlDatadigiprov.append(premisEvent)
-
-                techMDRepElements.append(techMDRep)
-                digiProvElements.append(digiprovMD)
-
-                # Add to PPNGroup class instance
-                self.append(thisCarrier)
-
-                # Update counters
-                sipFileCounterStart = sipFileCounter
-                counterTechMDStart = counterTechMD
-                carrierCounter += 1
-                counterDigiprovMD += 1
-
-                # convert volumeNumber to integer (so we can do more checking below)
-                try:
-                    volumeNumbers.append(int(volumeNumber))
-                except ValueError:
-                    # Raises error if volumeNumber string doesn't represent integer
-                    logging.error("jobID " + jobID + ": '" + volumeNumber +
-                                  "' is illegal value for 'volumeNumber' (must be integer)")
-                    config.errors += 1
-                    config.failedPPNs.append(self.PPN)
-
-                # Check carrierType value against controlled vocabulary
-                if carrierType not in config.carrierTypeAllowedValues:
-                    logging.error("jobID " + jobID + ": '" + carrierType +
-                                  "' is illegal value for 'carrierType'")
-                    config.errors += 1
-                    config.failedPPNs.append(self.PPN)
-                carrierTypes.append(carrierType)
-
-                # Check success value (status)
-                if success != "True":
-                    logging.error("jobID " + jobID +
-                                  ": value of 'success' not 'True'")
-                    config.errors += 1
-                    config.failedPPNs.append(self.PPN)
-
-                # Check if carrierType value is consistent with containsAudio and containsData
-                if carrierType in ["cd-rom", "dvd-rom", "dvd-video"] and containsData != "True":
-                    logging.error("jobID " + jobID + ": carrierType cannot be '" +
-                                  carrierType + "'if 'containsData' is 'False'")
-                    config.errors += 1
-                    config.failedPPNs.append(self.PPN)
-                elif carrierType == "cd-audio" and containsAudio != "True":
-                    logging.error("jobID " + jobID + ": carrierType cannot be '" +
-                                  carrierType + "'if 'containsAudio' is 'False'")
-                    config.errors += 1
-                    config.failedPPNs.append(self.PPN)
-
-
-        # Get metadata of this PPN from catalogue and convert to MODS format
-        mdMODS = createMODS(self)
-
-        # Append metadata to METS
-        xmlDataDmd.append(mdMODS)
-
-        # Append techMD and digiProvMD elements to amdSec
-        for element in techMDRepElements:
-            amdSec.append(element)
-        for element in digiProvElements:
-            amdSec.append(element)
-
-        if config.createSIPs:
+                                      volumeNumber, self.context)
+
+                yield thisCarrier, carrier
+
+    def addCarrier(self, thisCarrier, carrier, colsBatchManifest):
+        """Add metadata of carrier (after its files were processed) to METS"""
+
+        jobID = carrier[colsBatchManifest["jobID"]]
+        volumeNumber = carrier[colsBatchManifest["volumeNo"]]
+        title = carrier[colsBatchManifest["title"]]
+        volumeID = carrier[colsBatchManifest["volumeID"]]
+        success = carrier[colsBatchManifest["success"]]
+        containsAudio = carrier[colsBatchManifest["containsAudio"]]
+        containsData = carrier[colsBatchManifest["containsData"]]
+        cdExtra = carrier[colsBatchManifest["cdExtra"]]
+
+        if self.context.iromlabMajorVersion == 1:
+            mixedMode = carrier[colsBatchManifest["mixedMode"]]
+            cdInteractive = carrier[colsBatchManifest["cdInteractive"]]
+        else:
+            mixedMode = "False"
+            cdInteractive = "False"
+
+        # Process carrier metadata
+        sipFileCounter, counterTechMD = thisCarrier.processMetadata(self.sipFileCounterStart,
+                                                                    self.counterTechMDStart)
+
+        # Set carrierType value, based on Isobuster carrier type and info read
+        # from batch manifest. TODO: could be more fine-grained for CD-Extra,
+        # cd-i, etc.
+
+        if thisCarrier.isobusterCarrierType == "DVD":
+            # TODO:
+            # 1. Check if value reported by Isobuster is really "DVD"
+            # 2. Update resourceTypeMap in mods.py, which also contains dvd-video.
+            #    Probably better to merge both in one generic dvd class
+            carrierType = "dvd-rom"
+        elif cdInteractive == "True":
+            carrierType = "cd-interactive"
+        elif cdExtra == "True":
+            # TODO: vaguely recall cd-info flagging mixed mode CDs as cd-extra as well,
+            # or vice versa. If so needs additional exclusion here.
+            carrierType = "cd-extra"
+        elif mixedMode == "True":
+            # TODO: vaguely recall cd-info flagging mixed mode CDs as cd-extra as well,
+            # or vice versa. If so needs additional exclusion here.
+            carrierType = "cd-mixedmode"
+        elif containsData == "True":
+            carrierType = "cd-rom"
+        elif containsAudio == "True":
+            carrierType = "cd-audio"
+        else:
+            # Bogus value, needed below
+            carrierType = "unknown"
+
+        # Add file elements to fileGrp
+        for fileElement in thisCarrier.fileElements:
+            self.metsWriter.add("file", fileElement)
+
+        # Create carrier-level METS div entry
+        divDiscName = etree.QName(config.mets_ns, "div")
+        divDisc = etree.Element(divDiscName, nsmap=config.NSMAP)
+        divDisc.attrib["TYPE"] = carrierType
+        divDisc.attrib["ORDER"] = thisCarrier.volumeNumber
+
+        # Construct unique identifiers for digiProvMD and techMD (see below)
+        # and add to divDisc as ADMID
+        digiProvID = "digiprovMD_" + str(self.counterDigiprovMD)
+        techID = "techMD_" + str(counterTechMD)
+        divDisc.attrib["ADMID"] = " ".join([digiProvID, techID])
+
+        # Append file-level div elements to carrier-level div element
+        for divFile in thisCarrier.divFileElements:
+            divDisc.append(divFile)
+
+        # Update structmap in METS
+        self.metsWriter.add("div", divDisc)
+
+        # Add file-level techMD elements to amdSec
+        for techMD in thisCarrier.techMDFileElements:
+            self.metsWriter.add("techMDFile", techMD)
+
+        counterTechMD += 1
+
+        # Create representation-level techMD, digiprovMD, mdWrap and xmlData
+        # child elements
+        techMDRepName = etree.QName(config.mets_ns, "techMD")
+        techMDRep = etree.Element(techMDRepName, nsmap=config.NSMAP)
+        techMDRep.attrib["ID"] = techID
+        mdWrapTechMDRep = etree.SubElement(
+            techMDRep, "{%s}mdWrap" % (config.mets_ns))
+        mdWrapTechMDRep.attrib["MIMETYPE"] = "text/xml"
+        mdWrapTechMDRep.attrib["MDTYPE"] = "OTHER"
+        mdWrapTechMDRep.attrib["OTHERMDTYPE"] = "cd-info output"
+        xmlDatatechMDRep = etree.SubElement(
+            mdWrapTechMDRep, "{%s}xmlData" % (config.mets_ns))
+        xmlDatatechMDRep.append(thisCarrier.cdInfoElt)
+
+        digiprovMDName = etree.QName(config.mets_ns, "digiprovMD")
+        digiprovMD = etree.Element(digiprovMDName, nsmap=config.NSMAP)
+        digiprovMD.attrib["ID"] = digiProvID
+        mdWrapdigiprov = etree.SubElement(
+            digiprovMD, "{%s}mdWrap" % (config.mets_ns))
+        mdWrapdigiprov.attrib["MIMETYPE"] = "text/xml"
+        mdWrapdigiprov.attrib["MDTYPE"] = "PREMIS:EVENT"
+        mdWrapdigiprov.attrib["MDTYPEVERSION"] = "3.0"
+        xmlDatadigiprov = etree.SubElement(
+            mdWrapdigiprov, "{%s}xmlData" % (config.mets_ns))
+
+        # Append PREMIS events that were returned by ProcessCarrier
+        for premisEvent in thisCarrier.premisCreationEvents:
+            xmlDatadigiprov.append(premisEvent)
+
+        # Representation-level techMD and digiprovMD elements follow the file-level
+        # techMD elements of all carriers in amdSec
+        self.metsWriter.add("techMDRep", techMDRep)
+        self.metsWriter.add("digiprovMD", digiprovMD)
+
+        # Element trees of the carrier are written to the METS writer, and are
+        # no longer needed
+        thisCarrier.releaseElements()
+
+        # Add to PPNGroup class instance
+        self.append(thisCarrier)
+
+        # Update counters
+        self.sipFileCounterStart = sipFileCounter
+        self.counterTechMDStart = counterTechMD
+        self.carrierCounter += 1
+        self.counterDigiprovMD += 1
+
+        # convert volumeNumber to integer (so we can do more checking below)
+        try:
+            self.volumeNumbers.append(int(volumeNumber))
+        except ValueError:
+            # Raises error if volumeNumber string doesn't represent integer
+            logging.error("jobID " + jobID + ": '" + volumeNumber +
+                          "' is illegal value for 'volumeNumber' (must be integer)")
+            self.context.addError(self.PPN)
+
+        # Check carrierType value against controlled vocabulary
+        if carrierType not in config.carrierTypeAllowedValues:
+            logging.error("jobID " + jobID + ": '" + carrierType +
+                          "' is illegal value for 'carrierType'")
+            self.context.addError(self.PPN)
+        self.carrierTypesManifest.append(carrierType)
+
+        # Check success value (status)
+        if success != "True":
+            logging.error("jobID " + jobID +
+                          ": value of 'success' not 'True'")
+            self.context.addError(self.PPN)
+
+        # Check if carrierType value is consistent with containsAudio and containsData
+        if carrierType in ["cd-rom", "dvd-rom", "dvd-video"] and containsData != "True":
+            logging.error("jobID " + jobID + ": carrierType cannot be '" +
+                          carrierType + "'if 'containsData' is 'False'")
+            self.context.addError(self.PPN)
+        elif carrierType == "cd-audio" and containsAudio != "True":
+            logging.error("jobID " + jobID + ": carrierType cannot be '" +
+                          carrierType + "'if 'containsAudio' is 'False'")
+            self.context.addError(self.PPN)
+
+    def finish(self, catalogueRecord):
+        """Write METS, with MODS created from catalogueRecord, and do IP-level
+        consistency checks"""
+
+        # Convert catalogue metadata to MODS format
+        mdMODS = createMODS(self, catalogueRecord)
+
+        # Write METS file (only if SIPs are created)
+        self.context.checkLease()
+        if self.context.createSIPs:
             logging.info("writing METS file")
-            metsAsString = etree.tostring(
-                mets, pretty_print=True, encoding="unicode")
-            metsFname = os.path.join(dirSIP, "mets.xml")
-
-            with open(metsFname, "w", encoding="utf-8") as text_file:
-                text_file.write(metsAsString)
+        self.metsWriter.write(mdMODS)
 
         # IP-level consistency checks
 
+        # Carrier type of last carrier (used in messages below)
+        carrierType = self.carrierTypesManifest[-1]
+
         # jobID values must all be unique (no duplicates!)
-        uniquejobIDs = set(jobIDs)
-        if len(uniquejobIDs) != len(jobIDs):
+        uniquejobIDs = set(self.jobIDs)
+        if len(uniquejobIDs) != len(self.jobIDs):
             logging.error("PPN " + self.PPN + ": duplicate values found for 'jobID'")
-            config.errors += 1
-            config.failedPPNs.append(self.PPN)
+            self.context.addError(self.PPN)
 
         # Consistency checks on volumeNumber values
+        volumeNumbers = self.volumeNumbers
 
         # Volume numbers must be unique
         uniqueVolumeNumbers = set(volumeNumbers)
         if len(uniqueVolumeNumbers) != len(volumeNumbers):
             logging.error("PPN " + self.PPN + " (" + carrierType +
                           "): duplicate values found for 'volumeNumber'")
-            config.errors += 1
-            config.failedPPNs.append(self.PPN)
+            self.context.addError(self.PPN)
 
         # Report warning if lower value of volumeNumber not equal to '1'
         volumeNumbers.sort()
@@ -337,7 +367,7 @@ class PPN:
             logging.warning("PPN " + self.PPN + " (" + carrierType +
                             "): expected '1' as lower value for 'volumeNumber', found '" +
                             str(volumeNumbers[0]) + "'")
-            config.warnings += 1
+            self.context.addWarning()
 
         # Report warning if volumeNumber does not contain consecutive numbers
         # (indicates either missing volumes or data entry error)
@@ -346,4 +376,4 @@ class PPN:
                                                         max(volumeNumbers) + 1)):
             logging.warning("PPN " + self.PPN + " (" + carrierType +
                             "): values for 'volumeNumber' are not consecutive")
-            config.warnings += 1
+            self.context.addWarning()
@@ -14,24 +14,22 @@ from lxml import etree
 from isolyzer import isolyzer
 from . import config
 from .mdaudio import getAudioMetadata
+from .checksums import algorithmNames
 from .shared import makeHumanReadable
 from .shared import add_ns_prefix
+from .templates import ElementTemplate
 
 
-def addCreationEvent(log):
-
-    """Generate creation event using info from log file of creation application"""
-
-    # Read contents of log to a text string
-    with io.open(log, "r", encoding="utf-8") as fLog:
-        logContents = fLog.read()
-    fLog.close()
+def createEventTemplate():
+    """Return template for PREMIS creation event; the slots are the
+    eventIdentifierValue, eventDateTime, eventDetail, eventOutcomeDetail,
+    eventOutcomeDetailNote and linkingAgentIdentifierValue elements"""
 
     # Create PREMIS creation event
     eventName = etree.QName(config.premis_ns, "event")
     event = etree.Element(eventName, nsmap=config.NSMAP)
 
-    # Event identifier: UUID, based on host ID and current time
+    # Event identifier: UUID
     eventIdentifier = etree.SubElement(
         event, "{%s}eventIdentifier" % (config.premis_ns))
     eventIdentifierType = etree.SubElement(
@@ -39,22 +37,14 @@ def addCreationEvent(log):
     eventIdentifierType.text = "UUID"
     eventIdentifierValue = etree.SubElement(
         eventIdentifier, "{%s}eventIdentifierValue" % (config.premis_ns))
-    eventIdentifierValue.text = str(uuid.uuid1())
 
     # Event type
     eventType = etree.SubElement(event, "{%s}eventType" % (config.premis_ns))
     eventType.text = "creation"
 
-    # Event date/time: taken from timestamp of log file (last-modified)
-    eventDateTimeValue = datetime.fromtimestamp(os.path.getctime(log))
-    # Add time zone info
-    pst = pytz.timezone('Europe/Amsterdam')
-    eventDateTimeValue = pst.localize(eventDateTimeValue)
-    eventDateTimeFormatted = eventDateTimeValue.isoformat()
-
+    # Event date/time
     eventDateTime = etree.SubElement(
         event, "{%s}eventDateTime" % (config.premis_ns))
-    eventDateTime.text = eventDateTimeFormatted
 
     # eventDetailInformation container with eventDetail element
     eventDetailInformation = etree.SubElement(
@@ -76,11 +66,137 @@ def addCreationEvent(log):
     linkingAgentIdentifierType = etree.SubElement(
         linkingAgentIdentifier, "{%s}linkingAgentIdentifierType" % (config.premis_ns))
     linkingAgentIdentifierType.text = "URI"
-
-    # Values of linkingAgentIdentifierValue and agentName are set further below
     linkingAgentIdentifierValue = etree.SubElement(
         linkingAgentIdentifier, "{%s}linkingAgentIdentifierValue" % (config.premis_ns))
 
+    return ElementTemplate(event, [eventIdentifierValue, eventDateTime, eventDetail,
+                                   eventOutcomeDetail, eventOutcomeDetailNote,
+                                   linkingAgentIdentifierValue])
+
+
+def createObjectTemplate():
+    """Return template for PREMIS object instance; the slots are the
+    objectIdentifierValue, objectCharacteristics, messageDigest (SHA-512), size,
+    formatName, formatRegistryKey, objectCharacteristicsExtension and originalName
+    elements"""
+
+    # Create PREMIS object instance
+    objectName = etree.QName(config.premis_ns, "object")
+    pObject = etree.Element(objectName, nsmap=config.NSMAP)
+    pObject.attrib["{%s}type" % config.xsi_ns] = "premis:file"
+
+    # Object identifier
+    objectIdentifier = etree.SubElement(
+        pObject, "{%s}objectIdentifier" % (config.premis_ns))
+    objectIdentifierType = etree.SubElement(
+        objectIdentifier, "{%s}objectIdentifierType" % (config.premis_ns))
+    objectIdentifierType.text = "UUID"
+    objectIdentifierValue = etree.SubElement(
+        objectIdentifier, "{%s}objectIdentifierValue" % (config.premis_ns))
+
+    # Object characteristics
+    objectCharacteristics = etree.SubElement(
+        pObject, "{%s}objectCharacteristics" % (config.premis_ns))
+    compositionLevel = etree.SubElement(
+        objectCharacteristics, "{%s}compositionLevel" % (config.premis_ns))
+    compositionLevel.text = "0"
+
+    # Fixity element for SHA-512 checksum
+    fixity1 = etree.SubElement(
+        objectCharacteristics, "{%s}fixity" % (config.premis_ns))
+    messageDigestAlgorithm = etree.SubElement(
+        fixity1, "{%s}messageDigestAlgorithm" % (config.premis_ns))
+    messageDigestAlgorithm.text = "SHA-512"
+    messageDigest = etree.SubElement(
+        fixity1, "{%s}messageDigest" % (config.premis_ns))
+    messageDigestOriginator = etree.SubElement(
+        fixity1, "{%s}messageDigestOriginator" % (config.premis_ns))
+    # Value more or less follows convention for DM 1.5
+    messageDigestOriginator.text = "python.hashlib.sha512.hexdigest"
+
+    # Size
+    size = etree.SubElement(objectCharacteristics,
+                            "{%s}size" % (config.premis_ns))
+
+    # Format
+    pFormat = etree.SubElement(objectCharacteristics,
+                               "{%s}format" % (config.premis_ns))
+    formatDesignation = etree.SubElement(
+        pFormat, "{%s}formatDesignation" % (config.premis_ns))
+    formatName = etree.SubElement(
+        formatDesignation, "{%s}formatName" % (config.premis_ns))
+
+    # formatRegistry: DIAS fileTypeID values
+    # TODO FLAC and ISO Image fmts have no fileTypeID values. These either have to be added to the
+    # DIAS filetypes list or the formatRegistry element should be omitted altogether
+    formatRegistry = etree.SubElement(
+        pFormat, "{%s}formatRegistry" % (config.premis_ns))
+    formatRegistryName = etree.SubElement(
+        formatRegistry, "{%s}formatRegistryName" % (config.premis_ns))
+    formatRegistryName.text = "DIAS"
+    formatRegistryKey = etree.SubElement(
+        formatRegistry, "{%s}formatRegistryKey" % (config.premis_ns))
+
+    # objectCharacteristicsExtension - EBUCore, isolyzer, Isobuster DFXML
+    objectCharacteristicsExtension1 = etree.SubElement(
+        objectCharacteristics, "{%s}objectCharacteristicsExtension" % (config.premis_ns))
+
+    # originalName
+    originalName = etree.SubElement(
+        pObject, "{%s}originalName" % (config.premis_ns))
+
+    return ElementTemplate(pObject, [objectIdentifierValue, objectCharacteristics,
+                                     messageDigest, size, formatName, formatRegistryKey,
+                                     objectCharacteristicsExtension1, originalName])
+
+
+def createFixityTemplate():
+    """Return template for PREMIS fixity element of an additional checksum; the
+    slots are the messageDigestAlgorithm, messageDigest and messageDigestOriginator
+    elements"""
+    fixityName = etree.QName(config.premis_ns, "fixity")
+    fixity = etree.Element(fixityName, nsmap=config.NSMAP)
+    messageDigestAlgorithm = etree.SubElement(
+        fixity, "{%s}messageDigestAlgorithm" % (config.premis_ns))
+    messageDigest = etree.SubElement(
+        fixity, "{%s}messageDigest" % (config.premis_ns))
+    messageDigestOriginator = etree.SubElement(
+        fixity, "{%s}messageDigestOriginator" % (config.premis_ns))
+    return ElementTemplate(fixity, [messageDigestAlgorithm, messageDigest,
+                                    messageDigestOriginator])
+
+
+# Templates for the PREMIS elements of each carrier and file
+eventTemplate = createEventTemplate()
+objectTemplate = createObjectTemplate()
+fixityTemplate = createFixityTemplate()
+
+
+def addCreationEvent(log):
+
+    """Generate creation event using info from log file of creation application"""
+
+    # Read contents of log to a text string
+    with io.open(log, "r", encoding="utf-8") as fLog:
+        logContents = fLog.read()
+    fLog.close()
+
+    # Create PREMIS creation event from template; values of eventDetail and
+    # linkingAgentIdentifierValue are set further below
+    event, (eventIdentifierValue, eventDateTime, eventDetail, eventOutcomeDetail,
+            eventOutcomeDetailNote, linkingAgentIdentifierValue) = eventTemplate.new()
+
+    # Event identifier: UUID, based on host ID and current time
+    eventIdentifierValue.text = str(uuid.uuid1())
+
+    # Event date/time: taken from timestamp of log file (last-modified)
+    eventDateTimeValue = datetime.fromtimestamp(os.path.getctime(log))
+    # Add time zone info
+    pst = pytz.timezone('Europe/Amsterdam')
+    eventDateTimeValue = pst.localize(eventDateTimeValue)
+    eventDateTimeFormatted = eventDateTimeValue.isoformat()
+    eventDateTime.text = eventDateTimeFormatted
+
     # Name of log
     logName = os.path.basename(log)
 
@@ -150,9 +266,13 @@ def addAgent(softwareName):
     return agent
 
 
-def addObjectInstance(fileName, fileSize, mimeType, sha512Sum, sectorOffset, isobusterReportElt):
+def addObjectInstance(fileName, fileSize, mimeType, sha512Sum, sectorOffset, isobusterReportElt,
+                      extraChecksums=None):
 
-    """Generate object instance for file"""
+    """Generate object instance for file
+    extraChecksums is a list of (algorithm, checksum) tuples for any additional
+    fixity algorithms, where algorithm is a hashlib algorithm name
+    """
 
     # Dictionary that links formatName values to mimeTypes
     formatNames = {
@@ -167,74 +287,35 @@ def addObjectInstance(fileName, fileSize, mimeType, sha512Sum, sectorOffset, iso
         'audio/wav': '60',
         'audio/flac': 'n/a'  # Not on DIAS filetypes list
     }
-    # Create PREMIS object instance
-    objectName = etree.QName(config.premis_ns, "object")
-    pObject = etree.Element(objectName, nsmap=config.NSMAP)
-    pObject.attrib["{%s}type" % config.xsi_ns] = "premis:file"
+    # Create PREMIS object instance from template
+    pObject, (objectIdentifierValue, objectCharacteristics, messageDigest, size, formatName,
+              formatRegistryKey, objectCharacteristicsExtension1,
+              originalName) = objectTemplate.new()
 
     # Object identifier
-    objectIdentifier = etree.SubElement(
-        pObject, "{%s}objectIdentifier" % (config.premis_ns))
-    objectIdentifierType = etree.SubElement(
-        objectIdentifier, "{%s}objectIdentifierType" % (config.premis_ns))
-    objectIdentifierType.text = "UUID"
-    objectIdentifierValue = etree.SubElement(
-        objectIdentifier, "{%s}objectIdentifierValue" % (config.premis_ns))
     objectIdentifierValue.text = str(uuid.uuid1())
 
-    # Object characteristics
-    objectCharacteristics = etree.SubElement(
-        pObject, "{%s}objectCharacteristics" % (config.premis_ns))
-    compositionLevel = etree.SubElement(
-        objectCharacteristics, "{%s}compositionLevel" % (config.premis_ns))
-    compositionLevel.text = "0"
-
-    # Fixity element for SHA-512 checksum
-    fixity1 = etree.SubElement(
-        objectCharacteristics, "{%s}fixity" % (config.premis_ns))
-    messageDigestAlgorithm = etree.SubElement(
-        fixity1, "{%s}messageDigestAlgorithm" % (config.premis_ns))
-    messageDigestAlgorithm.text = "SHA-512"
-    messageDigest = etree.SubElement(
-        fixity1, "{%s}messageDigest" % (config.premis_ns))
+    # SHA-512 checksum
     messageDigest.text = sha512Sum
-    messageDigestOriginator = etree.SubElement(
-        fixity1, "{%s}messageDigestOriginator" % (config.premis_ns))
-    # Value more or less follows convention for DM 1.5
-    messageDigestOriginator.text = "python.hashlib.sha512.hexdigest"
+
+    # Fixity elements for any additional checksums (after the SHA-512 one)
+    for algorithm, checksum in extraChecksums or []:
+        fixity, (messageDigestAlgorithm, messageDigest,
+                 messageDigestOriginator) = fixityTemplate.new()
+        messageDigestAlgorithm.text = algorithmNames[algorithm]
+        messageDigest.text = checksum
+        messageDigestOriginator.text = "python.hashlib." + algorithm + ".hexdigest"
+        size.addprevious(fixity)
 
     # Size
-    size = etree.SubElement(objectCharacteristics,
-                            "{%s}size" % (config.premis_ns))
     size.text = fileSize
 
-    # Format
-    pFormat = etree.SubElement(objectCharacteristics,
-                               "{%s}format" % (config.premis_ns))
-    formatDesignation = etree.SubElement(
-        pFormat, "{%s}formatDesignation" % (config.premis_ns))
-    formatName = etree.SubElement(
-        formatDesignation, "{%s}formatName" % (config.premis_ns))
-
     # Lookup formatName for mimeType
     formatName.text = formatNames.get(mimeType)
 
     # formatRegistry: DIAS fileTypeID values
-    # TODO FLAC and ISO Image fmts have no fileTypeID values. These either have to be added to the
-    # DIAS filetypes list or the formatRegistry element should be omitted altogether
-    formatRegistry = etree.SubElement(
-        pFormat, "{%s}formatRegistry" % (config.premis_ns))
-    formatRegistryName = etree.SubElement(
-        formatRegistry, "{%s}formatRegistryName" % (config.premis_ns))
-    formatRegistryName.text = "DIAS"
-    formatRegistryKey = etree.SubElement(
-        formatRegistry, "{%s}formatRegistryKey" % (config.premis_ns))
     formatRegistryKey.text = fileTypeIDs.get(mimeType)
 
-    # objectCharacteristicsExtension - EBUCore, isolyzer, Isobuster DFXML
-    objectCharacteristicsExtension1 = etree.SubElement(
-        objectCharacteristics, "{%s}objectCharacteristicsExtension" % (config.premis_ns))
-
     if fileName.endswith(('.wav', '.WAV', 'flac', 'FLAC')):
         audioMDOut = getAudioMetadata(fileName)
         audioMD = audioMDOut["outElt"]
@@ -265,8 +346,6 @@ def addObjectInstance(fileName, fileSize, mimeType, sha512Sum, sectorOffset, iso
         objectCharacteristicsExtension2.append(isoMDOut)
 
     # originalName
-    originalName = etree.SubElement(
-        pObject, "{%s}originalName" % (config.premis_ns))
     originalName.text = os.path.basename(fileName)
 
     return pObject
@@ -0,0 +1,29 @@
+#! /usr/bin/env python
+"""
+Prebuilt element templates for METS and PREMIS elements that are created for
+every file
+"""
+
+from copy import deepcopy
+
+
+class ElementTemplate:
+    """Element tree that is built once (so its qualified tag names, fixed values and
+    namespace declarations are only set up once), and deep-copied for each new
+    element. Slots are elements of the tree that are filled in for each copy
+    (text, attributes or child elements); they are located in a copy by their
+    position in document order
+    """
+    def __init__(self, element, slots=None):
+        """initialise ElementTemplate class instance"""
+        self.element = element
+        elements = list(element.iter())
+        self.positions = [elements.index(slot) for slot in list(slots or [])]
+
+    def new(self):
+        """Return copy of template, and list with the slot elements of the copy"""
+        element = deepcopy(self.element)
+        if not self.positions:
+            return element, []
+        elements = list(element.iter())
+        return element, [elements[position] for position in self.positions]
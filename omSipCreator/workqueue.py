@@ -0,0 +1,212 @@
+#! /usr/bin/env python
+"""
+Shared queue of PPNs for processing a batch with several worker processes
+"""
+
+import time
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class LeaseLostError(Exception):
+    """Raised (see RunContext.checkLease) when a worker has lost its lease on the
+    PPN it is processing, so the PPN is aborted"""
+
+
+class WorkQueue:
+    """Queue of the PPNs of a batch, stored in an SQLite database on the (shared)
+    batch file system. Worker processes, on one or several machines, claim a PPN by
+    taking a lease on it, which is renewed while the PPN is processed; a PPN with an
+    expired lease (e.g. because its worker crashed) can be claimed by another worker.
+    Results of each PPN (log records, error and warning counts, failed PPNs, carrier
+    directories and I/O statistics) are stored in the database, so a coordinator can
+    merge them afterwards. Leases are based on the system clocks of the workers,
+    so these must be synchronised. Concurrent access relies on the file locking of
+    SQLite, which is unreliable on some network file systems (NFS, SMB); the
+    database must use a rollback journal, since WAL mode needs shared memory, which
+    does not work across machines at all
+    """
+    def __init__(self, dbFile, leaseTime=300):
+        """Initialise WorkQueue class instance"""
+        self.dbFile = dbFile
+        self.leaseTime = leaseTime
+        # Connection is shared with the lease renewal thread, so access is
+        # serialised with a lock. Transactions are managed explicitly, so claims
+        # can take the database write lock right away (BEGIN IMMEDIATE)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.dbFile, timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        with self.lock:
+            # A database that was switched to WAL mode (e.g. by another tool) is
+            # switched back, since WAL mode does not work on network file systems
+            journalMode = self.conn.execute("PRAGMA journal_mode").fetchone()[0]
+            if journalMode.lower() == "wal":
+                journalMode = self.conn.execute("PRAGMA journal_mode=DELETE").fetchone()[0]
+            if journalMode.lower() == "wal":
+                self.conn.close()
+                raise sqlite3.OperationalError("cannot switch '" + self.dbFile +
+                                               "' from WAL to rollback journal mode")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS settings ("
+                              "name TEXT PRIMARY KEY, "
+                              "value TEXT NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS ppns ("
+                              "ppn TEXT PRIMARY KEY, "
+                              "position INTEGER NOT NULL, "
+                              "status TEXT NOT NULL, "
+                              "worker TEXT, "
+                              "lease_expires REAL, "
+                              "attempts INTEGER NOT NULL, "
+                              "errors INTEGER, "
+                              "warnings INTEGER, "
+                              "failed INTEGER, "
+                              "exited INTEGER, "
+                              "dirs TEXT, "
+                              "io_stats TEXT, "
+                              "log TEXT)")
+
+    @contextmanager
+    def transaction(self):
+        """Context manager for a transaction that takes the database write lock
+        right away, so concurrent workers cannot claim the same PPN
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def populate(self, PPNValues, dirOut):
+        """Add PPNs in PPNValues (in processing order) to the queue, unless the queue
+        already exists. Returns False if the queue was created for another dirOut
+        """
+        with self.transaction():
+            row = self.conn.execute("SELECT value FROM settings WHERE name = 'dirOut'"
+                                    ).fetchone()
+            if row is not None:
+                return row[0] == dirOut
+            self.conn.execute("INSERT INTO settings VALUES ('dirOut', ?)", (dirOut,))
+            self.conn.executemany("INSERT INTO ppns (ppn, position, status, attempts) "
+                                  "VALUES (?, ?, 'pending', 0)",
+                                  [(PPNValue, position)
+                                   for position, PPNValue in enumerate(PPNValues)])
+        return True
+
+    def claim(self, workerID):
+        """Take lease on first PPN that is pending (or that has an expired lease),
+        and return its value, or None if no PPNs are left
+        """
+        with self.transaction():
+            now = time.time()
+            row = self.conn.execute("SELECT ppn FROM ppns WHERE status = 'pending' OR "
+                                    "(status = 'claimed' AND lease_expires < ?) "
+                                    "ORDER BY position LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE ppns SET status = 'claimed', worker = ?, "
+                              "lease_expires = ?, attempts = attempts + 1 WHERE ppn = ?",
+                              (workerID, now + self.leaseTime, row[0]))
+        return row[0]
+
+    def renew(self, PPNValue, workerID):
+        """Renew lease of workerID on PPN; returns False if the lease was lost"""
+        with self.lock:
+            cursor = self.conn.execute("UPDATE ppns SET lease_expires = ? WHERE ppn = ? AND "
+                                       "worker = ? AND status = 'claimed'",
+                                       (time.time() + self.leaseTime, PPNValue, workerID))
+        return cursor.rowcount == 1
+
+    @contextmanager
+    def leased(self, PPNValue, workerID):
+        """Context manager that keeps renewing the lease of workerID on PPN in a
+        background thread while the PPN is processed. It yields an event that is
+        set once the lease is lost, i.e. if another worker has claimed the PPN, or
+        if the lease could not be renewed before it expired (after which another
+        worker may claim the PPN at any moment)
+        """
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def keepLease():
+            expires = time.time() + self.leaseTime
+            while not stop.wait(self.leaseTime / 3):
+                try:
+                    renewed = self.renew(PPNValue, workerID)
+                except sqlite3.Error:
+                    # E.g. database locked for too long; try again next time,
+                    # unless the lease has expired by then
+                    renewed = None
+                if renewed:
+                    expires = time.time() + self.leaseTime
+                elif renewed is False or time.time() >= expires:
+                    lost.set()
+                    break
+
+        thread = threading.Thread(target=keepLease, daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, PPNValue, workerID, records, context, exited):
+        """Store results of PPN, and mark it as done. records are the (formatted)
+        log records of the PPN, context is the RunContext with the counters of the
+        PPN only, and exited indicates a fatal error. Returns False (and stores
+        nothing) if workerID no longer holds the lease on PPN
+        """
+        log = [[record.name, record.levelno, record.levelname, record.getMessage()]
+               for record in records]
+        ioStats = {ioMode: list(stats) for ioMode, stats in context.ioStats.items()}
+        with self.lock:
+            cursor = self.conn.execute("UPDATE ppns SET status = 'done', lease_expires = NULL, "
+                                       "errors = ?, warnings = ?, failed = ?, exited = ?, "
+                                       "dirs = ?, io_stats = ?, log = ? WHERE ppn = ? AND "
+                                       "worker = ? AND status = 'claimed'",
+                                       (context.errors, context.warnings,
+                                        int(PPNValue in context.failedPPNs), int(exited),
+                                        json.dumps(context.dirsInMetaCarriers),
+                                        json.dumps(ioStats), json.dumps(log),
+                                        PPNValue, workerID))
+        return cursor.rowcount == 1
+
+    def unfinished(self):
+        """Return number of PPNs that are not done yet"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM ppns WHERE status != 'done'"
+                                     ).fetchone()[0]
+
+    def busy(self):
+        """Return number of PPNs that are claimed by a worker with a live lease"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM ppns WHERE status = 'claimed' "
+                                     "AND lease_expires >= ?", (time.time(),)).fetchone()[0]
+
+    def results(self):
+        """Return list with a dictionary with the status and results of each PPN,
+        in processing order
+        """
+        with self.lock:
+            cursor = self.conn.execute("SELECT ppn, status, worker, attempts, errors, "
+                                       "warnings, failed, exited, dirs, io_stats, log "
+                                       "FROM ppns ORDER BY position")
+            names = [description[0] for description in cursor.description]
+            rows = cursor.fetchall()
+        results = []
+        for row in rows:
+            result = dict(zip(names, row))
+            for name in ["dirs", "log"]:
+                result[name] = json.loads(result[name]) if result[name] else []
+            result["io_stats"] = json.loads(result["io_stats"]) if result["io_stats"] else {}
+            results.append(result)
+        return results
+
+    def close(self):
+        """Close the database connection"""
+        with self.lock:
+            self.conn.close()
@@ -31,7 +31,7 @@ INSTALL_REQUIRES = [
     'isolyzer'
 ]
 
-PYTHON_REQUIRES = '>=3.2'
+PYTHON_REQUIRES = '>=3.9'
 
 setup(name='omSipCreator',
       packages=find_packages(),
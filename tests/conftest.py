@@ -0,0 +1,36 @@
+"""
+Shared fixtures for the tests (run with: python -m pytest)
+"""
+
+import pytest
+from omSipCreator import fileio
+from omSipCreator.context import RunContext
+from omSipCreator.checksumcache import ChecksumCache
+
+
+@pytest.fixture
+def smallChunks(monkeypatch):
+    """Use tiny blocks and chunks, so files with many chunks stay small"""
+    monkeypatch.setattr(fileio, "blocksize", 16)
+    monkeypatch.setattr(fileio, "chunkSize", 64)
+
+
+@pytest.fixture
+def cacheContext(tmp_path, smallChunks):
+    """RunContext with a checksum cache that records the chunk manifest"""
+    context = RunContext()
+    context.chunkManifest = True
+    context.checksumCache = ChecksumCache(str(tmp_path / "checksums.db"))
+    yield context
+    context.checksumCache.close()
+
+
+@pytest.fixture
+def makeFile(tmp_path):
+    """Return function that writes file name (in tmp_path) of noBytes bytes, with
+    content that differs between chunks, and returns its path"""
+    def writeFile(name, noBytes, seed=0):
+        path = tmp_path / name
+        path.write_bytes(bytes((seed + i * 7 + i // 64) % 251 for i in range(noBytes)))
+        return str(path)
+    return writeFile
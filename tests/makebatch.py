@@ -0,0 +1,57 @@
+#! /usr/bin/env python
+"""
+Generator of small batches of data carriers, for tests and scripted checks (test
+code only, so it is not part of the omSipCreator package). Each carrier has a
+meta-kbmdo.xml with the same catalogue record as the stand-in SRU service (see
+stubserver.py) returns for its PPN
+"""
+
+import os
+import csv
+import hashlib
+from stubserver import defaultRecord
+from stubserver import RESPONSE_TEMPLATE
+from stubserver import RECORD_TEMPLATE
+
+CDINFO = """cd-info version
+CD-ROM Track List (1 - 1)
+  #: MSF       LSN    Type   Green? Copy?
+  1: 00:02:00  000000 data   false  no
+170: 00:20:00  001350 leadout (3 MB raw, 3 MB formatted)
+CD Analysis Report
+CD-ROM with ISO 9660 filesystem
+"""
+
+ISOBUSTER_REPORT = ('<?xml version="1.0"?><dfxml xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                    '<metadata><dc:type>CD</dc:type></metadata></dfxml>')
+
+
+def makeBatch(batchDir, PPNs, carriersPerPPN=1):
+    """Create batch with carriersPerPPN data carriers (volumes) for each PPN"""
+    rows = []
+    for PPN in PPNs:
+        for volumeNo in range(1, carriersPerPPN + 1):
+            jobID = "job" + PPN + "-" + str(volumeNo)
+            jobDir = os.path.join(batchDir, jobID)
+            os.makedirs(jobDir)
+            files = {"image.iso": hashlib.sha512(jobID.encode()).digest() * 4096,
+                     "cd-info.log": CDINFO.encode(),
+                     "isobuster.log": b"0",
+                     "isobuster-report.xml": ISOBUSTER_REPORT.encode(),
+                     "meta-kbmdo.xml": (RESPONSE_TEMPLATE % (1, RECORD_TEMPLATE %
+                                                             (defaultRecord(PPN), 1))).encode()}
+            with open(os.path.join(jobDir, "checksums.sha512"), "w",
+                      encoding="utf-8") as fChecksums:
+                for fileName, data in sorted(files.items()):
+                    with open(os.path.join(jobDir, fileName), "wb") as fOut:
+                        fOut.write(data)
+                    fChecksums.write(hashlib.sha512(data).hexdigest() + " " + fileName + "\n")
+            rows.append([jobID, PPN, str(volumeNo), "title", "volume", "True", "False",
+                         "True", "False"])
+    with open(os.path.join(batchDir, "manifest.csv"), "w", encoding="utf-8") as fManifest:
+        writer = csv.writer(fManifest, lineterminator="\n")
+        writer.writerow(["jobID", "PPN", "volumeNo", "title", "volumeID", "success",
+                         "containsAudio", "containsData", "cdExtra"])
+        writer.writerows(rows)
+    with open(os.path.join(batchDir, "batch.log"), "w", encoding="utf-8") as fLog:
+        fLog.write("batch log")
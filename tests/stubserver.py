@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+"""
+Local stand-in for the KB SRU service, for testing the SRU client and
+catalogue lookups without network access (test code only, so it is not part
+of the omSipCreator package)
+"""
+
+import re
+import sys
+import gzip
+import time
+import threading
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+RESPONSE_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<srw:searchRetrieveResponse xmlns:srw="http://www.loc.gov/zing/srw/" \
+xmlns:dc="http://purl.org/dc/elements/1.1/" \
+xmlns:dcx="http://krait.kb.nl/coop/tel/handbook/telterms.html" \
+xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" \
+xmlns:dcterms="http://purl.org/dc/terms/">
+<srw:version>1.2</srw:version>
+<srw:numberOfRecords>%i</srw:numberOfRecords>
+<srw:records>%s</srw:records>
+</srw:searchRetrieveResponse>
+'''
+
+RECORD_TEMPLATE = '''<srw:record><srw:recordSchema>dcx</srw:recordSchema>\
+<srw:recordPacking>xml</srw:recordPacking><srw:recordData><srw:dc>
+%s
+</srw:dc></srw:recordData><srw:recordPosition>%i</srw:recordPosition></srw:record>'''
+
+
+def defaultRecord(PPN):
+    # Return dcx record data (contents of the srw:dc element) for PPN
+    PPN = escape(PPN)
+    return '\n'.join([
+        '<dc:title xsi:type="dcx:maintitle">Title of ' + PPN + '</dc:title>',
+        '<dc:creator>Creator of ' + PPN + '</dc:creator>',
+        '<dc:publisher>Publisher</dc:publisher>',
+        '<dc:date>2000</dc:date>',
+        '<dc:identifier xsi:type="dcterms:URI">'
+        'http://resolver.kb.nl/resolve?urn=PPN:' + PPN + '</dc:identifier>',
+        '<dcx:recordIdentifier xsi:type="dcterms:URI">'
+        'http://opc4.kb.nl/DB=1/PPN?PPN=' + PPN + '</dcx:recordIdentifier>'])
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class StubSruServer():
+    # Serves SRU searchRetrieve responses for queries of the form
+    # "PPN=..." (possibly several, combined with OR). records is a
+    # dictionary with the dcx record data for each known PPN; if it is
+    # None, every PPN has a record (see defaultRecord). startRecord and
+    # maximumRecords are honoured. delay (in seconds) is added to each
+    # response, and the first failures requests are answered with HTTP
+    # status 503. Connections are kept alive, and responses are
+    # gzip-compressed if the client accepts this. requestcount and
+    # connectioncount hold the number of requests and connections served.
+    def __init__(self, records=None, delay=0.0, failures=0, host='127.0.0.1', port=0):
+        self.records = records
+        self.delay = delay
+        self.failures = failures
+        self.requestcount = 0
+        self.connectioncount = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%i/sru/sru' % (host, port)
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are sent separately, which stalls keep-alive
+            # connections if Nagle's algorithm is enabled
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with stub.lock:
+                    stub.connectioncount += 1
+
+            def do_GET(self):
+                requestnumber = stub.countRequest()
+                if stub.delay:
+                    time.sleep(stub.delay)
+                if requestnumber <= stub.failures:
+                    status = 503
+                    body = b''
+                else:
+                    status = 200
+                    body = stub.respond(parse_qs(urlparse(self.path).query))
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def countRequest(self):
+        with self.lock:
+            self.requestcount += 1
+            return self.requestcount
+
+    def respond(self, params):
+        # Return response body for request parameters params
+        query = params.get('query', [''])[0]
+        startrecord = int(params.get('startRecord', ['1'])[0])
+        maximumrecords = int(params.get('maximumRecords', ['1'])[0])
+
+        matches = []
+        for PPN in re.findall(r'PPN=([^"\s)]+)', query):
+            if self.records is None:
+                matches.append(defaultRecord(PPN))
+            elif PPN in self.records:
+                matches.append(self.records[PPN])
+
+        first = max(startrecord, 1) - 1
+        selected = matches[first:first + maximumrecords]
+        records = ''.join([RECORD_TEMPLATE % (record, first + i + 1)
+                           for i, record in enumerate(selected)])
+        return (RESPONSE_TEMPLATE % (len(matches), records)).encode('utf-8')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.stop()
+
+
+if __name__ == '__main__':
+    # Run stand-in server in the foreground: stubserver.py [port]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    stub = StubSruServer(port=port)
+    sys.stdout.write('Serving stand-in SRU service at ' + stub.url + '\n')
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
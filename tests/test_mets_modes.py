@@ -0,0 +1,84 @@
+"""
+Tests that serial processing (write), parallel PPN processing (write --jobs), the
+staged pipeline (write --pipeline) and distributed processing (worker) write the
+same METS files
+"""
+
+import os
+import re
+import sys
+import subprocess
+import pytest
+from stubserver import StubSruServer
+from makebatch import makeBatch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs omSipCreator with the stub as catalogue: python -c MAIN url arguments
+MAIN = ("import sys; from omSipCreator import kbapi; kbapi.sru.baseurl = sys.argv[1]; "
+        "from omSipCreator.omSipCreator import main; "
+        "sys.argv = ['omSipCreator'] + sys.argv[2:]; main()")
+
+PPNs = [str(300000000 + PPN) for PPN in range(5)]
+
+pytestmark = pytest.mark.skipif(not os.path.isfile("/usr/bin/mediainfo"),
+                                reason="MediaInfo is not installed")
+
+
+def runOmSipCreator(url, *arguments):
+    """Run omSipCreator with arguments, and check that it reports no errors or warnings"""
+    process = subprocess.run([sys.executable, "-c", MAIN, url] + list(arguments), cwd=ROOT,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True, timeout=600)
+    assert process.returncode == 0, process.stdout
+    assert " 0 errors and 0 warnings" in process.stdout, process.stdout
+
+
+def readMets(dirOut):
+    """Return dictionary with the METS file of each PPN in dirOut, without the
+    values that differ between runs (identifiers, timestamps and the output
+    directory)"""
+    metsFiles = {}
+    for PPN in PPNs:
+        with open(os.path.join(dirOut, PPN, "mets.xml"), encoding="utf-8") as fMets:
+            mets = fMets.read()
+        mets = mets.replace(dirOut, "dirOut")
+        mets = re.sub(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}",
+                      "UUID", mets)
+        mets = re.sub(r"\d{4}-\d\d-\d\dT[\d:.+-]+Z?", "TIMESTAMP", mets)
+        metsFiles[PPN] = mets
+    return metsFiles
+
+
+@pytest.fixture(scope="module")
+def batch(tmp_path_factory):
+    """Batch with two carriers for each PPN, the stand-in SRU service, and the METS
+    files of serial processing"""
+    tempDir = tmp_path_factory.mktemp("mets")
+    batchDir = str(tempDir / "batch")
+    makeBatch(batchDir, PPNs, carriersPerPPN=2)
+    with StubSruServer() as stub:
+        dirOut = str(tempDir / "serial")
+        runOmSipCreator(stub.url, "write", batchDir, dirOut)
+        yield batchDir, stub, readMets(dirOut)
+
+
+@pytest.mark.parametrize("options", [["--jobs", "2"],
+                                     ["--pipeline"],
+                                     ["--pipeline", "--hash-workers", "2"],
+                                     ["--copy-strategy", "copy_file_range"]])
+def test_write_modes(batch, tmp_path, options):
+    """Write modes give the same METS files as serial processing"""
+    batchDir, stub, expected = batch
+    dirOut = str(tmp_path / "sips")
+    runOmSipCreator(stub.url, "write", batchDir, dirOut, *options)
+    assert readMets(dirOut) == expected
+
+
+def test_workers(batch, tmp_path):
+    """Worker and collect give the same METS files as serial processing"""
+    batchDir, stub, expected = batch
+    dirOut = str(tmp_path / "sips")
+    runOmSipCreator(stub.url, "worker", batchDir, dirOut, "--worker-id", "w1")
+    runOmSipCreator(stub.url, "collect", batchDir, dirOut)
+    assert readMets(dirOut) == expected
@@ -0,0 +1,120 @@
+"""
+Tests for completing an interrupted prune from the prune journal
+(Batch.rollForwardPrune)
+"""
+
+import os
+import json
+import pytest
+from omSipCreator.batch import Batch
+from omSipCreator.context import RunContext
+
+
+@pytest.fixture
+def interruptedPrune(tmp_path):
+    """Create input batch with carriers job1 and job2 (both with errors) and job3,
+    an error batch with its manifest, and the journal that prune writes before it
+    moves the carriers; returns Batch instance"""
+    batchDir = tmp_path / "batch"
+    batchErr = tmp_path / "failed"
+    for jobID in ["job1", "job2", "job3"]:
+        (batchDir / jobID).mkdir(parents=True)
+        (batchDir / jobID / "image.iso").write_text(jobID)
+    (batchDir / "manifest.csv").write_text("jobID\njob1\njob2\njob3\n")
+    (batchDir / "tmp.csv").write_text("jobID\njob3\n")
+    (batchDir / "batch.log").write_text("batch log")
+    batchErr.mkdir()
+    (batchErr / "manifest.csv").write_text("jobID\njob1\njob2\n")
+
+    context = RunContext()
+    context.pruneBatch = True
+    context.batchErr = str(batchErr)
+    batch = Batch(str(batchDir), context)
+    journal = {"moves": [(str(batchDir / jobID), str(batchErr / jobID))
+                         for jobID in ["job1", "job2"]],
+               "batchManifest": batch.batchManifest,
+               "batchManifestTemp": str(batchDir / "tmp.csv"),
+               "batchManifestOld": str(batchDir / "manifest.old"),
+               "copies": batch.pruneCopies()}
+    with open(batch.pruneJournal, "w", encoding="utf-8") as fJournal:
+        json.dump(journal, fJournal)
+    return batch
+
+
+def checkPruned(batch):
+    """Check that the prune of interruptedPrune was completed"""
+    batchDir = batch.batchDir
+    batchErr = batch.context.batchErr
+    assert sorted(os.listdir(batchDir)) == ["batch.log", "job3", "manifest.csv",
+                                            "manifest.old"]
+    assert sorted(os.listdir(batchErr)) == ["batch.log", "job1", "job2", "manifest.csv"]
+    with open(os.path.join(batchDir, "manifest.csv"), encoding="utf-8") as f:
+        assert f.read() == "jobID\njob3\n"
+    with open(os.path.join(batchDir, "manifest.old"), encoding="utf-8") as f:
+        assert f.read() == "jobID\njob1\njob2\njob3\n"
+    with open(os.path.join(batchErr, "job2", "image.iso"), encoding="utf-8") as f:
+        assert f.read() == "job2"
+    assert batch.context.errors == 0
+
+
+def test_journal_in_error_batch(interruptedPrune):
+    """The journal is kept in the error batch, not in the input batch"""
+    assert os.path.dirname(interruptedPrune.pruneJournal) == interruptedPrune.context.batchErr
+
+
+def test_no_journal(tmp_path):
+    """Without journal there is nothing to complete"""
+    context = RunContext()
+    context.pruneBatch = True
+    context.batchErr = str(tmp_path / "failed")
+    assert Batch(str(tmp_path), context).rollForwardPrune() is False
+
+
+def test_interrupted_before_moves(interruptedPrune):
+    """Prune that was interrupted right after writing the journal is completed"""
+    assert interruptedPrune.rollForwardPrune() is True
+    checkPruned(interruptedPrune)
+
+
+def test_interrupted_during_moves(interruptedPrune):
+    """Carriers that were already moved are skipped"""
+    os.rename(os.path.join(interruptedPrune.batchDir, "job1"),
+              os.path.join(interruptedPrune.context.batchErr, "job1"))
+    assert interruptedPrune.rollForwardPrune() is True
+    checkPruned(interruptedPrune)
+
+
+def test_interrupted_during_manifest_update(interruptedPrune):
+    """Prune that was interrupted after the original batch manifest was renamed
+    (but before the updated one replaced it) is completed"""
+    for jobID in ["job1", "job2"]:
+        os.rename(os.path.join(interruptedPrune.batchDir, jobID),
+                  os.path.join(interruptedPrune.context.batchErr, jobID))
+    os.rename(interruptedPrune.batchManifest,
+              os.path.join(interruptedPrune.batchDir, "manifest.old"))
+    assert interruptedPrune.rollForwardPrune() is True
+    checkPruned(interruptedPrune)
+
+
+def test_roll_forward_twice(interruptedPrune):
+    """The journal is removed once the prune is complete"""
+    assert interruptedPrune.rollForwardPrune() is True
+    assert not os.path.exists(interruptedPrune.pruneJournal)
+    assert interruptedPrune.rollForwardPrune() is False
+    checkPruned(interruptedPrune)
+
+
+def test_destination_exists(interruptedPrune):
+    """A carrier that cannot be moved is a fatal error, and the journal is kept, so
+    the prune can be completed once the problem is fixed"""
+    os.mkdir(os.path.join(interruptedPrune.context.batchErr, "job2"))
+    with pytest.raises(SystemExit):
+        interruptedPrune.rollForwardPrune()
+    assert interruptedPrune.context.errors == 1
+    assert os.path.isfile(interruptedPrune.pruneJournal)
+    assert os.path.isfile(interruptedPrune.batchManifest)
+
+    os.rmdir(os.path.join(interruptedPrune.context.batchErr, "job2"))
+    interruptedPrune.context.errors = 0
+    assert interruptedPrune.rollForwardPrune() is True
+    checkPruned(interruptedPrune)
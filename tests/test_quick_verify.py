@@ -0,0 +1,99 @@
+"""
+Tests for quick verification by chunk sampling (checksums.quick_file_sha512)
+"""
+
+import os
+import hashlib
+import logging
+import pytest
+from omSipCreator import checksums
+
+
+@pytest.fixture
+def sampledChunks(monkeypatch):
+    """Record the index of each chunk that is re-read by a quick verification"""
+    indices = []
+    hashChunk = checksums.hash_chunk
+
+    def recordChunk(context, fileIn, index):
+        indices.append(index)
+        return hashChunk(context, fileIn, index)
+    monkeypatch.setattr(checksums, "hash_chunk", recordChunk)
+    return indices
+
+
+def sha512(fileName):
+    """Return sha512 hash of fileName"""
+    with open(fileName, "rb") as f:
+        return hashlib.sha512(f.read()).hexdigest()
+
+
+def overwrite(fileName, offset):
+    """Change the byte at offset in place, keeping size and modification time, so the
+    checksum cache still considers fileName unchanged"""
+    fileStat = os.stat(fileName)
+    with open(fileName, "r+b") as f:
+        f.seek(offset)
+        value = f.read(1)[0]
+        f.seek(offset)
+        f.write(bytes([value ^ 0xff]))
+    os.utime(fileName, ns=(fileStat.st_atime_ns, fileStat.st_mtime_ns))
+
+
+@pytest.mark.parametrize("noBytes, expected", [(64 * 10 + 20, None),
+                                               (64 * 5, None),
+                                               (64 * 3, [0, 1, 2]),
+                                               (64 * 2, [0, 1]),
+                                               (64 + 1, [0, 1]),
+                                               (20, [0])])
+def test_sampled_chunks(cacheContext, makeFile, sampledChunks, noBytes, expected):
+    """First and last chunk plus quickSamples other chunks are re-read, each once"""
+    fileIn = makeFile("image.iso", noBytes)
+    checksum = checksums.get_file_sha512(cacheContext, fileIn)
+    assert sampledChunks == []
+
+    assert checksums.quick_file_sha512(cacheContext, fileIn) == checksum
+    noChunks = (noBytes + 63) // 64
+    if expected is None:
+        assert len(sampledChunks) == 2 + checksums.quickSamples
+        assert sampledChunks[0] == 0 and sampledChunks[-1] == noChunks - 1
+        assert sampledChunks == sorted(set(sampledChunks))
+    else:
+        assert sampledChunks == expected
+
+
+def test_samples_vary(cacheContext, makeFile, sampledChunks):
+    """The other chunks are selected at random for each quick verification"""
+    fileIn = makeFile("image.iso", 64 * 100)
+    checksums.get_file_sha512(cacheContext, fileIn)
+    samples = set()
+    for _ in range(10):
+        del sampledChunks[:]
+        checksums.quick_file_sha512(cacheContext, fileIn)
+        samples.add(tuple(sampledChunks))
+    assert len(samples) > 1
+
+
+@pytest.mark.parametrize("offset", [3, 64 * 10 + 5])
+def test_changed_chunk(cacheContext, makeFile, caplog, offset):
+    """A change in the first or last chunk is always found, and results in a full
+    checksum, which replaces the cached one"""
+    fileIn = makeFile("image.iso", 64 * 10 + 20)
+    checksumOld = checksums.get_file_sha512(cacheContext, fileIn)
+    overwrite(fileIn, offset)
+
+    with caplog.at_level(logging.WARNING):
+        checksum = checksums.quick_file_sha512(cacheContext, fileIn)
+    assert checksum == sha512(fileIn) != checksumOld
+    assert "quick check failed" in caplog.text
+    assert cacheContext.checksumCache.get(fileIn, os.stat(fileIn)) == checksum
+
+
+def test_no_chunk_manifest(cacheContext, makeFile, sampledChunks):
+    """Without chunk manifest the full checksum is calculated, and the chunk
+    manifest is recorded for the next quick verification"""
+    fileIn = makeFile("image.iso", 64 * 10 + 20)
+    assert checksums.quick_file_sha512(cacheContext, fileIn) == sha512(fileIn)
+    assert sampledChunks == []
+    assert checksums.quick_file_sha512(cacheContext, fileIn) == sha512(fileIn)
+    assert len(sampledChunks) == 2 + checksums.quickSamples
@@ -0,0 +1,86 @@
+"""
+Tests for resuming interrupted copies with the chunk manifest (checksums.resume_copy)
+"""
+
+import hashlib
+from omSipCreator import checksums
+
+
+def readBytes(fileName):
+    """Return contents of fileName"""
+    with open(fileName, "rb") as f:
+        return f.read()
+
+
+def prepareCopy(cacheContext, makeFile, data):
+    """Hash source file (which records its chunk manifest), and write data as its
+    (partial) copy; returns paths of source and copy"""
+    fileIn = makeFile("image.iso", 10 * 64 + 20)
+    checksums.get_file_hashes(cacheContext, fileIn, ["sha512", "md5"])
+    fileOut = makeFile("copy.iso", 0)
+    with open(fileOut, "wb") as f:
+        f.write(data(readBytes(fileIn)))
+    return fileIn, fileOut
+
+
+def checkResumed(cacheContext, fileIn, fileOut):
+    """Resume copy, and check that it is identical to the source"""
+    hashes = checksums.resume_copy(cacheContext, fileIn, fileOut, ["sha512", "md5"])
+    assert hashes == {"sha512": hashlib.sha512(readBytes(fileIn)).hexdigest(),
+                      "md5": hashlib.md5(readBytes(fileIn)).hexdigest()}
+    assert readBytes(fileOut) == readBytes(fileIn)
+
+
+def test_truncated_copy(cacheContext, makeFile):
+    """Copy that stopped halfway a chunk is completed"""
+    fileIn, fileOut = prepareCopy(cacheContext, makeFile, lambda data: data[:200])
+    checkResumed(cacheContext, fileIn, fileOut)
+
+
+def test_empty_copy(cacheContext, makeFile):
+    """Copy without any data is completed"""
+    fileIn, fileOut = prepareCopy(cacheContext, makeFile, lambda data: b"")
+    checkResumed(cacheContext, fileIn, fileOut)
+
+
+def test_corrupted_copy(cacheContext, makeFile):
+    """Copy with a bad byte is repaired from the first bad chunk onwards"""
+    def corrupt(data):
+        data = bytearray(data)
+        data[5 * 64 + 3] ^= 0xff
+        return bytes(data)
+    fileIn, fileOut = prepareCopy(cacheContext, makeFile, corrupt)
+    checkResumed(cacheContext, fileIn, fileOut)
+
+
+def test_copy_too_long(cacheContext, makeFile):
+    """Trailing data after a complete copy are removed"""
+    fileIn, fileOut = prepareCopy(cacheContext, makeFile, lambda data: data + b"extra")
+    checkResumed(cacheContext, fileIn, fileOut)
+
+
+def test_complete_copy(cacheContext, makeFile):
+    """Complete copy is kept as it is"""
+    fileIn, fileOut = prepareCopy(cacheContext, makeFile, lambda data: data)
+    checkResumed(cacheContext, fileIn, fileOut)
+
+
+def test_no_chunk_manifest(cacheContext, makeFile):
+    """Copy cannot be resumed if the source was hashed without chunk manifest"""
+    cacheContext.chunkManifest = False
+    fileIn, fileOut = prepareCopy(cacheContext, makeFile, lambda data: data[:200])
+    assert checksums.resume_copy(cacheContext, fileIn, fileOut, ["sha512"]) is None
+
+
+def test_source_changed(cacheContext, makeFile):
+    """Copy cannot be resumed if the source changed since it was hashed"""
+    fileIn, fileOut = prepareCopy(cacheContext, makeFile, lambda data: data[:200])
+    makeFile("image.iso", 10 * 64 + 30, seed=1)
+    assert checksums.resume_copy(cacheContext, fileIn, fileOut, ["sha512"]) is None
+
+
+def test_rehash(cacheContext, makeFile):
+    """With --rehash, cached hashes are not trusted, so the copy is not resumed"""
+    fileIn, fileOut = prepareCopy(cacheContext, makeFile, lambda data: data[:200])
+    cacheContext.rehashFlag = True
+    assert checksums.resume_copy(cacheContext, fileIn, fileOut, ["sha512"]) is None
@@ -0,0 +1,95 @@
+"""
+Tests for batched catalogue lookups (kbapi.sru.sru.search_batch), against the
+local stand-in for the SRU service
+"""
+
+import pytest
+from omSipCreator.kbapi.sru import sru
+from omSipCreator.kbapi.cache import recordcache
+from stubserver import StubSruServer
+from stubserver import defaultRecord
+
+
+def titles(results):
+    """Return dictionary with the titles of the records of each value"""
+    return {value: [found.titles for found in records] for value, records in results.items()}
+
+
+def withoutIdentifiers(PPN):
+    """Return record data for PPN without any PPN identifiers"""
+    return defaultRecord(PPN).replace("PPN:" + PPN, "").replace("PPN=" + PPN, "")
+
+
+@pytest.fixture
+def cachePuts(monkeypatch):
+    """Record the queries of each put in the record cache"""
+    puts = []
+    put = recordcache.put
+
+    def recordPut(self, url, collection, recordschema, entries):
+        puts.append(sorted(entries))
+        put(self, url, collection, recordschema, entries)
+    monkeypatch.setattr(recordcache, "put", recordPut)
+    return puts
+
+
+def test_records_assigned_to_values():
+    """Records of OR'd queries are assigned to their PPNs; PPNs without records
+    get an empty list"""
+    PPNs = [str(100 + i) for i in range(7)]
+    records = {PPN: defaultRecord(PPN) for PPN in PPNs if PPN not in ("101", "105")}
+    with StubSruServer(records) as stub:
+        results = sru(stub.url, retries=0).search_batch(PPNs, "GGC", batchsize=3)
+        assert stub.requestcount == 3
+    assert list(results) == PPNs
+    for PPN in PPNs:
+        expected = [["Title of " + PPN]] if PPN in records else []
+        assert titles(results)[PPN] == expected
+        assert all(found.sru.nr_of_records == len(expected) for found in results[PPN])
+
+
+def test_duplicate_values():
+    """Each value is searched once"""
+    with StubSruServer() as stub:
+        results = sru(stub.url, retries=0).search_batch(["1", "2", "1"], "GGC")
+        assert stub.requestcount == 1
+    assert titles(results) == {"1": [["Title of 1"]], "2": [["Title of 2"]]}
+
+
+def test_record_of_several_values():
+    """A record with the identifiers of several PPNs belongs to each of them"""
+    records = {"1": defaultRecord("1") + "\n<dc:identifier>PPN:2</dc:identifier>"}
+    with StubSruServer(records) as stub:
+        results = sru(stub.url, retries=0).search_batch(["1", "2", "3"], "GGC")
+        assert stub.requestcount == 1
+    assert titles(results) == {"1": [["Title of 1"]], "2": [["Title of 1"]], "3": []}
+
+
+def test_single_value_keeps_all_records():
+    """All records of a query for one PPN belong to it, whatever their identifiers"""
+    with StubSruServer({"1": withoutIdentifiers("1")}) as stub:
+        results = sru(stub.url, retries=0).search_batch(["1"], "GGC")
+        assert stub.requestcount == 1
+    assert titles(results) == {"1": [["Title of 1"]]}
+
+
+def test_unassigned_record_requeried(tmp_path, cachePuts):
+    """If an OR'd query returns a record that cannot be assigned, the PPNs without
+    records are searched on their own, and their empty results of the OR'd query
+    are not cached"""
+    records = {"1": withoutIdentifiers("1"), "3": defaultRecord("3")}
+    cache = recordcache(str(tmp_path / "catalogue.db"))
+    with StubSruServer(records) as stub:
+        client = sru(stub.url, retries=0)
+        client.cache = cache
+        results = client.search_batch(["1", "2", "3"], "GGC")
+        assert stub.requestcount == 3
+        assert titles(results) == {"1": [["Title of 1"]], "2": [], "3": [["Title of 3"]]}
+        assert cachePuts == [['"PPN=3"'], ['"PPN=1"'], ['"PPN=2"']]
+
+        # All values are now taken from the cache
+        results = client.search_batch(["1", "2", "3"], "GGC")
+        assert stub.requestcount == 3
+        assert titles(results) == {"1": [["Title of 1"]], "2": [], "3": [["Title of 3"]]}
+    cache.close()
+
@@ -0,0 +1,157 @@
+"""
+Tests for the shared work queue of distributed processing (workqueue.WorkQueue)
+"""
+
+import types
+import logging
+import sqlite3
+import pytest
+from omSipCreator import workqueue
+from omSipCreator.workqueue import WorkQueue
+from omSipCreator.context import RunContext
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace the clock of the work queue by one that is advanced by hand"""
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(workqueue, "time", types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def queueFile(tmp_path):
+    """Work queue with PPNs 1, 2 and 3, and a lease time of 300 seconds"""
+    queueFile = str(tmp_path / "queue.db")
+    queue = WorkQueue(queueFile)
+    assert queue.populate(["1", "2", "3"], "/sips")
+    queue.close()
+    return queueFile
+
+
+@pytest.fixture
+def workers(queueFile):
+    """Two workers, each with its own connection to the work queue"""
+    queues = [WorkQueue(queueFile), WorkQueue(queueFile)]
+    yield queues
+    for queue in queues:
+        queue.close()
+
+
+def results(queue, name):
+    """Return list with field name of the results of all PPNs"""
+    return [result[name] for result in queue.results()]
+
+
+def test_populate(queueFile):
+    """The first worker fills the queue; other workers must use the same dirOut"""
+    queue = WorkQueue(queueFile)
+    assert queue.populate(["1", "2", "3", "4"], "/sips")
+    assert not queue.populate(["1", "2", "3"], "/other")
+    assert results(queue, "ppn") == ["1", "2", "3"]
+    assert results(queue, "status") == ["pending"] * 3
+    queue.close()
+
+
+def test_claim(clock, workers):
+    """PPNs are claimed in order, each by one worker"""
+    assert workers[0].claim("w1") == "1"
+    assert workers[1].claim("w2") == "2"
+    assert workers[0].claim("w1") == "3"
+    assert workers[1].claim("w2") is None
+    assert results(workers[0], "worker") == ["w1", "w2", "w1"]
+    assert results(workers[0], "status") == ["claimed"] * 3
+    assert workers[0].busy() == 3
+    assert workers[0].unfinished() == 3
+
+
+def test_lease_expiry(clock, workers):
+    """A PPN whose lease expired is claimed again by another worker"""
+    assert workers[0].claim("w1") == "1"
+    clock.now += 200
+    assert workers[0].renew("1", "w1")
+    clock.now += 299
+    assert workers[1].claim("w2") == "2"
+    assert workers[0].busy() == 2
+
+    clock.now += 2
+    assert workers[0].busy() == 1
+    assert workers[1].claim("w2") == "1"
+    assert results(workers[0], "attempts") == [2, 1, 0]
+    assert results(workers[0], "worker")[0] == "w2"
+    assert not workers[0].renew("1", "w1")
+
+
+def test_complete(clock, workers):
+    """Results of a PPN are stored by the worker that holds its lease"""
+    context = RunContext()
+    context.addError()
+    context.failedPPNs.add("1")
+    context.dirsInMetaCarriers.append("/batch/job1")
+    record = logging.LogRecord("root", logging.ERROR, __file__, 1, "bad %s", ("file",), None)
+
+    assert workers[0].claim("w1") == "1"
+    assert workers[0].complete("1", "w1", [record], context, False)
+    result = workers[1].results()[0]
+    assert result["status"] == "done" and result["worker"] == "w1"
+    assert (result["errors"], result["warnings"], result["failed"], result["exited"]) == \
+        (1, 0, 1, 0)
+    assert result["dirs"] == ["/batch/job1"]
+    assert result["log"] == [["root", logging.ERROR, "ERROR", "bad file"]]
+    assert workers[1].unfinished() == 2
+    assert workers[1].busy() == 0
+
+
+def test_complete_lease_lost(clock, workers):
+    """A worker that lost its lease cannot store its results, so the results of the
+    worker that claimed the PPN after it are kept"""
+    contextW1 = RunContext()
+    contextW1.addWarning()
+    assert workers[0].claim("w1") == "1"
+    clock.now += 301
+    assert workers[1].claim("w2") == "1"
+
+    assert not workers[0].complete("1", "w1", [], contextW1, False)
+    assert results(workers[0], "status")[0] == "claimed"
+    assert workers[1].complete("1", "w2", [], RunContext(), False)
+    assert results(workers[0], "warnings")[0] == 0
+    assert not workers[0].complete("1", "w1", [], contextW1, False)
+    assert results(workers[0], "worker")[0] == "w2"
+
+
+def test_leased_keeps_lease(queueFile):
+    """The lease is renewed while the PPN is processed, so it is not claimed again"""
+    queue = WorkQueue(queueFile, leaseTime=0.3)
+    other = WorkQueue(queueFile, leaseTime=0.3)
+    assert queue.claim("w1") == "1"
+    with queue.leased("1", "w1") as lost:
+        assert not lost.wait(1)
+        assert other.claim("w2") == "2"
+    assert not lost.is_set()
+    queue.close()
+    other.close()
+
+
+def test_leased_lost(queueFile):
+    """The lost event is set once another worker has claimed the PPN"""
+    queue = WorkQueue(queueFile, leaseTime=0.3)
+    other = WorkQueue(queueFile, leaseTime=0.3)
+    assert queue.claim("w1") == "1"
+    with queue.leased("1", "w1") as lost:
+        with other.transaction():
+            other.conn.execute("UPDATE ppns SET worker = 'w2' WHERE ppn = '1'")
+        assert lost.wait(2)
+    assert not queue.complete("1", "w1", [], RunContext(), False)
+    queue.close()
+    other.close()
+
+
+def test_wal_mode(tmp_path):
+    """A queue in WAL mode is switched back to a rollback journal"""
+    queueFile = str(tmp_path / "queue.db")
+    conn = sqlite3.connect(queueFile)
+    assert conn.execute("PRAGMA journal_mode=WAL").fetchone()[0] == "wal"
+    conn.close()
+    queue = WorkQueue(queueFile)
+    assert queue.conn.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    queue.close()